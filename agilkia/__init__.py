@@ -5,7 +5,11 @@ Traces may come from user interactions, or from automated test suites, etc.
 
 The main data structure for traces is the ``TraceSet``:
 * class TraceSet supports loading/saving traces as JSON, converting to Pandas, etc.
+* class TraceSetColumns is a fast columnar (NumPy) view of the actions in a TraceSet.
+* class TraceQuery is a lazy pipeline of filter/group/split steps over a TraceSet or file.
+* class TraceSetWriter saves traces into a JSON file incrementally, one trace at a time.
 * class Trace is used by TraceSet, and contains a list of Events.
+* class TraceView is a Trace that shares a selection of the events of another trace.
 * Each Event is a dict that contains at least the following keys:
   - "action" gives the name of the action (a string);
   - "inputs" is a dict of input parameter names to values;
@@ -30,8 +34,10 @@ __version__ = '0.5.1'
 from . random_tester import (read_input_rules, uniq, build_interface, print_signatures,
                              TracePrefixExtractor, RandomTester, SmartSequenceGenerator,
                              DUMP_WSDL, DUMP_SIGNATURES, GOOD_PASSWORD, TRACE_END)
-from . json_traces import (Event, Trace, TraceSet, TraceEncoder, TRACE_SET_VERSION,
-                           MetaData, xml_decode, all_action_names, safe_name,
+from . json_traces import (Event, Trace, TraceView, TraceSet, TraceSetColumns, TraceQuery,
+                           TraceSetWriter, TraceEncoder, TRACE_SET_VERSION, MetaData, EMPTY_DATA,
+                           COMPRESSION_SUFFIXES, CLUSTER_STRATEGIES, JsonBackend, JSON_BACKENDS,
+                           get_json_backend, xml_decode, all_action_names, safe_name,
                            default_map_to_chars, trace_to_string, traces_to_pandas)
 from . scanette_utils import (ScanetteModel)
 from . utils import (Color, ColorList)
@@ -898,6 +898,13 @@ class DotFile:
                     ["dot", formatOption, self.fileName]))
 
 
+def actionStatusSymbol(event: agilkia.Event) -> ExternalSymbol:
+    """
+    The default `eventToSymbol` of HMM_ClusterAlgo: the action name followed by the raw output Status.
+    """
+    return ExternalSymbol(event.action + str(event.outputs.get('Status', '')))
+
+
 class HMM_ClusterAlgo:
 
     def __init__(self, K: int = 2, states: int = 5):
@@ -915,7 +922,7 @@ class HMM_ClusterAlgo:
         self._symbols = None
         self._models = None
         self._bigModel = None
-        self.eventToSymbol = lambda event: ExternalSymbol(event.action + str(event.outputs.get('Status', '')))
+        self.eventToSymbol = actionStatusSymbol
 
     def tracesSetToSymbolSeq(self, traces: Iterable[agilkia.Trace]) -> List[List[ExternalSymbol]]:
         """
@@ -923,6 +930,8 @@ class HMM_ClusterAlgo:
 
         This is based on method `eventToSymbol` to translate each event, this method can be changed before a call to `fit` to change which events are considered equals.
         """
+        if self.eventToSymbol is actionStatusSymbol and isinstance(traces, agilkia.TraceSet):
+            return self._columnsToSymbolSeq(traces.get_columns())
         seqs = []
         for trace in traces:
             seq = []
@@ -931,6 +940,18 @@ class HMM_ClusterAlgo:
             seqs.append(seq)
         return seqs
 
+    def _columnsToSymbolSeq(self, columns: agilkia.TraceSetColumns) -> List[List[ExternalSymbol]]:
+        """
+        Same as `tracesSetToSymbolSeq` with the default `eventToSymbol`, using a columnar view.
+        """
+        statusCodes, statusLabels = columns.status_labels()
+        pairs = np.stack([columns.action_codes, statusCodes], axis=1)
+        keys, symbolCodes = np.unique(pairs, axis=0, return_inverse=True)
+        symbols = [ExternalSymbol(columns.actions[a] + statusLabels[s]) for a, s in keys.tolist()]
+        symbolList = [symbols[i] for i in symbolCodes.reshape(-1).tolist()]
+        offsets = columns.offsets.tolist()
+        return [symbolList[offsets[i]:offsets[i + 1]] for i in range(columns.num_traces)]
+
     def getSymbols(self, traces: Iterable[agilkia.Trace]) -> List[ExternalSymbol]:
         """
         Get the list of symbols used in the traces.
@@ -42,23 +42,36 @@ Ideas / Tasks to do
 
 import os
 import sys
+import io
+import concurrent.futures
+import functools
+import itertools
+import gzip
+import bz2
+import lzma
 from pathlib import Path  # object-oriented filenames!
 from collections import defaultdict
 import json
 import decimal
+import math
 import datetime
 import re
+import zlib
+import hashlib
+import pickle
 import xml.etree.ElementTree as ET
 import pandas as pd            # type: ignore
 import numpy as np             # type: ignore
+import scipy.sparse            # type: ignore
 import sklearn.cluster         # type: ignore
 import sklearn.preprocessing   # type: ignore
+import sklearn.neighbors       # type: ignore
+import sklearn.decomposition   # type: ignore
+import scipy.spatial           # type: ignore
 import matplotlib.pyplot as plt
-import matplotlib.cm as pltcm
 from sklearn.manifold import TSNE
-# liac-arff from https://pypi.org/project/liac-arff (via pip)
-# import arff                    # type: ignore
-from typing import List, Set, Mapping, Dict, Union, Any, Optional, cast
+from typing import (List, Set, Mapping, Dict, Tuple, Union, Any, Optional, Iterator, Callable,
+                    IO, cast)
 
 
 TRACE_SET_VERSION = "0.1.4"
@@ -71,6 +84,84 @@ def safe_name(string: str) -> str:
     return re.sub("[^A-Za-z0-9]", "_", string)
 
 
+class _EmptyData(dict):
+    """A read-only empty dictionary, shared by all the compacted events.
+
+    Events never return it directly.  Instead, each access to an empty field of a
+    compacted event returns a new empty _EmptyDataRef, which replaces EMPTY_DATA
+    in that event when it is first updated.  So compacted events can still be updated.
+    """
+
+    __slots__ = ()
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("EMPTY_DATA is shared and read-only.  Assign a new dict instead.")
+
+    __setitem__ = __delitem__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+    def __ior__(self, other):
+        self._read_only()
+
+    def copy(self) -> Dict[str, Any]:
+        """Returns a new, empty, mutable dictionary."""
+        return {}
+
+    def __reduce__(self):
+        return "EMPTY_DATA"
+
+    def __repr__(self):
+        return "{}"
+
+
+EMPTY_DATA: Dict[str, Any] = _EmptyData()
+"""The shared empty inputs/outputs/meta_data of compacted events.  See TraceSet.compact()."""
+
+
+class _EmptyDataRef(dict):
+    """The value of an empty field of a compacted event: a new empty dictionary.
+
+    The first update stores this dictionary into the event, in place of EMPTY_DATA.
+    (If the event has been updated via another reference since then, it is not stored.)
+    """
+
+    __slots__ = ("_event", "_field")
+
+    def _store(self) -> None:
+        """Replaces EMPTY_DATA in the event by this dictionary, just before its first update."""
+        if self._event is not None:
+            if getattr(self._event, self._field) is EMPTY_DATA:
+                setattr(self._event, self._field, self)
+            self._event = None
+
+    def __setitem__(self, key, value):
+        self._store()
+        super().__setitem__(key, value)
+
+    def setdefault(self, key, default=None):
+        self._store()
+        return super().setdefault(key, default)
+
+    def update(self, *args, **kwargs):
+        self._store()
+        super().update(*args, **kwargs)
+
+    def __ior__(self, other):
+        self._store()
+        return super().__ior__(other)
+
+    def __reduce__(self):
+        return (dict, (dict(self),))
+
+
+def _empty_data_ref(event: 'Event', field: str) -> Dict[str, Any]:
+    """Makes an _EmptyDataRef for the given field of event (without a slow __init__)."""
+    ref = _EmptyDataRef()
+    ref._event = event
+    ref._field = field
+    return ref
+
+
 class Event:
     """An Event is a dictionary-like object that records all the details of an event.
 
@@ -81,32 +172,97 @@ class Event:
         * self.meta_data (Dict[str,Any]): any extra properties such as "timestamp".
           Note: if self.meta_data["timestamp"] is present, it should be in ISO 8601 format.
           Or use get_meta(key) to get an individual meta-data value.
+
+    Events use __slots__ and interned action names, to keep them small.
+    After compact(), empty inputs/outputs/meta_data are stored as the shared EMPTY_DATA,
+    until they are first updated.
     """
 
+    __slots__ = ("action", "_inputs", "_outputs", "_meta_data")
+
     def __init__(self, action: str, inputs: Dict[str, Any], outputs: Dict[str, Any],
                  meta_data: Optional[MetaData] = None):
-        self.action = action
-        self.inputs = inputs
-        self.outputs = outputs
-        self.meta_data: MetaData = {} if meta_data is None else meta_data.copy()
+        self.action = sys.intern(action) if type(action) is str else action
+        self._inputs = inputs
+        self._outputs = outputs
+        self._meta_data: MetaData = {} if meta_data is None else meta_data.copy()
+
+    @property
+    def inputs(self) -> Dict[str, Any]:
+        """The named inputs and their values."""
+        inputs = self._inputs
+        return _empty_data_ref(self, "_inputs") if inputs is EMPTY_DATA else inputs
+
+    @inputs.setter
+    def inputs(self, inputs: Dict[str, Any]) -> None:
+        self._inputs = inputs
+
+    @property
+    def outputs(self) -> Dict[str, Any]:
+        """The named outputs and their values."""
+        outputs = self._outputs
+        return _empty_data_ref(self, "_outputs") if outputs is EMPTY_DATA else outputs
+
+    @outputs.setter
+    def outputs(self, outputs: Dict[str, Any]) -> None:
+        self._outputs = outputs
+
+    @property
+    def meta_data(self) -> MetaData:
+        """Any extra properties of this event, such as "timestamp"."""
+        meta_data = self._meta_data
+        return _empty_data_ref(self, "_meta_data") if meta_data is EMPTY_DATA else meta_data
+
+    @meta_data.setter
+    def meta_data(self, meta_data: MetaData) -> None:
+        self._meta_data = meta_data
 
     @property
     def status(self) -> int:
         """Read-only status of the operation, where 0 means success.
         If no output 'Status' is available, this method always returns 0.
         """
-        return int(self.outputs.get("Status", "0"))
+        return int(self._outputs.get("Status", "0"))
 
     @property
     def error_message(self) -> str:
         """Read-only error message output by this operation.
         If no output['Error'] field is available, this method always returns "".
         """
-        return self.outputs.get("Error", "")
+        return self._outputs.get("Error", "")
 
     def __str__(self):
         """Shows action, inputs and outputs, but elides any meta-data."""
-        return f"Event({self.action}, {self.inputs}, {self.outputs})"
+        return f"Event({self.action}, {self._inputs}, {self._outputs})"
+
+    def compact(self) -> None:
+        """Shares the action name and replaces any empty dictionaries by EMPTY_DATA."""
+        if type(self.action) is str:
+            self.action = sys.intern(self.action)
+        if not self._inputs:
+            self._inputs = EMPTY_DATA
+        if not self._outputs:
+            self._outputs = EMPTY_DATA
+        if not self._meta_data:
+            self._meta_data = EMPTY_DATA
+
+
+def _cached_trace_data(method):
+    """Memoizes a data-gathering method of Trace, keyed by the method name and arguments.
+
+    The cache is cleared when the length of the trace changes (see Trace._check_cache).
+    Each call returns a copy of the cached dictionary, so callers can safely update it.
+    """
+    @functools.wraps(method)
+    def cached_method(self, *args, **kwargs):
+        self._check_cache()
+        key = (method.__name__, args, tuple(sorted(kwargs.items())))
+        result = self._trace_data.get(key)
+        if result is None:
+            result = method(self, *args, **kwargs)
+            self._trace_data[key] = result
+        return result.copy()
+    return cached_method
 
 
 class Trace:
@@ -137,6 +293,9 @@ class Trace:
             raise Exception("Events required, not: " + str(events[0]) + " ...")
         self.events = events
         self._parent = parent
+        self._timestamps: Optional[Tuple[np.ndarray, np.ndarray]] = None
+        self._trace_data: Dict[Tuple, Dict[str, Any]] = {}
+        self._cache_length = len(events)  # the number of events when the caches were valid.
         self.meta_data: MetaData = {} if meta_data is None else meta_data
         if random_state is not None:
             self.meta_data["random_state"] = random_state
@@ -165,30 +324,165 @@ class Trace:
         if not isinstance(event, Event):
             raise Exception("Event required, not: " + str(event))
         self.events.append(event)
+        self.invalidate_cache()
+        if self._parent is not None:
+            self._parent._columns = None
+
+    def invalidate_cache(self) -> None:
+        """Discards the cached timestamps and data (such as action_counts) of this trace.
+
+        This is done automatically by append, or when the number of events changes (for
+        example, by appending directly to ``trace.events``).  If you change the events in
+        some other way (for example, by updating ``event.action``), call this, or
+        invalidate_columns() on the parent TraceSet.
+        """
+        self._timestamps = None
+        self._trace_data = {}
+        self._cache_length = len(self)
+
+    def _check_cache(self) -> None:
+        """Discards the cached data if events have been added or removed without append."""
+        if self._cache_length != len(self):
+            self.invalidate_cache()
+
+    def get_timestamps(self) -> np.ndarray:
+        """Returns the "timestamp" meta-data of each event in this trace as a NumPy array.
+
+        The timestamps are parsed (using datetime.fromisoformat) the first time this is
+        called, then cached until an event is appended to this trace.
+        Timezone-aware timestamps are converted to UTC.
 
+        Returns:
+            An array of datetime64[ns] values (int64 nanoseconds since the epoch),
+            with NaT for each event that has no timestamp.
+        """
+        return self._parsed_timestamps()[0]
+
+    def _parsed_timestamps(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the cached pair (timestamps, aware), where aware marks timezone-aware ones."""
+        self._check_cache()
+        if self._timestamps is None:
+            nanos = []
+            aware = []
+            for ev in self:
+                timestamp = ev._meta_data.get("timestamp")
+                if timestamp is None:
+                    nanos.append(_NAT)
+                    aware.append(False)
+                else:
+                    # the parsing of date should be done with dateutil.parser but it is
+                    # under BSD licence, so we use fromisoformat (see with_traces_split).
+                    timestamp = datetime.datetime.fromisoformat(timestamp)
+                    is_aware = timestamp.tzinfo is not None
+                    delta = timestamp - (_EPOCH_UTC if is_aware else _EPOCH)
+                    nanos.append((delta.days * 86400 + delta.seconds) * 1000000000
+                                 + delta.microseconds * 1000)
+                    aware.append(is_aware)
+            self._timestamps = (np.array(nanos, dtype=np.int64).view("datetime64[ns]"),
+                                np.array(aware, dtype=bool))
+        return self._timestamps
+
+    def _delay_cuts(self, delay: datetime.timedelta) -> np.ndarray:
+        """Returns a boolean array that is True for each event that starts after a long delay.
+
+        This is true if this event and the previous event both have timestamps,
+        and the time between them is greater than delay.
+        """
+        (timestamps, aware) = self._parsed_timestamps()
+        cuts = np.zeros(len(timestamps), dtype=bool)
+        if len(timestamps) > 1:
+            valid = ~np.isnat(timestamps)
+            pairs = valid[1:] & valid[:-1]
+            if (pairs & (aware[1:] != aware[:-1])).any():
+                raise TypeError("can't subtract offset-naive and offset-aware datetimes")
+            cuts[1:] = pairs & (np.diff(timestamps) > np.timedelta64(delay))
+        return cuts
+
+    def view(self, indexes: Union[range, np.ndarray],
+             meta_data: Optional[MetaData] = None) -> 'TraceView':
+        """Returns a new trace that contains just the events at the given indexes.
+
+        The new trace is a TraceView, so it shares the events of this trace
+        rather than copying them.
+
+        Args:
+            indexes: the positions of the wanted events within this trace, either as
+                a range or as a NumPy array of integers.
+            meta_data: the meta-data of the new trace.
+        """
+        return TraceView(self.events, indexes, meta_data=meta_data)
+
+    def compact(self) -> None:
+        """Compacts all the events in this trace, to reduce memory usage.  See Event.compact()."""
+        for ev in self:
+            ev.compact()
+
+    @_cached_trace_data
     def action_counts(self) -> Dict[str, int]:
         """Returns a dictionary of how many times each action occurs in this trace.
 
         Returns:
             A dictionary of counts that can be used for clustering traces.
         """
+        columns = self._parent_columns()
+        if columns is not None:
+            return columns.action_counts(columns.trace_index(self))
         result = defaultdict(int)
-        for ev in self.events:
+        for ev in self:
             result[ev.action] += 1
         return result
 
+    @_cached_trace_data
     def action_status_counts(self) -> Dict[str, int]:
         """Counts how many times each action-status pair occurs in this trace.
 
         Returns:
             A dictionary of counts that can be used for clustering traces.
         """
+        columns = self._parent_columns()
+        if columns is not None:
+            return columns.action_status_counts(columns.trace_index(self))
         result = defaultdict(int)
-        for ev in self.events:
+        for ev in self:
             key = ev.action + "_" + str(ev.status)
             result[key] += 1
         return result
 
+    @_cached_trace_data
+    def action_ngram_counts(self, n: int = 2, pad: bool = False,
+                            hash_size: Optional[int] = None) -> Dict[str, int]:
+        """Counts how many times each sequence of n consecutive actions occurs in this trace.
+
+        For example, the bigram (n=2) "Login->Pay" counts how often Pay directly follows Login.
+        These capture the order of the actions, unlike action_counts().
+
+        Args:
+            n: the length of the sequences of actions.
+            pad: True means add a "^" action before the start and a "$" action after the end,
+                so that the first and last actions of the trace are counted too.
+            hash_size: optional maximum number of distinct keys.  Each sequence is hashed
+                into one of this many buckets, named "hash0", "hash1", etc.
+                This caps the number of columns of get_trace_data.
+
+        Returns:
+            A dictionary of counts that can be used for clustering traces.
+        """
+        columns = self._parent_columns()
+        if columns is not None:
+            return columns.ngram_counts(columns.trace_index(self), n, pad, hash_size)
+        vocab: Dict[str, int] = {}
+        codes = np.array([vocab.setdefault(ev.action, len(vocab)) for ev in self], dtype=np.int64)
+        offsets = np.array([0, len(codes)], dtype=np.int64)
+        (rows, ngrams, names) = _ngrams(codes, offsets, list(vocab), n, pad, hash_size)
+        return _count_codes(ngrams, names)
+
+    @_cached_trace_data
+    def action_transition_counts(self, hash_size: Optional[int] = None) -> Dict[str, int]:
+        """Counts the transitions from each action to the next, including from the start
+        ("^") and to the end ("$").  This is action_ngram_counts(2, pad=True).
+        """
+        return self.action_ngram_counts(2, pad=True, hash_size=hash_size)
+
     def to_string(self,
                   to_char: Dict[str, str] = None,
                   compress: List[str] = None,
@@ -200,8 +494,22 @@ class Trace:
         if to_char is None:
             if self._parent is None:
                 raise Exception("Cannot view trace with no parent and no to_char map.")
+            columns = self._parent_columns()
+            if columns is not None:
+                strings = self._parent._cached_strings(compress, color_status, columns)
+                return strings[columns.trace_index(self)]
             to_char = self._parent.get_event_chars()
-        return trace_to_string(self.events, to_char, compress=compress, color_status=color_status)
+        columns = self._parent_columns()
+        if columns is not None:
+            return columns.trace_to_string(columns.trace_index(self), to_char,
+                                           compress=compress, color_status=color_status)
+        return trace_to_string(self, to_char, compress=compress, color_status=color_status)
+
+    def _parent_columns(self) -> Optional['TraceSetColumns']:
+        """Returns the columnar view of the parent TraceSet, if this trace is in it."""
+        if self._parent is None:
+            return None
+        return self._parent._trace_columns(self)
 
     def __str__(self):
         try:
@@ -210,6 +518,86 @@ class Trace:
             return "???"
 
 
+class TraceView(Trace):
+    """A Trace whose events are a selection of the events of another trace.
+
+    A view stores just the indexes of its events within the original list of events,
+    so the split/group/filter methods of TraceSet can create views (with view=True)
+    without copying any lists of events.  Views can be used like any other Trace.
+    They are materialized into a normal list of events the first time that
+    ``self.events`` is used (for example, by ``append``).  Saving a view into a
+    JSON file does not materialize it.
+    """
+
+    def __init__(self, source: List[Event], indexes: Union[range, np.ndarray],
+                 parent: 'TraceSet' = None, meta_data: Optional[MetaData] = None):
+        """Create a view of the events source[i] for each i in indexes."""
+        self._source: Optional[List[Event]] = source
+        self._indexes: Union[range, np.ndarray, None] = indexes
+        self._events: Optional[List[Event]] = None
+        self._parent = parent
+        self._timestamps: Optional[Tuple[np.ndarray, np.ndarray]] = None
+        self._trace_data: Dict[Tuple, Dict[str, Any]] = {}
+        self._cache_length = len(indexes)
+        self.meta_data: MetaData = {} if meta_data is None else meta_data
+
+    @property
+    def events(self) -> List[Event]:
+        """The list of events in this trace.  This materializes the view."""
+        if self._events is None:
+            self._events = list(self)
+            self._source = None
+            self._indexes = None
+        return self._events
+
+    @events.setter
+    def events(self, events: List[Event]) -> None:
+        self._events = events
+        self._source = None
+        self._indexes = None
+        self.invalidate_cache()
+
+    def is_materialized(self) -> bool:
+        """True if this view has made its own copy of its list of events."""
+        return self._events is not None
+
+    def __iter__(self):
+        if self._events is not None:
+            return iter(self._events)
+        if isinstance(self._indexes, range):
+            return iter(self._source[self._indexes.start:self._indexes.stop:self._indexes.step])
+        return map(self._source.__getitem__, self._indexes.tolist())
+
+    def __len__(self):
+        if self._events is not None:
+            return len(self._events)
+        return len(self._indexes)
+
+    def __getitem__(self, key):
+        if self._events is not None:
+            return self._events[key]
+        if isinstance(key, slice):
+            return [self._source[i] for i in self._indexes[key]]
+        return self._source[self._indexes[key]]
+
+    def view(self, indexes: Union[range, np.ndarray],
+             meta_data: Optional[MetaData] = None) -> 'TraceView':
+        """Returns a view of some of the events in this trace, sharing the same source."""
+        if self._events is not None:
+            return super().view(indexes, meta_data)
+        if isinstance(self._indexes, range) and isinstance(indexes, range):
+            selected = self._indexes[indexes.start:indexes.stop:indexes.step]
+        else:
+            base = self._indexes
+            if isinstance(base, range):
+                base = np.arange(base.start, base.stop, base.step, dtype=_index_dtype(base.stop))
+            if isinstance(indexes, range):
+                selected = base[indexes.start:indexes.stop:indexes.step]
+            else:
+                selected = base[indexes]
+        return TraceView(self._source, selected, meta_data=meta_data)
+
+
 class TraceSet:
     """Represents a set of traces, either generated or recorded.
 
@@ -247,6 +635,13 @@ class TraceSet:
         self.traces = traces
         self._clusters: List[int] = None
         self._cluster_data: pd.DataFrame = None
+        self._cluster_rows: Optional[np.ndarray] = None  # the rows in _cluster_data (or all).
+        self._cluster_model: Optional[Tuple[Any, Any, Optional[List[str]]]] = None
+        self._cluster_index: Optional[Tuple[np.ndarray, np.ndarray]] = None  # (order, starts)
+        self._cluster_embedding: Optional[Tuple[Tuple, Any, np.ndarray, np.ndarray]] = None
+        self._columns: Optional[TraceSetColumns] = None
+        self._trace_data: Dict[Tuple, Any] = {}
+        self._strings: Dict[Tuple, List[str]] = {}
         trace_parents = set()
         # add all the trace to this set.
         for tr in self.traces:
@@ -322,6 +717,62 @@ class TraceSet:
         trace._parent = self
         self.traces.append(trace)
         self._event_chars = None  # we will recalculate this later
+        self._columns = None
+        self._trace_data = {}
+        self._strings = {}
+        self._cluster_index = None  # the clusters no longer cover all the traces.
+
+    def get_columns(self) -> 'TraceSetColumns':
+        """Returns a columnar view of the actions and statuses of all events in this set.
+
+        The view is built on the first call and cached.  It is rebuilt when the number of
+        traces changes or the length of any trace changes (for example, after appending
+        an event directly to ``trace.events``).  If you change the events in some other
+        way (for example, by updating ``event.action``), call ``invalidate_columns()``.
+        """
+        if self._columns is None or not self._columns.matches(self.traces):
+            self._columns = TraceSetColumns(self.traces)
+            # the cached get_trace_data results and strings are stale too.
+            self._trace_data = {}
+            self._strings = {}
+        return self._columns
+
+    def _trace_columns(self, trace: Trace) -> Optional['TraceSetColumns']:
+        """Like get_columns, for the methods of one trace, or None if trace is not in this set.
+
+        This checks just the number of traces and the length of the given trace,
+        rather than every trace, so that it takes constant time.
+        """
+        columns = self._columns
+        if (columns is None or columns.traces is not self.traces
+                or columns.num_traces != len(self.traces)):
+            columns = self.get_columns()
+        i = columns.trace_index(trace)
+        if i is not None and columns.offsets[i + 1] - columns.offsets[i] != len(trace):
+            self._columns = None
+            columns = self.get_columns()
+            i = columns.trace_index(trace)
+        return None if i is None else columns
+
+    def query(self) -> 'TraceQuery':
+        """Starts a lazy query over the traces in this set.  See TraceQuery."""
+        return TraceQuery(self)
+
+    @classmethod
+    def query_json(cls, file: Path) -> 'TraceQuery':
+        """Starts a lazy query that streams the traces from a JSON file.  See TraceQuery."""
+        return TraceQuery(file)
+
+    def invalidate_columns(self) -> None:
+        """Discards the cached columnar view and trace data, after the events have been changed.
+
+        This also calls invalidate_cache() on every trace.
+        """
+        self._columns = None
+        self._trace_data = {}
+        self._strings = {}
+        for tr in self.traces:
+            tr.invalidate_cache()
 
     def set_event_chars(self, given: Mapping[str, str] = None):
         """Sets up the event-to-char map that is used to visualise traces.
@@ -339,8 +790,10 @@ class TraceSet:
         else:
             self.meta_data["action_chars"] = given  # override any previous given map.
             new_given = cast(Dict[str, str], given).copy()  # copy so we don't change orginal.
-        actions = all_action_names(self.traces)
+        actions = set(self.get_columns().actions)
         self._event_chars = default_map_to_chars(actions, given=new_given)
+        self._trace_data = {}
+        self._strings = {}
 
     def get_event_chars(self):
         """Gets the event-to-char map that is used to visualise traces.
@@ -352,32 +805,122 @@ class TraceSet:
             self.set_event_chars()
         return self._event_chars
 
+    def to_strings(self, compress: List[str] = None, color_status: bool = False) -> List[str]:
+        """Returns the one-line summary of every trace, one character per event.
+
+        This is the same as [tr.to_string(None, compress, color_status) for tr in self],
+        but all the traces are rendered in one pass (see TraceSetColumns.to_strings).
+        The strings are cached until set_event_chars is called or the number of traces or
+        events changes, so that Trace.to_string and str(trace) just look up the cached string.
+        """
+        return list(self._cached_strings(compress, color_status))
+
+    def _cached_strings(self, compress: Optional[List[str]], color_status: bool,
+                        columns: Optional['TraceSetColumns'] = None) -> List[str]:
+        """Implements to_strings, returning the cached list itself.
+
+        Trace.to_string passes the columns that it got from _trace_columns, which has
+        already checked (in constant time) that its own string is not stale.
+        """
+        if columns is None:
+            columns = self.get_columns()  # this discards the cached strings if events changed.
+        key = (None if compress is None else tuple(compress), color_status)
+        strings = self._strings.get(key)
+        if strings is None:
+            # get_event_chars may call set_event_chars, which clears the cache.
+            to_char = self.get_event_chars()
+            strings = columns.to_strings(to_char, compress, color_status)
+            self._strings[key] = strings
+        return strings
+
+    def compact(self) -> None:
+        """Reduces the memory used by all the events in this TraceSet.
+
+        The action names are interned, so each distinct name is stored just once,
+        and any empty inputs, outputs or meta_data dictionaries are replaced by the
+        shared EMPTY_DATA dictionary.  This is worthwhile for very large TraceSets.
+        The events can still be updated as usual: the first update of an empty
+        dictionary gives that event its own dictionary again.
+        """
+        for tr in self.traces:
+            tr.compact()
+
     def __str__(self):
         name = self.meta_data["dataset"]  # required meta data
         return f"TraceSet '{name}' with {len(self)} traces."
 
-    def save_to_json(self, file: Path) -> None:
+    def save_to_json(self, file: Path, indent: Optional[int] = 2, index: bool = False,
+                     backend: Union[str, 'JsonBackend', None] = None,
+                     compress_level: Optional[int] = None) -> None:
+        """Save this TraceSet into a JSON file.
+
+        Args:
+            file: the JSON file to write.  If its name ends with one of the
+                COMPRESSION_SUFFIXES (such as "traces.json.gz") it will be compressed.
+            indent: the number of spaces to indent each nesting level of the JSON.
+                None means no indentation or newlines, which gives much smaller files.
+            index: True means also save a sidecar index file, which allows individual
+                traces to be loaded quickly via ``load_trace`` and ``load_traces``.
+            backend: the JSON library to use, such as "json" or "orjson".
+                The default is the fastest one installed.  See ``get_json_backend``.
+            compress_level: the compression level, if the file is compressed.
+                The default is the usual default level of each compression library.
+        """
         if isinstance(file, str):
             print(f"WARNING: converting {file} to Path.  Please learn to speak pathlib.")
             file = Path(file)
-        with file.open("w") as output:
-            json.dump(self, output, indent=2, cls=TraceEncoder)
+        with TraceSetWriter(file, self.meta_data, indent=indent, index=index,
+                            backend=backend, compress_level=compress_level) as writer:
+            for tr in self.traces:
+                writer.write(tr)
 
     @classmethod
-    def load_from_json(cls, file: Path) -> 'TraceSet':
+    def load_from_json(cls, file: Path, streaming: bool = False,
+                       backend: Union[str, 'JsonBackend', None] = None,
+                       compact: bool = False) -> 'TraceSet':
+        """Load a TraceSet from a JSON file.
+
+        Args:
+            file: the JSON file to read.  Compressed files (see COMPRESSION_SUFFIXES)
+                are decompressed as they are read.
+            streaming: True means parse the traces one at a time, using
+                ``iter_traces_from_json``, rather than decoding the whole JSON document
+                into memory first.  This is slower, but the peak memory usage is bounded
+                by the largest single trace, so it is useful for very large files.
+            backend: the JSON library to use when not streaming, such as "json" or
+                "orjson".  The default is the fastest one installed.
+                See ``get_json_backend``.
+            compact: True means compact the events as they are loaded, to reduce
+                memory usage.  See ``compact()``.
+        """
         if isinstance(file, str):
             print(f"WARNING: converting {file} to Path.  Please learn to speak pathlib.")
             file = Path(file)
         if not isinstance(file, Path):
             raise Exception(f"load_from_json requires Path, not {file} (type={type(file)})")
-        # with open(filename, "r") as input:
-        data = json.loads(file.read_text())
+        if streaming:
+            header: Dict[str, Any] = {}
+            traceset = cls([], {})
+            for tr in cls.iter_traces_from_json(file, header):
+                if compact:
+                    tr.compact()
+                traceset.append(tr)
+            cls._upgrade_header(traceset, file, header)
+            return traceset
+        with _open_trace_file(file, "rb") as input:
+            data = get_json_backend(backend).loads(input.read())
+        traceset = cls._traceset_from_json_data(file, data)
+        if compact:
+            traceset.compact()
+        return traceset
+
+    @classmethod
+    def _traceset_from_json_data(cls, file: Path, data: Any) -> 'TraceSet':
+        """Builds a TraceSet from the decoded JSON data of a whole file."""
         # Now check version and upgrade if necessary.
         if isinstance(data, list):
             # this file was pre-TraceSet, so just a list of lists of events.
-            mtime = datetime.datetime.fromtimestamp(file.stat().st_mtime).isoformat()
-            meta = {"date": mtime, "dataset": file.name, "source": "Upgraded from version 0.1"}
-            traces = cls([], meta)
+            traces = cls([], cls._pre_traceset_meta_data(file))
             for ev_list in data:
                 events = [cls._create_event_object("0.1", ev) for ev in ev_list]
                 traces.append(Trace(events))
@@ -387,28 +930,403 @@ class TraceSet:
         else:
             raise Exception("unknown JSON file format: " + str(data)[0:60])
 
+    @classmethod
+    def load_many(cls, files: List[Path], workers: Optional[int] = None,
+                  meta_data: Optional[MetaData] = None,
+                  backend: Optional[str] = None) -> 'TraceSet':
+        """Loads several traces files in parallel, and merges them into one TraceSet.
+
+        Each file is parsed in a separate process, then all the traces are added into
+        the resulting TraceSet in the same order as files, so the result is deterministic.
+        Files with the suffix ".npz" are loaded via ``load_from_columnar``, and all
+        other files via ``load_from_json``.
+
+        The "source_file" meta-data of each trace is set to the name of its file.
+        The meta-data of the result is:
+            * meta_data, if that is given;
+            * otherwise all the meta-data entries that have the same value in every file,
+              plus default meta-data (see ``get_default_meta_data``) for other entries.
+        In both cases, meta_data["source_files"] is set to the list of file names.
+
+        Args:
+            files: the traces files to load.
+            workers: the maximum number of processes to use (default is the number of CPUs).
+                If this is 1, the files are all loaded by the current process.
+            meta_data: optional meta-data for the resulting TraceSet.
+            backend: the JSON library to use (see ``get_json_backend``).
+
+        Returns:
+            a new TraceSet containing all the traces from all the files.
+        """
+        files = [Path(f) for f in files]
+        if workers == 1 or len(files) <= 1:
+            loaded = [_load_traces_file(cls, f, backend) for f in files]
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+                loaded = list(executor.map(_load_traces_file, [cls] * len(files), files,
+                                           [backend] * len(files)))
+        if meta_data is None:
+            meta_data = cls.get_default_meta_data()
+            if loaded:
+                common = loaded[0].meta_data
+                for traceset in loaded[1:]:
+                    common = {k: v for (k, v) in common.items()
+                              if k in traceset.meta_data and traceset.meta_data[k] == v}
+                meta_data.update(common)
+        else:
+            meta_data = meta_data.copy()
+        meta_data["source_files"] = [str(f) for f in files]
+        result = cls([], meta_data)
+        for (file, traceset) in zip(files, loaded):
+            for tr in traceset.traces:
+                tr.meta_data["source_file"] = str(file)
+                result.append(tr)
+        return result
+
+    @classmethod
+    def iter_traces_from_json(cls, file: Path, header: Optional[Dict[str, Any]] = None,
+                              event_filter: Callable[[Event], bool] = None) -> Iterator[Trace]:
+        """Reads the traces from a JSON file one at a time, without loading the whole file.
+
+        The "traces" array is parsed incrementally, so only one trace is held in memory
+        at a time.  The version number of the file is checked before any traces are read.
+        Note that the yielded traces have no parent TraceSet.
+
+        Args:
+            file: the JSON file to read.  Compressed files (see COMPRESSION_SUFFIXES)
+                are decompressed incrementally too.
+            header: optional dictionary that will be filled in with all the top-level
+                fields of the file (such as "version" and "meta_data") except "traces".
+                Note that fields that appear after the traces in the file (usually
+                "meta_data") are only available once the iteration has finished.
+            event_filter: optional predicate that is applied to each event as it is
+                decoded.  Events where it returns False are discarded straight away,
+                and traces that lose all their events are skipped.
+
+        Returns:
+            An iterator over the Trace objects in the file.
+        """
+        if isinstance(file, str):
+            print(f"WARNING: converting {file} to Path.  Please learn to speak pathlib.")
+            file = Path(file)
+        if header is None:
+            header = {}
+        with io.TextIOWrapper(_open_trace_file(file, "rb"), encoding="utf-8") as input:
+            yield from cls._iter_json_traces(_JsonStreamReader(input), header, event_filter)
+
+    @classmethod
+    def _iter_json_traces(cls, reader: '_JsonStreamReader', header: Dict[str, Any],
+                          event_filter: Callable[[Event], bool] = None) -> Iterator[Trace]:
+        """Parses a JSON traces file, yielding each Trace."""
+        for tr_data in cls._scan_json_traces(reader, header):
+            trace = cls._decode_trace(header["version"], tr_data)
+            if event_filter is not None and len(trace) > 0:
+                trace.events = [ev for ev in trace.events if event_filter(ev)]
+                if len(trace) == 0:
+                    continue
+            yield trace
+
+    @classmethod
+    def _scan_json_traces(cls, reader: '_JsonStreamReader', header: Dict[str, Any],
+                          spans: bool = False,
+                          header_spans: Optional[Dict[str, Tuple[int, int]]] = None
+                          ) -> Iterator[Any]:
+        """Parses the outer structure of a JSON traces file.
+
+        Yields the JSON data of each trace, or its (start, end) position if spans is True.
+        All the other top-level fields are stored into header, and their (start, end)
+        positions are stored into header_spans (if given).
+        """
+        read_trace = reader.span if spans else reader.value
+        if reader.expect("[{") == "[":
+            # this file was pre-TraceSet, so just a list of lists of events.
+            header["version"] = "0.1"
+            yield from reader.items(read_trace)
+            return
+        for key in reader.keys():
+            if key == "traces":
+                if header.get("__class__", None) != "TraceSet":
+                    raise Exception("unknown JSON file format: " + str(header)[0:60])
+                if "version" not in header:
+                    raise Exception("JSON traces file must give its version before its traces.")
+                cls._check_json_version(header["version"])
+                reader.expect("[")
+                yield from reader.items(read_trace)
+            elif header_spans is not None:
+                reader.peek()
+                start = reader.position
+                header[key] = reader.value()
+                header_spans[key] = (start, reader.position)
+            else:
+                header[key] = reader.value()
+        if header.get("__class__", None) != "TraceSet":
+            raise Exception("unknown JSON file format: " + str(header)[0:60])
+
+    @classmethod
+    def _decode_trace(cls, version: str, tr_data: Any) -> Trace:
+        """Converts the JSON data of one trace into a Trace object."""
+        if version == "0.1":
+            return Trace([cls._create_event_object("0.1", ev) for ev in tr_data])
+        return cls._create_trace_object(version, tr_data)
+
+    @classmethod
+    def load_trace(cls, file: Path, num: int) -> Trace:
+        """Loads just the trace at position num of a JSON traces file.
+
+        This uses the index of the file (see ``load_traces``), so it does not need
+        to parse the rest of the file.
+        """
+        return cls.load_traces(file, [num])[0]
+
+    @classmethod
+    def load_traces(cls, file: Path, nums: List[int],
+                    backend: Union[str, 'JsonBackend', None] = None) -> 'TraceSet':
+        """Loads just the requested traces from a JSON traces file.
+
+        This uses a sidecar index file (FILE.index.npz) that records where each trace
+        starts and ends within the JSON file, so it can seek directly to the requested
+        traces without parsing the rest of the file.  The index is written by
+        ``save_to_json(..., index=True)``, or it is built (and saved if possible) the
+        first time it is needed.  It is rebuilt automatically if the size or
+        modification time of the JSON file changes.
+        Note that this does not support compressed files.
+
+        Args:
+            file: the JSON traces file.
+            nums: the positions of the wanted traces within the file.  Like list indexes,
+                negative positions count back from the end of the file, so -1 is the last trace.
+            backend: the JSON library used to decode the traces (see ``get_json_backend``).
+
+        Returns:
+            a new TraceSet containing just the requested traces, in the requested order.
+
+        Raises:
+            IndexError: if a position is not within -N..N-1, for a file of N traces.
+        """
+        if isinstance(file, str):
+            print(f"WARNING: converting {file} to Path.  Please learn to speak pathlib.")
+            file = Path(file)
+        if file.suffix in COMPRESSION_SUFFIXES:
+            raise Exception(f"cannot load individual traces from compressed file {file}.")
+        (starts, ends, header) = cls._json_index(file)
+        version = header["version"]
+        decoder = get_json_backend(backend)
+        traces: Dict[int, Trace] = {}
+        with file.open("rb") as input:
+            # read the traces in file order, to minimise seeking.
+            for num in sorted(set(nums), key=lambda n: starts[n]):
+                input.seek(starts[num])
+                data = input.read(ends[num] - starts[num])
+                traces[num] = cls._decode_trace(version, decoder.loads(data))
+        if version == "0.1":
+            meta = cls._pre_traceset_meta_data(file)
+        else:
+            meta = header["meta_data"]
+        traceset = cls([], meta)
+        for num in nums:
+            traceset.append(traces[num])
+        if version != "0.1":
+            cls._upgrade_meta_data(traceset, version, header)
+        return traceset
+
+    @classmethod
+    def _json_index(cls, file: Path) -> Any:
+        """Gets the (starts, ends, header) index of a JSON traces file.
+
+        It is read from the sidecar index file if that is still valid, else it is rebuilt.
+        """
+        index_file = _json_index_path(file)
+        stat = file.stat()
+        if index_file.exists():
+            with np.load(index_file, allow_pickle=False) as index:
+                if index["size"] == stat.st_size and index["mtime_ns"] == stat.st_mtime_ns:
+                    return (index["starts"], index["ends"], _json_column_values(index["header"]))
+        # Latin-1 maps each byte to one character, so the positions are byte offsets.
+        # This is safe because UTF-8 multi-byte characters never contain ASCII bytes.
+        header: Dict[str, Any] = {}
+        header_spans: Dict[str, Tuple[int, int]] = {}
+        with file.open("r", encoding="latin-1", newline="") as input:
+            spans = list(cls._scan_json_traces(_JsonStreamReader(input), header, spans=True,
+                                               header_spans=header_spans))
+        # but the header values must be decoded again from their UTF-8 bytes.
+        with file.open("rb") as input:
+            for (key, (start, end)) in header_spans.items():
+                input.seek(start)
+                header[key] = json.loads(input.read(end - start).decode("utf-8"))
+        starts = np.array([start for (start, end) in spans], dtype=np.int64)
+        ends = np.array([end for (start, end) in spans], dtype=np.int64)
+        try:
+            _save_json_index(file, starts, ends, header)
+        except OSError:
+            pass  # the index is just a cache, so it does not matter if we cannot save it.
+        return (starts, ends, header)
+
+    @classmethod
+    def _pre_traceset_meta_data(cls, file: Path) -> MetaData:
+        """Default meta-data for a version 0.1 file, which was just a list of traces."""
+        mtime = datetime.datetime.fromtimestamp(file.stat().st_mtime).isoformat()
+        return {"date": mtime, "dataset": file.name, "source": "Upgraded from version 0.1"}
+
+    @classmethod
+    def _upgrade_header(cls, traceset: 'TraceSet', file: Path, header: Dict[str, Any]) -> None:
+        """Sets up the meta-data of a streamed TraceSet, once all its traces have been read."""
+        version = header["version"]
+        if version == "0.1":
+            traceset.meta_data = cls._pre_traceset_meta_data(file)
+        else:
+            traceset.meta_data = header["meta_data"].copy()
+            cls._upgrade_meta_data(traceset, version, header)
+
     @classmethod
     def upgrade_json_data(cls, json_data: Dict) -> 'TraceSet':
         version = json_data["version"]
-        if version.startswith("0.1."):
-            # This JSON file is compatible with our code.
-            # First, convert json_data dicts to Trace and TraceSet objects.
-            traceset = TraceSet([], json_data["meta_data"])
-            for tr_data in json_data["traces"]:
-                traceset.append(cls._create_trace_object(version, tr_data))
-            # Next, see if any more little updates are needed.
-            if version in ["0.1.2", "0.1.3", TRACE_SET_VERSION]:
-                pass  # nothing more to do.
-            elif version == "0.1.1":
-                # Move given_event_chars into meta_data["action_chars"]
-                # Note: traceset["version"] has already been updated to the latest.
-                traceset.meta_data["actions_chars"] = json_data["given_event_chars"]
+        cls._check_json_version(version)
+        # This JSON file is compatible with our code.
+        # First, convert json_data dicts to Trace and TraceSet objects.
+        traceset = TraceSet([], json_data["meta_data"])
+        for tr_data in json_data["traces"]:
+            traceset.append(cls._create_trace_object(version, tr_data))
+        cls._upgrade_meta_data(traceset, version, json_data)
+        return traceset
+
+    @classmethod
+    def _check_json_version(cls, version: str) -> None:
+        """Raises an exception if JSON traces of this version cannot be read."""
+        if not version.startswith("0.1."):
+            raise Exception(f"upgrade of TraceSet v{version} to v{TRACE_SET_VERSION} "
+                            "not supported.")
+
+    @classmethod
+    def _upgrade_meta_data(cls, traceset: 'TraceSet', version: str,
+                           json_data: Dict[str, Any]) -> None:
+        """Applies any little updates that are needed after loading an older 0.1.x version."""
+        if version in ["0.1.2", "0.1.3", TRACE_SET_VERSION]:
+            pass  # nothing more to do.
+        elif version == "0.1.1":
+            # Move given_event_chars into meta_data["action_chars"]
+            # Note: traceset["version"] has already been updated to the latest.
+            traceset.meta_data["actions_chars"] = json_data["given_event_chars"]
+        else:
+            # The JSON must be from a newer 0.1.x version, so give a warning.
+            print(f"WARNING: reading {version} TraceSet using {TRACE_SET_VERSION} code.")
+            print(f"         Some data may be lost.  Please upgrade this program.")
+
+    def save_to_columnar(self, file: Path) -> None:
+        """Save this TraceSet into a compact, compressed, column-oriented file.
+
+        The file is a NumPy ``.npz`` archive.  Each event attribute is stored as a
+        separate column, with one row per event (in trace order):
+
+            * "trace" and "event": the trace number and the position within that trace.
+            * "action": integer codes into the action names (in the header).
+            * "status": the status of each event (see Event.status).
+            * "error": integer codes into the distinct error messages (in the header),
+              where a missing error message is recorded as "".
+            * "inputs", "outputs", "meta_data": each of these column groups is a JSON
+              array of the input/output/meta-data dictionaries of all the events.
+
+        The meta-data of each trace, and of the whole TraceSet, is stored too, so the file
+        can be loaded by ``load_from_columnar`` without losing any data.
+
+        Args:
+            file: the file to write.  The suffix ".npz" is recommended.
+        """
+        if isinstance(file, str):
+            print(f"WARNING: converting {file} to Path.  Please learn to speak pathlib.")
+            file = Path(file)
+        lengths = np.array([len(tr) for tr in self.traces], dtype=np.int64)
+        starts = np.cumsum(lengths) - lengths
+        events = [ev for tr in self.traces for ev in tr]
+        action_codes: Dict[str, int] = {}
+        error_codes: Dict[Any, int] = {}
+        actions = [action_codes.setdefault(ev.action, len(action_codes)) for ev in events]
+        errors = [error_codes.setdefault(_error_string(ev), len(error_codes)) for ev in events]
+        header = {
+            "__class__": "TraceSet",
+            "version": TRACE_SET_VERSION,
+            "meta_data": self.meta_data,
+            "actions": list(action_codes.keys()),
+            "errors": list(error_codes.keys()),
+            }
+        columns = {
+            "header": _json_column(header),
+            "trace": np.repeat(np.arange(len(lengths), dtype=np.int32), lengths),
+            "event": (np.arange(len(events)) - np.repeat(starts, lengths)).astype(np.int32),
+            "action": np.array(actions, dtype=np.int32),
+            "status": np.array([ev.status for ev in events], dtype=np.int64),
+            "error": np.array(errors, dtype=np.int32),
+            "inputs": _json_column([ev._inputs for ev in events]),
+            "outputs": _json_column([ev._outputs for ev in events]),
+            "meta_data": _json_column([ev._meta_data for ev in events]),
+            "trace_meta_data": _json_column([tr.meta_data for tr in self.traces]),
+            }
+        with file.open("wb") as output:
+            np.savez_compressed(output, **columns)
+
+    @classmethod
+    def load_from_columnar(cls, file: Path, columns: List[str] = None) -> 'TraceSet':
+        """Load a TraceSet that was saved by ``save_to_columnar``.
+
+        Args:
+            file: the file to read.
+            columns: optional list of the event columns to load, from "status", "error",
+                "inputs", "outputs" and "meta_data".  The action names are always loaded.
+                The default is to load all columns, which restores the whole TraceSet.
+                Loading fewer columns is faster.  For example, ["status"] is enough for
+                clustering by action and status.  If "outputs" is not loaded, each event
+                will just have a "Status" output (and an "Error" output if that is loaded
+                and is not empty).
+
+        Returns:
+            a new TraceSet.
+        """
+        if isinstance(file, str):
+            print(f"WARNING: converting {file} to Path.  Please learn to speak pathlib.")
+            file = Path(file)
+        all_columns = ["status", "error", "inputs", "outputs", "meta_data"]
+        if columns is None:
+            columns = all_columns
+        for col in columns:
+            if col not in all_columns + ["action"]:
+                raise Exception(f"unknown column {col}, expected one of {all_columns}.")
+        with np.load(file, allow_pickle=False) as data:
+            header = _json_column_values(data["header"])
+            if header.get("__class__", None) != "TraceSet":
+                raise Exception("unknown columnar file format: " + str(header)[0:60])
+            version = header["version"]
+            cls._check_json_version(version)
+            trace_meta = _json_column_values(data["trace_meta_data"])
+            lengths = np.bincount(data["trace"], minlength=len(trace_meta))
+            actions = [header["actions"][a] for a in data["action"]]
+            size = len(actions)
+
+            def load_dicts(name: str) -> List[Dict[str, Any]]:
+                if name in columns:
+                    return _json_column_values(data[name])
+                return [{} for i in range(size)]
+
+            inputs = load_dicts("inputs")
+            metas = load_dicts("meta_data")
+            if "outputs" in columns:
+                outputs = _json_column_values(data["outputs"])
             else:
-                # The JSON must be from a newer 0.1.x version, so give a warning.
-                print(f"WARNING: reading {version} TraceSet using {TRACE_SET_VERSION} code.")
-                print(f"         Some data may be lost.  Please upgrade this program.")
-            return traceset
-        raise Exception(f"upgrade of TraceSet v{version} to v{TRACE_SET_VERSION} not supported.")
+                statuses = data["status"].tolist() if "status" in columns else [0] * size
+                errors = data["error"].tolist() if "error" in columns else None
+                outputs = []
+                for i in range(size):
+                    out = {"Status": statuses[i]}
+                    if errors is not None and header["errors"][errors[i]]:
+                        out["Error"] = header["errors"][errors[i]]
+                    outputs.append(out)
+        traceset = cls([], header["meta_data"])
+        pos = 0
+        for (length, meta) in zip(lengths, trace_meta):
+            end = pos + length
+            events = [Event(actions[i], inputs[i], outputs[i], metas[i]) for i in range(pos, end)]
+            traceset.append(Trace(events, meta_data=meta))
+            pos = end
+        cls._upgrade_meta_data(traceset, version, header)
+        return traceset
 
     @classmethod
     def _create_trace_object(cls, version: str, tr_data: Dict[str, Any]) -> Trace:
@@ -434,7 +1352,9 @@ class TraceSet:
             props = ev["meta_data"]
         return Event(action, inputs, outputs, props)
 
-    def to_pandas(self) -> pd.DataFrame:
+    def to_pandas(self, inputs: Union[bool, List[str]] = True,
+                  outputs: Union[bool, List[str]] = False,
+                  meta_keys: List[str] = None) -> pd.DataFrame:
         """Converts all the traces into a single Pandas DataFrame (one event/row).
 
         The first three columns are 'Trace' and 'Event' which give the number of the
@@ -442,52 +1362,99 @@ class TraceSet:
         the name of the action of the event.
         Each named input value is recorded in a separate column.
         For outputs, by default there are just 'Status' (int) and 'Error' (str) columns.
+        See traces_to_pandas for the options to choose the input, output and meta-data columns.
+        """
+        return _events_to_pandas(self.traces, self.get_columns(), inputs, outputs, meta_keys)
+
+    def iter_pandas(self, chunk_traces: int = 1000, inputs: Union[bool, List[str]] = True,
+                    outputs: Union[bool, List[str]] = False,
+                    meta_keys: List[str] = None) -> Iterator[pd.DataFrame]:
+        """Like to_pandas, but yields a series of smaller tables for blocks of traces.
+
+        Each table contains the events of chunk_traces consecutive traces (fewer for the
+        last table), and the 'Trace' column still numbers the traces from the start of
+        this set.  All the tables have the same columns, and the same types for the
+        'Trace', 'Event', 'Action', 'Status' and 'Error' columns, so they can be
+        analysed one at a time, or concatenated with pd.concat.
         """
-        return traces_to_pandas(self.traces)
+        return _iter_pandas(lambda: iter(self.traces), chunk_traces, inputs, outputs, meta_keys)
 
-    def arff_type(self, pandas_type: str) -> Union[str, List[str]]:
-        """Maps each Pandas data type to the closest ARFF type."""
-        if pd.api.types.is_integer_dtype(pandas_type):
+    def arff_type(self, pandas_type: str, values: Optional[Set[str]] = None,
+                  max_nominal: int = 50) -> Union[str, List[str]]:
+        """Maps each Pandas data type to the closest ARFF type.
+
+        Args:
+            pandas_type: the type of a column.
+            values: the distinct values (as strings) of a column, if known.
+            max_nominal: columns of strings (or categories) with at most this many
+                distinct values are NOMINAL (a list of the values) rather than STRING.
+        """
+        if isinstance(pandas_type, pd.CategoricalDtype):
+            values = set(str(value) for value in pandas_type.categories)
+        elif pd.api.types.is_integer_dtype(pandas_type):
             return "INTEGER"
-        if pd.api.types.is_float_dtype(pandas_type):
+        elif pd.api.types.is_float_dtype(pandas_type):
             return "REAL"
-        if pd.api.types.is_bool_dtype(pandas_type):
+        elif pd.api.types.is_bool_dtype(pandas_type):
             return ["False", "True"]
+        if values and len(values) <= max_nominal:
+            return sorted(values)
         return "STRING"
-        # TODO: check column to see if NOMINAL is better?
-        # raise Exception(f"do not know how to translate Pandas type {pandas_type} to ARFF.")
 
-    def save_to_arff(self, file: Path, name=None) -> None:
+    def save_to_arff(self, file: Path, name=None, max_nominal: int = 50,
+                     inputs: Union[bool, List[str]] = True, outputs: Union[bool, List[str]] = False,
+                     meta_keys: List[str] = None) -> None:
         """Save all the events in all traces into an ARFF file for machine learning.
 
+        The file has the same columns as to_pandas, but it is written one trace at a time,
+        after one pass over all the events to find the type of each column.
+        Columns of strings with few distinct values are saved as NOMINAL attributes.
+
         Args:
             filename: the name of the file to save into.  Should end with '.arff'.
+                It is compressed if it ends with one of the COMPRESSION_SUFFIXES.
             name: optional relation name to identify this data inside the ARFF file.
                 The default is the base name of 'file'.
+            max_nominal: columns with at most this many distinct strings are NOMINAL.
+            inputs, outputs, meta_keys: choose the columns, as for to_pandas.
         """
         if isinstance(file, str):
             print(f"WARNING: converting {file} to Path.  Please learn to speak pathlib.")
             file = Path(file)
         if name is None:
             name = file.stem
-        data = self.to_pandas()
-        attributes = [(n, self.arff_type(t)) for (n, t) in zip(data.columns, data.dtypes)]
-        try:
-            import arff
-        except ImportError:
-            print("Please install ARFF support before using save_to_arff.")
-            print("It is a pip only package:  pip install liac-arff")
-            return
-        with file.open("w") as output:
-            contents = {
-                "relation": safe_name(name),
-                "attributes": attributes,
-                "data": data.values,  # [[tr] for tr in trace_summaries],
-                "description": "Events from " + name
-                }
-            arff.dump(contents, output)
-
-    def with_traces_split(self, start_action: str = None, input_name: str = None, delay: datetime.timedelta = None) -> 'TraceSet':
+        scan = _EventScan(iter(self.traces), inputs, outputs, meta_keys, max_distinct=max_nominal)
+        distinct = {col: info.distinct for (col, info) in scan.value_columns()}
+        attributes = [(col, self.arff_type(dtype, distinct.get(col), max_nominal))
+                      for (col, dtype) in scan.dtypes().items()]
+        numeric = [attr_type in ["INTEGER", "REAL"] for (col, attr_type) in attributes[5:]]
+        (inputs, outputs, meta_keys) = scan.keys()
+        sources = _value_sources(inputs, outputs, meta_keys)
+        with io.TextIOWrapper(_open_trace_file(file, "wb"), encoding="utf-8",
+                              newline="\n") as output:
+            output.write(f"% Events from {name}\n")
+            output.write(f"@RELATION {_arff_quote(safe_name(name))}\n\n")
+            for (col, attr_type) in attributes:
+                if isinstance(attr_type, list):
+                    attr_type = "{" + ", ".join(_arff_quote(value) for value in attr_type) + "}"
+                output.write(f"@ATTRIBUTE {_arff_quote(col)} {attr_type}\n")
+            output.write("\n@DATA\n")
+            for (tr_num, tr) in enumerate(self.traces):
+                rows = []
+                for (ev_num, ev) in enumerate(tr):
+                    row = [str(tr_num), str(ev_num), _arff_quote(ev.action), str(ev.status),
+                           _arff_quote(_error_string(ev))]
+                    col = 0
+                    for (get_dict, prefix, keys, skip) in sources:
+                        values = get_dict(ev)
+                        for key in keys:
+                            row.append(_arff_value(values.get(key), numeric[col]))
+                            col += 1
+                    rows.append(",".join(row) + "\n")
+                output.write("".join(rows))
+
+    def with_traces_split(self, start_action: str = None, input_name: str = None,
+                          delay: datetime.timedelta = None, view: bool = False) -> 'TraceSet':
         """Returns a new TraceSet with each trace in this set split into shorter traces.
 
         It accepts several split criteria, and will start a new trace whenever any
@@ -501,6 +1468,8 @@ class TraceSet:
             delay: cut the trace if two events are separated by a duration longer
                 than delay. This suppose that each trace is ordered (which is
                 the case most of the time when you work with logs).
+            view: True means that the new traces are TraceViews, which share the events
+                of the original traces without copying them.  This saves memory.
 
         Returns:
             a new TraceSet, usually with more traces and shorter traces.
@@ -510,104 +1479,121 @@ class TraceSet:
         traces2 = TraceSet([], self.meta_data)
         # TODO: update meta data with split info?
         for old in self.traces:
-            curr_trace = Trace([])
-            traces2.append(curr_trace)
-            prev_input = None
-            prev_timestamp = None
-            for event in old:
-                input_value = event.inputs.get(input_name, None)
-                input_changed = input_value != prev_input and input_value is not None
-                delay_elapsed = False
-                if delay is not None:
-                    timestamp = event.meta_data.get('timestamp')
-                    if timestamp is not None:
-                        # the parsing of date should be done with
-                        # dateutil.parser but it is under BSD licsence and
-                        # compatibility should be checked. The method
-                        # fromisoformat() is discouraged here :
-                        # https://docs.python.org/dev/library/datetime.html#datetime.datetime.fromisoformat
-                        timestamp = datetime.datetime.fromisoformat(timestamp)
-                        if prev_timestamp is not None and timestamp-prev_timestamp > delay:
-                            delay_elapsed = True
-                    prev_timestamp = timestamp
-    
-                if (event.action == start_action or input_changed or delay_elapsed) and len(curr_trace) > 0:
-                    curr_trace = Trace([])
-                    traces2.append(curr_trace)
-                curr_trace.append(event)
-                if input_value is not None:
-                    prev_input = input_value
-                # NOTE: we could check end_action here.
+            for tr in _split_trace(old, start_action, input_name, delay, view):
+                traces2.append(tr)
         return traces2
 
-    def with_traces_grouped_by(self, name: str, property: bool = False) -> 'TraceSet':
+    def with_traces_grouped_by(self, name: str = None, property: bool = False,
+                               view: bool = False, key: Callable[[Event], Any] = None,
+                               across_traces: bool = False, sort_by: str = None,
+                               workers: Optional[int] = None) -> 'TraceSet':
         """Returns a new TraceSet with each trace grouped into shorter traces.
 
         It generates a new trace for each distinct value of the given input or property name.
+        The new traces are in order of the first appearance of each value.
 
         Args:
             name: the name of an input.  A new trace is started for each value of this input
                 (or property).  Note that events with this value missing are totally discarded.
             property: True means group by the property called name, rather than an input.
+            view: True means that the new traces are TraceViews, which share the events
+                of the original traces without copying them.  This saves memory.
+            key: optional function that returns the group value of each event, instead of
+                using name.  Events where it returns None are discarded.
+            across_traces: True means group all the events of all the traces together,
+                in one pass, rather than grouping the events within each trace separately.
+            sort_by: optional name of a meta-data field, such as "timestamp".  The events
+                in each group are sorted by this field (stably, with missing values last).
+                Timestamps are compared as times (see Trace.get_timestamps).
+            workers: the number of processes to use when grouping across traces (the
+                default is to group them all in this process).  The traces are divided
+                between the processes, and then the groups are merged.  This requires key
+                to be picklable, and is worthwhile only when key is expensive.
 
         Returns:
             a new TraceSet, usually with more traces and shorter traces.
         """
+        key = _group_key(name, property, key)
         # TODO: update meta data with split info?
         traces2 = TraceSet([], self.meta_data)
-        for old in self.traces:
-            groups = defaultdict(list)  # for each value this stores a list of Events.
-            for event in old:
-                if property:
-                    value = event.meta_data.get(name, None)
-                else:
-                    value = event.inputs.get(name, None)
-                if value is not None:
-                    groups[value].append(event)
-            for event_list in groups.values():
-                traces2.append(Trace(event_list))
+        if across_traces:
+            if len(self.traces) == 1:
+                source = self.traces[0]
+            else:
+                source = Trace([ev for tr in self.traces for ev in tr])
+            groups = self._group_across_traces(key, workers)
+            for tr in _grouped_traces(source, groups, self.traces, sort_by, view):
+                traces2.append(tr)
+        else:
+            for old in self.traces:
+                for tr in _group_trace(old, key, sort_by, view):
+                    traces2.append(tr)
         return traces2
 
+    def _group_across_traces(self, key: Callable[[Event], Any],
+                             workers: Optional[int]) -> Dict[Any, List[int]]:
+        """Groups the positions of all events (in all the traces) by their key value.
+
+        With several workers, each process groups a contiguous chunk of the traces.
+        The results are merged in order, so the groups are still in order of first appearance.
+        Each worker is sent just the lists of events of its chunk, because pickling a Trace
+        would also pickle its parent TraceSet (that is, all the traces).
+        """
+        if workers is None or workers <= 1 or len(self.traces) <= 1:
+            return _group_positions(self.traces, key)
+        num_chunks = min(workers, len(self.traces))
+        bounds = [len(self.traces) * i // num_chunks for i in range(num_chunks + 1)]
+        chunks = [[list(tr) for tr in self.traces[start:end]]
+                  for (start, end) in zip(bounds, bounds[1:])]
+        groups: Dict[Any, List[int]] = {}
+        offset = 0
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(_group_positions, chunks, [key] * len(chunks))
+            for (chunk, chunk_groups) in zip(chunks, results):
+                for (value, positions) in chunk_groups.items():
+                    groups.setdefault(value, []).extend(pos + offset for pos in positions)
+                offset += sum(len(events) for events in chunk)
+        return groups
+
     def with_events_filtered(
             self,
             name: str,
             value,
-            removeEmptyTrace: bool = True) -> 'TraceSet':
+            removeEmptyTrace: bool = True,
+            view: bool = False) -> 'TraceSet':
         """Filter the events to keep only those with a specific value in the meta data.
 
         Args:
             name: the name of the meta data
             value: the expected value for the meta data. Events with another value are discarded.
             removeEmptyTrace: removes traces in which all events were removed.
+            view: True means that the new traces are TraceViews, which share the events
+                of the original traces without copying them.  This saves memory.
 
         Returns:
             A new TraceSet in which all events have the meta data ``name`` with value ``value``.
         """
         # TODO: update meta data with filter info ?
         newTraces = TraceSet([], self.meta_data)
+        predicate = functools.partial(_meta_equals, name, value)
         for trace in self:
-            newTrace = Trace([], trace.meta_data)
-            for event in trace:
-                if event.meta_data.get(name) == value:
-                    newTrace.append(event)
-            if not removeEmptyTrace or len(newTrace) > 0 or len(trace) == 0:
+            for newTrace in _filter_trace(trace, predicate, removeEmptyTrace, view):
                 newTraces.append(newTrace)
         return newTraces
 
     def get_all_actions(self):
         """Returns a sorted list (with duplicates removed) of all the keys in data."""
-        actions = set()
-        for tr in self.traces:
-            for ev in tr.events:
-                actions.add(ev.action)
-        return sorted(list(actions))
+        return list(self.get_columns().actions)
 
     def get_trace_data(self, method: str = "action_counts",
-                       columns:List[str]=None) -> pd.DataFrame:
+                       columns:List[str]=None, sparse: bool = False,
+                       **kwargs) -> Union[pd.DataFrame, Tuple[Any, List[str]]]:
         """Returns a Pandas table of statistics/data about each trace.
 
-        This can gather data using any of the zero-parameter data-gathering methods
-        of the Trace class.  Any missing data values are replaced by zeroes.
+        This can gather data using any of the data-gathering methods of the Trace class,
+        such as action_counts, action_status_counts, action_ngram_counts (or just "ngrams")
+        and action_transition_counts (or just "transitions").
+        Any missing data values are replaced by zeroes.
 
         Note: you can add more data-gathering methods by defining a subclass of Trace
         and using that subclass when you create Trace objects.
@@ -619,68 +1605,230 @@ class TraceSet:
                 *bag-of-words* algorithm.
             columns: optional list of column names.  This can be used to reorder or remove
                 or add columns.  (Any added columns will be filled with zeroes).
+            sparse: True means return a pair (matrix, column_names) instead of a table,
+                where matrix is a scipy.sparse.csr_matrix.  This uses much less memory
+                when most of the values are zero, and create_clusters accepts it too.
+            kwargs: any parameters for the method, such as ``n=3`` or ``hash_size=1000``
+                for action_ngram_counts.
+
+        The result is cached until a trace or event is appended or set_event_chars is called,
+        so repeated calls with the same arguments are fast.  Each call returns a new copy.
 
         Returns:
             A table of data that can be used for clustering or machine learning.
             If columns is not specified, the columns of the table will be in alphabetical order.
             The i'th row of the table is the data for the i'th trace in this set.
         """
-        trace_data = [getattr(tr, method)() for tr in self.traces]
-        if columns is None:
-            # columns is the sorted list of the union of all keys in trace_data.
-            keys = set()
-            for d in trace_data:
-                keys.update(set(d.keys()))
-            columns = sorted(list(keys))
-        data = pd.DataFrame(trace_data, columns=columns)
-        data.fillna(value=0, inplace=True)
-        return data
-
-    def create_clusters(self, data: pd.DataFrame, algorithm=None,
-                        normalizer=None, fit: bool = True) -> int:
+        method = _TRACE_DATA_ALIASES.get(method, method)
+        self.get_columns()  # this discards the cached results if the traces have changed.
+        key = (method, None if columns is None else tuple(columns), sparse,
+               tuple(sorted(kwargs.items())))
+        try:
+            result = self._trace_data.get(key)
+        except TypeError:
+            # unhashable arguments, so just calculate the result.
+            return self._calculate_trace_data(method, columns, sparse, **kwargs)
+        if result is None:
+            result = self._calculate_trace_data(method, columns, sparse, **kwargs)
+            self._trace_data[key] = result
+        if sparse:
+            return (result[0].copy(), list(result[1]))
+        return result.copy()
+
+    def _calculate_trace_data(self, method: str, columns: Optional[List[str]], sparse: bool,
+                              **kwargs) -> Union[pd.DataFrame, Tuple[Any, List[str]]]:
+        """Calculates get_trace_data(...), without using the cache."""
+        if (method in _COLUMNAR_TRACE_DATA and len(self.traces) > 0
+                and all(getattr(type(tr), method) is getattr(Trace, method)
+                        for tr in self.traces)):
+            counts = self.get_columns()
+            if method == "action_counts":
+                matrix = counts.count_matrix(False, columns)
+            elif method == "action_status_counts":
+                matrix = counts.count_matrix(True, columns)
+            elif method == "action_ngram_counts":
+                matrix = counts.ngram_matrix(columns=columns, **kwargs)
+            else:
+                matrix = counts.ngram_matrix(2, pad=True, columns=columns, **kwargs)
+            return matrix if sparse else _matrix_to_table(*matrix)
+        trace_data = [getattr(tr, method)(**kwargs) for tr in self.traces]
+        if sparse:
+            return _trace_data_matrix(trace_data, columns)
+        return _trace_data_table(trace_data, columns)
+
+    def create_clusters(self, data: Union[pd.DataFrame, Tuple[Any, List[str]]], algorithm=None,
+                        normalizer=None, fit: bool = True, strategy: str = None,
+                        n_clusters: int = None, sample_size: int = None,
+                        batch_size: int = None, random_state: int = None) -> int:
         """Runs a clustering algorithm on the given data and remembers the clusters.
 
-        Note that clustering results are viewed as transient, so are currently not saved
-        into JSON files.  Clustering must be repeated after loading a TraceSet.
+        Note that clustering results are not saved into JSON files.  Use save_clusters()
+        and load_clusters() to save them into a separate file, rather than repeating
+        the clustering after loading a TraceSet.
+
+        For large sets of traces, use a scalable strategy (such as "minibatch_kmeans" or
+        "birch"), plus sample_size to fit on a sample of the traces and then predict the
+        clusters of all the traces, and/or batch_size to normalize and predict the data
+        in batches, so that no normalized copy of all the data is kept in memory.
 
         Args:
             data: a Pandas DataFrame, typically from get_trace_data(), with the i'th row
                 of the DataFrame being for the i'th trace in this set of traces.
-            algorithm: a clustering algorithm (default is MeanShift()).
-            normalizer: a normalization algorithm (default is MinMaxScaler).
+                This may also be a scipy.sparse matrix, or the (matrix, column_names)
+                pair returned by get_trace_data(sparse=True).
+            algorithm: a clustering algorithm (default is MeanShift()).  Sparse data is
+                passed directly to algorithms that accept sparse input (such as KMeans,
+                MiniBatchKMeans, Birch or DBSCAN), and is converted to a dense array
+                for the others.
+            normalizer: a normalization algorithm (default is MinMaxScaler, or
+                MaxAbsScaler for sparse data, since it keeps the zeroes unchanged).
             fit: True means fit the data into clusters, False means just predict clusters
                 assuming that the algorithm and normalizer have already been trained.
+            strategy: instead of algorithm, the name of one of the CLUSTER_STRATEGIES:
+                "meanshift" (the default algorithm), "minibatch_kmeans", "birch" or
+                "hdbscan" (which needs scikit-learn 1.3 or later).
+            n_clusters: the number of clusters for the "minibatch_kmeans" and "birch"
+                strategies (default 8 and 3 respectively, as in scikit-learn).
+            sample_size: fit the normalizer and the algorithm on a sample of about this many
+                traces, stratified by the largest feature of each trace, then predict the
+                cluster of every trace.  Algorithms without a predict method (such as
+                HDBSCAN) give each trace the cluster of its nearest sampled trace.
+            batch_size: normalize and predict this many traces at a time.  When there is
+                no sample, algorithms with a partial_fit method (such as MiniBatchKMeans
+                and Birch) are fitted one batch at a time too.  Afterwards, just the
+                normalized data of the sample (or of about batch_size traces, stratified
+                by cluster) is kept for visualize_clusters.
+            random_state: optional seed for the sampling and the strategy algorithm.
 
         Returns:
             The number of clusters generated.
         """
+        if strategy is not None:
+            if algorithm is not None:
+                raise Exception("create_clusters needs an algorithm or a strategy, not both.")
+            algorithm = _cluster_algorithm(strategy, n_clusters, random_state)
         if algorithm is None:
             if not fit:
                 raise Exception("You must supply pre-fitted algorithm when fit=False")
             algorithm = sklearn.cluster.MeanShift()
+        columns = list(data.columns) if isinstance(data, pd.DataFrame) else None
+        if isinstance(data, tuple):
+            columns = list(data[1])
+            data = data[0]  # from get_trace_data(sparse=True)
+        sparse = scipy.sparse.issparse(data)
         if normalizer is None:
             if not fit:
                 raise Exception("You must supply pre-fitted normalizer when fit=False")
-            normalizer = sklearn.preprocessing.MinMaxScaler()
+            if sparse:
+                normalizer = sklearn.preprocessing.MaxAbsScaler()
+            else:
+                normalizer = sklearn.preprocessing.MinMaxScaler()
             # normalizer = sklearn.preprocessing.RobustScaler()
 
+        self._cluster_model = (normalizer, algorithm, columns)
         alg_name = str(algorithm).split("(")[0]
-        self.message(f"running {alg_name} on {len(data)} traces.")
+        self.message(f"running {alg_name} on {data.shape[0]} traces.")
+        if sample_size is not None or batch_size is not None:
+            return self._set_clusters(self._cluster_in_batches(
+                data, algorithm, normalizer, fit, sample_size, batch_size, random_state))
+        self._cluster_rows = None
         if fit:
             normalizer.fit(data)
-        self._cluster_data = pd.DataFrame(normalizer.transform(data), columns=data.columns)
+        self._cluster_data = _normalized_rows(normalizer, data)
+        if fit:
+            _fit_maybe_sparse(algorithm.fit, self._cluster_data)
+            return self._set_clusters(algorithm.labels_)
+        print(" pre predict len=", len(algorithm.labels_))
+        clusters = _fit_maybe_sparse(algorithm.predict, self._cluster_data)
+        print("post predict len=", len(algorithm.labels_), len(clusters))
+        return self._set_clusters(clusters)
+
+    def _set_clusters(self, clusters: Any) -> int:
+        """Remembers the cluster of each trace, and indexes the traces in each cluster.
+
+        Returns:
+            The number of clusters.
+        """
+        self._clusters = clusters
+        self._cluster_embedding = None
+        labels = np.asarray(clusters, dtype=np.int64)
+        # shift the labels up by one, so that the 'noise' traces (-1) are indexed too.
+        counts = np.bincount(labels + 1, minlength=1)
+        order = np.argsort(labels, kind="stable")
+        self._cluster_index = (order, np.concatenate([[0], np.cumsum(counts)]))
+        return len(counts) - 1
+
+    def _cluster_in_batches(self, data: Any, algorithm: Any, normalizer: Any, fit: bool,
+                            sample_size: Optional[int], batch_size: Optional[int],
+                            random_state: Optional[int]) -> np.ndarray:
+        """Implements the sample_size and batch_size modes of create_clusters.
+
+        Returns:
+            The cluster number of each row of data.
+        """
+        num_rows = data.shape[0]
+        rand = np.random.default_rng(random_state)
+        batch = _CLUSTER_BATCH_SIZE if batch_size is None else batch_size
+        sample = None
+        if fit and sample_size is not None and sample_size < num_rows:
+            strata = np.concatenate([_row_argmax(_take_rows(data, rows))
+                                     for rows in _row_batches(num_rows, batch)])
+            sample = _stratified_sample(strata, sample_size, rand)
+        sample_data = None
         if fit:
-            algorithm.fit(self._cluster_data)
-            self._clusters = algorithm.labels_
+            incremental = batch_size is not None and sample is None
+            if incremental and hasattr(normalizer, "partial_fit"):
+                for rows in _row_batches(num_rows, batch):
+                    normalizer.partial_fit(_take_rows(data, rows))
+            else:
+                normalizer.fit(data if sample is None else _take_rows(data, sample))
+            if incremental and hasattr(algorithm, "partial_fit"):
+                for rows in _row_batches(num_rows, batch):
+                    batch_data = _normalized_rows(normalizer, _take_rows(data, rows))
+                    _fit_maybe_sparse(algorithm.partial_fit, batch_data)
+            else:
+                sample_data = _normalized_rows(normalizer, data if sample is None
+                                               else _take_rows(data, sample))
+                _fit_maybe_sparse(algorithm.fit, sample_data)
+        if hasattr(algorithm, "predict"):
+            predict = algorithm.predict
+        elif sample_data is not None:
+            # give each row the cluster of its nearest neighbour in the fitted rows.
+            neighbours = sklearn.neighbors.KNeighborsClassifier(n_neighbors=1)
+            predict = _fit_maybe_sparse(lambda x: neighbours.fit(x, algorithm.labels_),
+                                        sample_data).predict
+        else:
+            raise Exception(f"{type(algorithm).__name__} cannot predict clusters.")
+        clusters = np.concatenate([
+            _fit_maybe_sparse(predict, _normalized_rows(normalizer, _take_rows(data, rows)))
+            for rows in _row_batches(num_rows, batch)])
+        # keep a bounded amount of normalized data for visualize_clusters.
+        if batch_size is None:
+            self._cluster_rows = None
+            self._cluster_data = _normalized_rows(normalizer, data)
         else:
-            print(" pre predict len=", len(algorithm.labels_))
-            self._clusters = algorithm.predict(self._cluster_data)
-            print("post predict len=", len(algorithm.labels_), len(self._clusters))
-        return max(self._clusters) + 1
+            if sample is None:
+                sample = _stratified_sample(clusters, batch, rand)
+            self._cluster_rows = sample
+            self._cluster_data = _normalized_rows(normalizer, _take_rows(data, sample))
+        return clusters
 
     def is_clustered(self) -> bool:
         return self._clusters is not None
 
+    def get_cluster_model(self) -> Tuple[Any, Any, Optional[List[str]]]:
+        """Get the (normalizer, algorithm, columns) that were used to create the clusters.
+
+        The columns are the feature names of the clustered data (None if it had no names).
+        The normalizer and algorithm are fitted, so they can be passed to
+        create_clusters(..., fit=False) to predict the clusters of other traces.
+
+        Precondition: self.is_clustered()
+        """
+        if self._cluster_model is None:
+            raise Exception("You must call create_clusters() before get_cluster_model()")
+        return self._cluster_model
+
     def get_clusters(self) -> List[int]:
         """Get the list of cluster numbers for each trace.
 
@@ -691,9 +1839,15 @@ class TraceSet:
     def visualize_clusters(self, algorithm=None, fit: bool = True,
                            xlim=None, ylim=None, cmap=None,
                            markers=None, markersize=None,
-                           filename:str = None, block:bool=True):
+                           filename:str = None, block:bool=True,
+                           sample_size: int = None, pca_components: int = None,
+                           random_state: int = None):
         """Visualize the clusters from create_clusters().
 
+        The 2D positions of the traces are cached, so calling this again with the same
+        algorithm, fit, sample_size, pca_components and random_state arguments just
+        redraws the graph (for example, with different xlim, ylim, cmap or markers).
+
         Args:
             algorithm: the visualization algorithm to map data into 2D (default TSNE).
             fit: True means fit the data, False means algorithm is pre-trained, so use it
@@ -725,25 +1879,22 @@ class TraceSet:
             filename (str): optional file name to save image into, as well as displaying it.
             block (bool): True (the default) means wait for user to close figure before
                 returning.  False means non-blocking.
+            sample_size (int): optional number of traces to show, for large sets of traces.
+                About this many traces are chosen randomly, in proportion to the size of
+                each cluster, but with at least one trace from every cluster.
+            pca_components (int): optional number of dimensions to reduce the data to
+                (using PCA, or TruncatedSVD for sparse data) before running the
+                visualization algorithm.  For example, 50 makes TSNE much faster when
+                there are many features.  This requires fit=True.
+            random_state (int): optional seed for the sampling, PCA and the default TSNE.
 
             Limitations: if you call this multiple times with different numbers of clusters,
                 the color map will not be exactly the same.
         """
-        data = self._cluster_data
-        if data is None or self._clusters is None:
-            raise Exception("You must call create_clusters() before visualizing them!")
+        (rows, tsne_obj) = self._embed_clusters(algorithm, fit, sample_size, pca_components,
+                                                random_state)
         num_clusters = max(self._clusters) + 1
-        if algorithm is None:
-            if not fit:
-                raise Exception("You must supply pre-fitted algorithm when fit=False")
-            algorithm = TSNE()
-        alg_name = str(algorithm).split("(")[0]
-        self.message(f"running {alg_name} on {len(data)} traces.")
-        if fit:
-            tsne_obj = algorithm.fit_transform(data)
-        else:
-            tsne_obj = algorithm.transform(data)
-        # print(tsne_obj[0:5])
+        clusters = np.asarray(self._clusters)[rows]
 
         # All the following complex stuff is for adding a 'show label on mouse over' feature
         # to the visualisation scatter graph.
@@ -760,14 +1911,14 @@ class TraceSet:
         if cmap is None:
             # Choose a default colormap.  See bottom of the matplotlib page:
             #   https://matplotlib.org/3.1.0/tutorials/colors/colormaps.html
-            cmap = pltcm.get_cmap('brg')  # sequential map with nice b&w printing.
+            cmap = plt.get_cmap('brg')  # sequential map with nice b&w printing.
         elif isinstance(cmap, str):
-            cmap = pltcm.get_cmap(cmap)  # it is the name of a matplotlib color map
+            cmap = plt.get_cmap(cmap)  # it is the name of a matplotlib color map
         if markers is None:
             markers = "o"
         if isinstance(markers, str) and len(markers) > 1:
             # loop through the marker styles
-            clusters = np.ma.array(self._clusters)
+            clusters = np.ma.array(clusters)
             markchars = markers + "o" * num_clusters
             for curr in range(max(num_clusters, len(markers))):
                 #prepare for masking arrays - 'conventional' arrays won't do it
@@ -784,12 +1935,15 @@ class TraceSet:
             leg = ax.legend(loc='best') #, ncol=2, mode="expand", shadow=True, fancybox=True)
             leg.get_frame().set_alpha(0.5)
         else:
-            sc = plt.scatter(tsne_obj[:, 0], tsne_obj[:, 1], c=self._clusters,
+            sc = plt.scatter(tsne_obj[:, 0], tsne_obj[:, 1], c=clusters,
                              cmap=cmap, marker=markers)
 
         if filename:
             plt.savefig(filename)
-        names = [str(tr) for tr in self.traces]  # these are in same order as tsne_df rows.
+        # the hover labels are rendered only when needed.
+        columns = self.get_columns()
+        to_char = self.get_event_chars()
+        finder = _PointFinder(tsne_obj)
 
         annot = ax.annotate("",
                             xy=(0, 0),
@@ -801,11 +1955,10 @@ class TraceSet:
         annot.set_visible(False)
 
         def update_annot(ind):
-            pos = sc.get_offsets()[ind["ind"][0]]
+            pos = tsne_obj[ind["ind"][0]]
             annot.xy = pos
-            # text = "{}, {}".format(" ".join(list(map(str, ind["ind"]))),
-            #                        " ".join([str(names[n]) for n in ind["ind"]]))
-            anns = [f"{n} ({self._clusters[n]}): {str(names[n])}" for n in ind["ind"]]
+            anns = [f"{rows[n]} ({clusters[n]}): {columns.trace_to_string(rows[n], to_char)}"
+                    for n in ind["ind"]]
             text = "\n".join(anns)
             annot.set_text(text)
             # annot.get_bbox_patch().set_facecolor(cmap(norm(c[ind["ind"][0]])))
@@ -814,9 +1967,9 @@ class TraceSet:
         def hover(event):
             vis = annot.get_visible()
             if event.inaxes == ax:
-                cont, ind = sc.contains(event)
-                if cont:
-                    update_annot(ind)
+                near = finder.find(ax.transData.get_matrix(), event.xdata, event.ydata)
+                if near:
+                    update_annot({"ind": near})
                     annot.set_visible(True)
                     fig.canvas.draw_idle()
                 else:
@@ -827,17 +1980,817 @@ class TraceSet:
         fig.canvas.mpl_connect("motion_notify_event", hover)
         plt.show(block=block)
 
-    def get_cluster(self, num: int) -> List[Trace]:
-        """Gets a list of all the Trace objects that are in the given cluster."""
-        if self._clusters is None:
-            raise Exception("You must call create_clusters() before get_cluster(_)")
-        if len(self._clusters) != len(self.traces):
-            raise Exception("Traces have changed, so you must call create_clusters() again.")
-        return [tr for (i, tr) in zip(self._clusters, self.traces) if i == num]
-
+    def _embed_clusters(self, algorithm: Any, fit: bool, sample_size: Optional[int],
+                        pca_components: Optional[int],
+                        random_state: Optional[int]) -> Tuple[np.ndarray, np.ndarray]:
+        """Maps the clustered data into 2D for visualize_clusters, caching the result.
 
-class TraceEncoder(json.JSONEncoder):
-    """Custom JSON encoder because objects from zeep could not be serialised.
+        Returns:
+            A pair (rows, points), where rows are the trace numbers of the chosen traces,
+            and the i'th row of points is the 2D position of trace rows[i].
+        """
+        data = self._cluster_data
+        if data is None or self._clusters is None:
+            raise Exception("You must call create_clusters() before visualizing them!")
+        if algorithm is None and not fit:
+            raise Exception("You must supply pre-fitted algorithm when fit=False")
+        if pca_components is not None and not fit:
+            raise Exception("pca_components cannot be used with fit=False")
+        key = (fit, sample_size, pca_components, random_state)
+        cached = self._cluster_embedding
+        if cached is not None and cached[0] == key and cached[1] is algorithm:
+            return (cached[2], cached[3])
+        # the trace number of each row of data (create_clusters may keep just some rows).
+        rows = np.arange(len(self._clusters)) if self._cluster_rows is None else self._cluster_rows
+        if sample_size is not None and sample_size < len(rows):
+            rand = np.random.default_rng(random_state)
+            sample = _stratified_sample(np.asarray(self._clusters)[rows], sample_size, rand)
+            (rows, data) = (rows[sample], _take_rows(data, sample))
+        if pca_components is not None and pca_components < data.shape[1]:
+            if scipy.sparse.issparse(data):
+                pca = sklearn.decomposition.TruncatedSVD(pca_components, random_state=random_state)
+            else:
+                pca = sklearn.decomposition.PCA(pca_components, random_state=random_state)
+            self.message(f"reducing {data.shape[1]} features to {pca_components}.")
+            data = pca.fit_transform(data)
+        vis = algorithm
+        if vis is None:
+            # TSNE cannot use its default PCA initialisation on sparse data.
+            if scipy.sparse.issparse(data):
+                vis = TSNE(init="random", random_state=random_state)
+            else:
+                vis = TSNE(random_state=random_state)
+        alg_name = str(vis).split("(")[0]
+        self.message(f"running {alg_name} on {data.shape[0]} traces.")
+        if fit:
+            points = _fit_maybe_sparse(vis.fit_transform, data)
+        else:
+            points = _fit_maybe_sparse(vis.transform, data)
+        points = np.asarray(points)
+        self._cluster_embedding = (key, algorithm, rows, points)
+        return (rows, points)
+
+    def get_cluster(self, num: int) -> List[Trace]:
+        """Gets a list of all the Trace objects that are in the given cluster."""
+        return [self.traces[i] for i in self.get_cluster_indices(num)]
+
+    def get_cluster_indices(self, num: int) -> np.ndarray:
+        """Gets the positions of all the traces that are in the given cluster.
+
+        This uses an index that is built by create_clusters, so it takes time proportional
+        to the size of the cluster, rather than to the number of traces.
+
+        Args:
+            num: a cluster number, or -1 for the traces that some algorithms (such as
+                DBSCAN and HDBSCAN) leave as 'noise' outside all the clusters.
+
+        Returns:
+            The positions of the traces, in increasing order.
+        """
+        (order, starts) = self._get_cluster_index()
+        if num < -1 or num + 2 >= len(starts):
+            return order[0:0]
+        return order[starts[num + 1]:starts[num + 2]]
+
+    def cluster_sizes(self) -> np.ndarray:
+        """Gets the number of traces in each cluster, from cluster 0 upwards.
+
+        Traces in the 'noise' cluster (-1) are not included.
+        """
+        (order, starts) = self._get_cluster_index()
+        return np.diff(starts)[1:]
+
+    def iter_clusters(self) -> Iterator[Tuple[int, List[Trace]]]:
+        """Iterates through the (cluster number, list of traces) of each cluster, in order."""
+        for num in range(len(self.cluster_sizes())):
+            yield (num, self.get_cluster(num))
+
+    def _get_cluster_index(self) -> Tuple[np.ndarray, np.ndarray]:
+        """The (order, starts) index of the traces in each cluster, built by _set_clusters.
+
+        The traces in cluster num are at positions order[starts[num + 1]:starts[num + 2]].
+        """
+        if self._clusters is None:
+            raise Exception("You must call create_clusters() before get_cluster(_)")
+        if self._cluster_index is None or len(self._clusters) != len(self.traces):
+            raise Exception("Traces have changed, so you must call create_clusters() again.")
+        return self._cluster_index
+
+    def save_clusters(self, file: Path) -> None:
+        """Save the clustering results into a sidecar file, such as 'traces.clusters.npz'.
+
+        This saves the cluster of each trace, the normalized data used by visualize_clusters,
+        the fitted normalizer and algorithm, and the column names of the clustered data.
+        It also records a hash of the contents of the traces, so that load_clusters can
+        check that it is being given the same traces.
+
+        Args:
+            file: the file to write, in NumPy npz format.
+        """
+        if isinstance(file, str):
+            print(f"WARNING: converting {file} to Path.  Please learn to speak pathlib.")
+            file = Path(file)
+        if self._clusters is None or self._cluster_model is None:
+            raise Exception("You must call create_clusters() before save_clusters(_)")
+        if len(self._clusters) != len(self.traces):
+            raise Exception("Traces have changed, so you must call create_clusters() again.")
+        (normalizer, algorithm, columns) = self._cluster_model
+        data = self._cluster_data
+        sparse = scipy.sparse.issparse(data)
+        header = {
+            "__class__": "Clusters",
+            "version": TRACE_SET_VERSION,
+            "traces_hash": _traces_hash(self.traces),
+            "num_traces": len(self.traces),
+            "columns": columns,
+            "sparse": sparse,
+            }
+        arrays = {
+            "header": _json_column(header),
+            "clusters": np.asarray(self._clusters, dtype=np.int64),
+            "model": np.frombuffer(pickle.dumps((normalizer, algorithm)), dtype=np.uint8),
+            }
+        if self._cluster_rows is not None:
+            arrays["rows"] = np.asarray(self._cluster_rows, dtype=np.int64)
+        if sparse:
+            data = scipy.sparse.csr_matrix(data)
+            arrays.update(data=data.data, indices=data.indices, indptr=data.indptr,
+                          shape=np.array(data.shape, dtype=np.int64))
+        else:
+            arrays["data"] = np.asarray(data)
+        with file.open("wb") as output:
+            np.savez_compressed(output, **arrays)
+
+    def load_clusters(self, file: Path) -> int:
+        """Load clustering results that were saved by save_clusters, without re-fitting.
+
+        Afterwards, get_clusters, get_cluster and visualize_clusters can be used as if
+        create_clusters had just been called.  Note that the fitted normalizer and algorithm
+        are stored using pickle, so you should only load cluster files that you trust.
+
+        Args:
+            file: a file written by save_clusters, for a TraceSet with the same traces.
+
+        Returns:
+            The number of clusters.
+        """
+        if isinstance(file, str):
+            print(f"WARNING: converting {file} to Path.  Please learn to speak pathlib.")
+            file = Path(file)
+        with np.load(file, allow_pickle=False) as arrays:
+            header = _json_column_values(arrays["header"])
+            if header.get("__class__", None) != "Clusters":
+                raise Exception("unknown clusters file format: " + str(header)[0:60])
+            if (header["num_traces"] != len(self.traces)
+                    or header["traces_hash"] != _traces_hash(self.traces)):
+                raise Exception(f"{file} was saved for different traces.")
+            clusters = arrays["clusters"]
+            (normalizer, algorithm) = pickle.loads(arrays["model"].tobytes())
+            rows = arrays["rows"] if "rows" in arrays else None
+            columns = header["columns"]
+            if header["sparse"]:
+                shape = tuple(arrays["shape"])
+                data = scipy.sparse.csr_matrix(
+                    (arrays["data"], arrays["indices"], arrays["indptr"]), shape=shape)
+            elif columns is not None:
+                data = pd.DataFrame(arrays["data"], columns=columns)
+            else:
+                data = arrays["data"]
+        self._cluster_data = data
+        self._cluster_rows = rows
+        self._cluster_model = (normalizer, algorithm, columns)
+        return self._set_clusters(clusters)
+
+
+class TraceSetColumns:
+    """A read-only columnar view of the actions and statuses of all the events in some traces.
+
+    Most analyses only need the action and status of each event, so this view stores
+    those as NumPy arrays, which makes counting and summarising traces much faster than
+    walking through all the Event objects.  Use TraceSet.get_columns() to get the
+    (cached) view of a TraceSet.
+
+    Public data fields include:
+        * self.actions: List[str].  The sorted vocabulary of action names.
+        * self.action_codes: np.ndarray.  The action of each event, as an index into actions.
+        * self.offsets: np.ndarray.  The events of trace i are offsets[i]:offsets[i+1].
+        * self.statuses: np.ndarray.  The status of each event (calculated when first used).
+    """
+
+    def __init__(self, traces: List[Trace]):
+        self.traces = traces
+        self.num_traces = len(traces)
+        vocab: Dict[str, int] = {}
+        codes = [vocab.setdefault(ev.action, len(vocab)) for tr in traces for ev in tr]
+        self.actions: List[str] = sorted(vocab)
+        renumber = np.zeros(len(vocab), dtype=np.int32)
+        for (new_code, action) in enumerate(self.actions):
+            renumber[vocab[action]] = new_code
+        self.action_codes: np.ndarray = renumber[np.array(codes, dtype=np.int32)]
+        lengths = np.array([len(tr) for tr in traces], dtype=np.int64)
+        self.offsets: np.ndarray = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        self._positions = {id(tr): i for (i, tr) in enumerate(traces)}
+        self._statuses: Optional[np.ndarray] = None
+        self._status_labels: Optional[Tuple[np.ndarray, List[str]]] = None
+        self._action_status_codes: Optional[Tuple[np.ndarray, List[str]]] = None
+
+    @property
+    def statuses(self) -> np.ndarray:
+        """The int64 status of each event (see Event.status)."""
+        if self._statuses is None:
+            self._statuses = np.array([ev.status for tr in self.traces for ev in tr],
+                                      dtype=np.int64)
+        return self._statuses
+
+    def status_labels(self) -> Tuple[np.ndarray, List[str]]:
+        """Returns the raw output 'Status' of each event as a string ("" if missing).
+
+        Returns:
+            A pair (codes, labels), where the label of event i is labels[codes[i]].
+        """
+        if self._status_labels is None:
+            labels: Dict[str, int] = {}
+            codes = [labels.setdefault(str(ev._outputs.get("Status", "")), len(labels))
+                     for tr in self.traces for ev in tr]
+            self._status_labels = (np.array(codes, dtype=np.int32), list(labels))
+        return self._status_labels
+
+    def matches(self, traces: List[Trace]) -> bool:
+        """True if this view is still up to date for the given list of traces.
+
+        That is, it is the same list, with the same number of traces and the same
+        number of events in each trace.
+        """
+        if traces is not self.traces or len(traces) != self.num_traces:
+            return False
+        lengths = np.fromiter(map(len, traces), dtype=np.int64, count=len(traces))
+        return np.array_equal(lengths, np.diff(self.offsets))
+
+    def trace_index(self, trace: Trace) -> Optional[int]:
+        """Returns the position of the given Trace object in this view, or None."""
+        i = self._positions.get(id(trace), None)
+        return i if i is not None and self.traces[i] is trace else None
+
+    def trace_codes(self, i: int) -> np.ndarray:
+        """Returns the action codes of the events in the i'th trace."""
+        return self.action_codes[self.offsets[i]:self.offsets[i + 1]]
+
+    def action_status_codes(self) -> Tuple[np.ndarray, List[str]]:
+        """Returns the action-status pair of each event, such as "Order_0".
+
+        Returns:
+            A pair (codes, names), where the pair of event i is names[codes[i]].
+        """
+        if self._action_status_codes is None:
+            (status_values, status_codes) = np.unique(self.statuses, return_inverse=True)
+            num_statuses = max(len(status_values), 1)
+            pairs = self.action_codes.astype(np.int64) * num_statuses + status_codes.reshape(-1)
+            (keys, codes) = np.unique(pairs, return_inverse=True)
+            names = [self.actions[k // num_statuses] + "_" + str(status_values[k % num_statuses])
+                     for k in keys.tolist()]
+            self._action_status_codes = (codes.reshape(-1), names)
+        return self._action_status_codes
+
+    def action_counts(self, i: int) -> Dict[str, int]:
+        """Like Trace.action_counts(), for the i'th trace."""
+        return _count_codes(self.trace_codes(i), self.actions)
+
+    def action_status_counts(self, i: int) -> Dict[str, int]:
+        """Like Trace.action_status_counts(), for the i'th trace."""
+        (codes, names) = self.action_status_codes()
+        return _count_codes(codes[self.offsets[i]:self.offsets[i + 1]], names)
+
+    def ngram_counts(self, i: int, n: int = 2, pad: bool = False,
+                     hash_size: Optional[int] = None) -> Dict[str, int]:
+        """Like Trace.action_ngram_counts(), for the i'th trace."""
+        offsets = np.array([0, self.offsets[i + 1] - self.offsets[i]], dtype=np.int64)
+        (rows, ngrams, names) = _ngrams(self.trace_codes(i), offsets, self.actions,
+                                        n, pad, hash_size)
+        return _count_codes(ngrams, names)
+
+    def ngram_matrix(self, n: int = 2, pad: bool = False, hash_size: Optional[int] = None,
+                     columns: List[str] = None) -> Tuple[Any, List[str]]:
+        """Returns the action_ngram_counts of every trace, as a sparse matrix.
+
+        Returns:
+            A pair (scipy.sparse.csr_matrix, column_names), with one row per trace.
+        """
+        (rows, ngrams, names) = _ngrams(self.action_codes, self.offsets, self.actions,
+                                        n, pad, hash_size)
+        return _codes_matrix(rows, ngrams, names, self.num_traces, columns)
+
+    def count_table(self, with_status: bool = False,
+                    columns: List[str] = None) -> pd.DataFrame:
+        """Returns the same table as TraceSet.get_trace_data() for the count methods.
+
+        Args:
+            with_status: False counts each action ("action_counts"), while True counts
+                each action-status pair ("action_status_counts").
+            columns: optional list of column names, to reorder, remove or add columns.
+        """
+        return _matrix_to_table(*self.count_matrix(with_status, columns))
+
+    def count_matrix(self, with_status: bool = False,
+                     columns: List[str] = None) -> Tuple[Any, List[str]]:
+        """Like count_table, but returns (scipy.sparse.csr_matrix, column_names).
+
+        The matrix is built directly from the action codes, without any dense table.
+        """
+        if with_status:
+            (codes, names) = self.action_status_codes()
+        else:
+            (codes, names) = (self.action_codes, self.actions)
+        trace_nums = np.repeat(np.arange(self.num_traces), np.diff(self.offsets))
+        return _codes_matrix(trace_nums, codes, names, self.num_traces, columns)
+
+    def trace_to_string(self, i: int, to_char: Mapping[str, str], compress: List[str] = None,
+                        color_status: bool = False) -> str:
+        """Like the trace_to_string function, for the i'th trace."""
+        (start, end) = (self.offsets[i], self.offsets[i + 1])
+        codes = self.action_codes[start:end]
+        if compress:
+            compressed = np.array([a in compress for a in self.actions], dtype=bool)
+            keep = np.ones(len(codes), dtype=bool)
+            keep[1:] = ~((codes[1:] == codes[:-1]) & compressed[codes[1:]])
+            codes = codes[keep]
+        table = [to_char.get(a, None) for a in self.actions]
+        chars = [table[c] for c in codes.tolist()]
+        if None in chars:
+            # raise the same KeyError as trace_to_string does.
+            raise KeyError(self.actions[codes[chars.index(None)]])
+        if color_status:
+            bad = self.statuses[start:end]
+            bad = (bad[keep] if compress else bad) != 0
+            chars = [f"\033[91m{ch}\033[0m" if red else ch
+                     for (ch, red) in zip(chars, bad.tolist())]
+        return "".join(chars)
+
+    def to_strings(self, to_char: Mapping[str, str], compress: List[str] = None,
+                   color_status: bool = False) -> List[str]:
+        """Like trace_to_string(i, ...) for every trace, but renders them all in one pass.
+
+        The chars of all the events are looked up in a table indexed by action code,
+        joined into one string, then sliced into one string per trace.
+        """
+        codes = self.action_codes
+        keep = None
+        if compress:
+            compressed = np.array([a in compress for a in self.actions], dtype=bool)
+            keep = np.ones(len(codes), dtype=bool)
+            keep[1:] = ~((codes[1:] == codes[:-1]) & compressed[codes[1:]])
+            keep[self.offsets[:-1][np.diff(self.offsets) > 0]] = True  # each trace's first event.
+            codes = codes[keep]
+        table = [to_char.get(a, None) for a in self.actions]
+        if None in table:
+            missing = [i for (i, ch) in enumerate(table) if ch is None]
+            used = np.isin(codes, missing)
+            if used.any():
+                # raise the same KeyError as trace_to_string does.
+                raise KeyError(self.actions[codes[np.argmax(used)]])
+        if color_status:
+            # each action code c has its plain char at 2*c and its red char at 2*c+1.
+            table = [ch for plain in table
+                     for ch in [plain, None if plain is None else f"\033[91m{plain}\033[0m"]]
+            bad = self.statuses if keep is None else self.statuses[keep]
+            codes = codes.astype(np.int64) * 2 + (bad != 0)
+        chars = np.array(table, dtype=object)[codes]
+        text = "".join(chars.tolist())
+        # the offset of each trace within text.
+        sizes = np.array([0 if ch is None else len(ch) for ch in table], dtype=np.int64)[codes]
+        ends = np.concatenate([[0], np.cumsum(sizes)])
+        if keep is not None:
+            bounds = ends[np.concatenate([[0], np.cumsum(keep)])[self.offsets]].tolist()
+        else:
+            bounds = ends[self.offsets].tolist()
+        return [text[bounds[i]:bounds[i + 1]] for i in range(self.num_traces)]
+
+
+class TraceQuery:
+    """A lazy pipeline of TraceSet transformations, which runs in one pass over the traces.
+
+    Create a query with TraceSet.query() or TraceSet.query_json(file), add steps with
+    filter_events, group_by, split and features, then run it with one of the terminal
+    operations: collect, to_pandas or save.  For example::
+
+        data = (TraceSet.query_json(file)
+                .filter_events("shop", "B")
+                .split(start_action="Login")
+                .features("action_counts")
+                .to_pandas())
+
+    Each input trace is passed through all the steps before the next trace is read,
+    so no intermediate TraceSets are built, and the derived traces are TraceViews
+    that share the original events.  When the input is a JSON file, the traces are
+    streamed from the file, and if the first step is filter_events, it is applied
+    while the events are decoded.  Each builder method returns a new query.
+    """
+
+    def __init__(self, source: Union['TraceSet', Path]):
+        """Create a query that reads the traces of a TraceSet, or streams them from a file."""
+        if isinstance(source, str):
+            print(f"WARNING: converting {source} to Path.  Please learn to speak pathlib.")
+            source = Path(source)
+        self._source = source
+        self._steps: List[Tuple[Callable[[Trace], List[Trace]], Any]] = []
+        self._features: Optional[Tuple[str, Optional[List[str]], Dict[str, Any]]] = None
+
+    def _copy(self) -> 'TraceQuery':
+        query = TraceQuery(self._source)
+        query._steps = list(self._steps)
+        query._features = self._features
+        return query
+
+    def _with_step(self, step: Callable[[Trace], List[Trace]],
+                   event_filter: Callable[[Event], bool] = None) -> 'TraceQuery':
+        query = self._copy()
+        query._steps.append((step, event_filter))
+        return query
+
+    def filter_events(self, name: str = None, value: Any = None,
+                      predicate: Callable[[Event], bool] = None,
+                      removeEmptyTrace: bool = True) -> 'TraceQuery':
+        """Keeps only the events whose meta data name equals value (or that satisfy predicate).
+        See TraceSet.with_events_filtered.
+        """
+        if predicate is None:
+            if name is None:
+                raise Exception("filter_events requires a name or a predicate.")
+            predicate = functools.partial(_meta_equals, name, value)
+        step = functools.partial(_filter_trace, predicate=predicate,
+                                 removeEmptyTrace=removeEmptyTrace, view=True)
+        return self._with_step(step, predicate if removeEmptyTrace else None)
+
+    def group_by(self, name: str = None, property: bool = False,
+                 key: Callable[[Event], Any] = None, sort_by: str = None) -> 'TraceQuery':
+        """Groups the events of each trace.  See TraceSet.with_traces_grouped_by."""
+        step = functools.partial(_group_trace, key=_group_key(name, property, key),
+                                 sort_by=sort_by, view=True)
+        return self._with_step(step)
+
+    def split(self, start_action: str = None, input_name: str = None,
+              delay: datetime.timedelta = None) -> 'TraceQuery':
+        """Splits each trace into shorter traces.  See TraceSet.with_traces_split."""
+        if start_action is None and input_name is None and delay is None:
+            raise Exception("split requires at least one split criteria.")
+        step = functools.partial(_split_trace, start_action=start_action,
+                                 input_name=input_name, delay=delay, view=True)
+        return self._with_step(step)
+
+    def features(self, method: str = "action_counts",
+                 columns: List[str] = None, **kwargs) -> 'TraceQuery':
+        """Makes to_pandas() return a table of data about each trace, rather than each event.
+        See TraceSet.get_trace_data, which takes the same method names (such as "ngrams")
+        and keyword parameters (such as ``n=3``).  The data is gathered as each trace
+        is produced.
+        """
+        query = self._copy()
+        query._features = (_TRACE_DATA_ALIASES.get(method, method), columns, kwargs)
+        return query
+
+    def _traces(self, header: Dict[str, Any]) -> Iterator[Trace]:
+        """Runs the pipeline, yielding each resulting trace."""
+        steps = [step for (step, _) in self._steps]
+        if isinstance(self._source, TraceSet):
+            # views, so that the results never take over the traces of the source set.
+            traces: Iterator[Trace] = (tr.view(range(len(tr)), dict(tr.meta_data))
+                                       for tr in self._source.traces)
+        else:
+            event_filter = None
+            if self._steps and self._steps[0][1] is not None:
+                # push the first filter down into the JSON decoding.
+                event_filter = self._steps[0][1]
+                steps = steps[1:]
+            traces = TraceSet.iter_traces_from_json(self._source, header, event_filter)
+        for tr in traces:
+            yield from _apply_steps(tr, steps)
+
+    def _meta_data(self, header: Dict[str, Any]) -> MetaData:
+        """The meta-data of the source, once all its traces have been read."""
+        if isinstance(self._source, TraceSet):
+            return self._source.meta_data
+        traceset = TraceSet([], {})
+        TraceSet._upgrade_header(traceset, self._source, header)
+        return traceset.meta_data
+
+    def collect(self) -> 'TraceSet':
+        """Runs the query and returns the resulting traces as a new TraceSet."""
+        header: Dict[str, Any] = {}
+        result = TraceSet([], {})
+        for tr in self._traces(header):
+            result.append(tr)
+        result.meta_data = self._meta_data(header).copy()
+        return result
+
+    def to_pandas(self, **kwargs) -> pd.DataFrame:
+        """Runs the query and returns a Pandas table.
+
+        If features() was called, this is a table of data about each trace
+        (like TraceSet.get_trace_data), otherwise it has one row per event
+        (like TraceSet.to_pandas, with the same keyword options for choosing the columns).
+        The traces are not kept after their data is gathered.
+        """
+        if self._features is None:
+            return traces_to_pandas(list(self._traces({})), **kwargs)
+        (method, columns, method_kwargs) = self._features
+        trace_data = [getattr(tr, method)(**method_kwargs) for tr in self._traces({})]
+        return _trace_data_table(trace_data, columns)
+
+    def iter_pandas(self, chunk_traces: int = 1000, header: Optional[Dict[str, Any]] = None,
+                    **kwargs) -> Iterator[pd.DataFrame]:
+        """Runs the query and yields a table of events for each block of chunk_traces traces.
+
+        See TraceSet.iter_pandas.  This runs the query twice - first to find the columns
+        and their types, then to build the tables - so that at most chunk_traces traces
+        are in memory at once.  The optional header is filled in as for
+        TraceSet.iter_traces_from_json, when the source is a file.
+        """
+        if header is None:
+            header = {}
+        return _iter_pandas(lambda: self._traces(header), chunk_traces, **kwargs)
+
+    def save(self, file: Path, **kwargs) -> int:
+        """Runs the query and saves the resulting traces into a JSON file, one at a time.
+
+        Args:
+            file: the JSON file to write.
+            kwargs: any other options for TraceSetWriter, such as indent.
+
+        Returns:
+            the number of traces saved.
+        """
+        header: Dict[str, Any] = {}
+        traces = self._traces(header)
+        # reading the first trace also reads any meta-data that comes before the traces.
+        first = list(itertools.islice(traces, 1))
+        # older files have their meta-data after the traces, so then we write it last too.
+        meta_last = (not isinstance(self._source, TraceSet) and "meta_data" not in header
+                     and len(first) > 0)
+        meta = None if meta_last else self._meta_data(header)
+        with TraceSetWriter(file, meta, meta_data_last=meta_last, **kwargs) as writer:
+            for tr in itertools.chain(first, traces):
+                writer.write(tr)
+            if meta_last:
+                writer.meta_data = self._meta_data(header)
+        return writer.count
+
+
+class TraceSetWriter:
+    """Writes a JSON traces file incrementally, one trace at a time.
+
+    The header and meta-data are written immediately, then each trace is appended
+    as soon as it is passed to write(), and the file is completed by close().
+    This means that long-running test generation jobs do not need to keep all their
+    traces until the end, and if the program crashes, the traces written so far can
+    still be recovered via ``TraceSet.iter_traces_from_json``.
+    The resulting file can be read by ``TraceSet.load_from_json`` as usual.
+
+    Typical usage is::
+
+        with TraceSetWriter(Path("out.json"), meta_data) as writer:
+            for ...:
+                writer.write(trace)
+    """
+
+    def __init__(self, file: Path, meta_data: Optional[MetaData] = None,
+                 indent: Optional[int] = 2, flush: bool = False, index: bool = False,
+                 backend: Union[str, 'JsonBackend', None] = None,
+                 compress_level: Optional[int] = None, meta_data_last: bool = False):
+        """Opens the given file and writes the header of the TraceSet.
+
+        Args:
+            file: the JSON file to write.  If its name ends with one of the
+                COMPRESSION_SUFFIXES (such as "traces.json.gz") it will be compressed.
+            meta_data: the meta-data of the whole TraceSet (default is
+                ``TraceSet.get_default_meta_data()``).
+            indent: the number of spaces to indent each nesting level of the JSON.
+                None means no indentation or newlines, which gives much smaller files.
+            flush: True means flush each trace out to the file as soon as it is written.
+            index: True means also save the index of the positions of the traces
+                when the file is closed.  See ``TraceSet.load_traces``.
+            backend: the JSON library used to encode the traces (see ``get_json_backend``).
+            compress_level: the compression level, if the file is compressed.
+            meta_data_last: True means write the meta-data after the traces (as older
+                versions did), when the file is closed.  Until then, it can be set or
+                updated via ``self.meta_data``.
+        """
+        if isinstance(file, str):
+            print(f"WARNING: converting {file} to Path.  Please learn to speak pathlib.")
+            file = Path(file)
+        if index and file.suffix in COMPRESSION_SUFFIXES:
+            raise Exception(f"cannot save an index for compressed file {file}.")
+        if meta_data is None and not meta_data_last:
+            meta_data = TraceSet.get_default_meta_data()
+        self.file = file
+        self.meta_data = meta_data
+        self._meta_data_last = meta_data_last
+        self.indent = indent
+        self.flush = flush
+        self.count = 0  # number of traces written so far.
+        self._backend = get_json_backend(backend)
+        self._sep = b", " if indent is None else b","
+        self._position = 0  # the number of bytes written so far.
+        self._spans: Optional[List[Tuple[int, int]]] = [] if index else None
+        self._header = {"__class__": "TraceSet", "__module__": TraceSet.__module__,
+                        "version": TRACE_SET_VERSION}
+        self._output = _open_trace_file(file, "wb", compress_level)
+        self._write(b"{")
+        for (key, value) in self._header.items():
+            self._write_field(key, value)
+            self._write(self._sep)
+        if not meta_data_last:
+            self._write_field("meta_data", meta_data)
+            self._write(self._sep)
+        self._write(self._newline(1) + b'"traces": [')
+
+    def _write_field(self, key: str, value: Any) -> None:
+        """Writes one field of the TraceSet object (without any separator)."""
+        self._write(self._newline(1) + json.dumps(key).encode() + b": " + self._dumps(value, 1))
+
+    def _write(self, data: bytes) -> None:
+        self._output.write(data)
+        self._position += len(data)
+
+    def _newline(self, level: int) -> bytes:
+        """The text that starts a new line at the given nesting level."""
+        return b"" if self.indent is None else b"\n" + b" " * (self.indent * level)
+
+    def _dumps(self, value: Any, level: int) -> bytes:
+        """Encodes value as JSON, indented to start at the given nesting level."""
+        data = self._backend.dumps(value, indent=self.indent)
+        if self.indent is not None:
+            # Note: newlines inside strings are always escaped, so this is safe.
+            data = data.replace(b"\n", self._newline(level))
+        return data
+
+    def write(self, trace: Trace) -> None:
+        """Appends the given trace to the file."""
+        if not isinstance(trace, Trace):
+            raise Exception("Trace required, not: " + str(trace))
+        if self.count > 0:
+            self._write(self._sep)
+        self._write(self._newline(2))
+        start = self._position
+        self._write(self._dumps(trace, 2))
+        if self._spans is not None:
+            self._spans.append((start, self._position))
+        self.count += 1
+        if self.flush:
+            self._output.flush()
+
+    def close(self) -> None:
+        """Finishes the JSON file and closes it (and saves its index, if requested)."""
+        if not self._output.closed:
+            if self.meta_data is None:
+                self.meta_data = TraceSet.get_default_meta_data()
+            self._write(self._newline(1) + b"]")
+            if self._meta_data_last:
+                self._write(self._sep)
+                self._write_field("meta_data", self.meta_data)
+            self._write(self._newline(0) + b"}")
+            self._output.close()
+            if self._spans is not None:
+                starts = np.array([start for (start, end) in self._spans], dtype=np.int64)
+                ends = np.array([end for (start, end) in self._spans], dtype=np.int64)
+                header = dict(self._header, meta_data=self.meta_data)
+                _save_json_index(self.file, starts, ends, header)
+
+    def __enter__(self) -> 'TraceSetWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+
+class JsonBackend:
+    """Reads and writes JSON using the standard Python json module.
+
+    The subclasses of this use faster JSON libraries, when they are installed.
+    See ``get_json_backend``.  Every backend must encode the special objects in traces
+    (Decimal, bytes, sets, datetimes, zeep objects, etc.) exactly like ``TraceEncoder``.
+    """
+
+    name = "json"
+
+    def loads(self, data: Union[str, bytes]) -> Any:
+        """Decodes the given JSON text, which may be a str or UTF-8 bytes."""
+        return json.loads(data)
+
+    def dumps(self, value: Any, indent: Optional[int] = None) -> bytes:
+        """Encodes value as UTF-8 JSON text, with the given indentation (if any)."""
+        return json.dumps(value, indent=indent, cls=TraceEncoder).encode("utf-8")
+
+
+class _OrjsonBackend(JsonBackend):
+    """Uses the orjson library, which is much faster for both reading and writing."""
+
+    name = "orjson"
+
+    def __init__(self):
+        import orjson  # type: ignore
+        self._orjson = orjson
+        self._default = TraceEncoder().default
+        # datetimes and dataclasses are passed to TraceEncoder, so they are encoded as usual.
+        self._options = (orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+                         | orjson.OPT_PASSTHROUGH_DATACLASS)
+
+    def loads(self, data: Union[str, bytes]) -> Any:
+        try:
+            return self._orjson.loads(data)
+        except self._orjson.JSONDecodeError:
+            return super().loads(data)  # for example, NaN and Infinity are not supported.
+
+    def dumps(self, value: Any, indent: Optional[int] = None) -> bytes:
+        if indent in [None, 2]:  # orjson only supports these.
+            option = self._options | (self._orjson.OPT_INDENT_2 if indent else 0)
+            try:
+                result = self._orjson.dumps(value, default=self._default, option=option)
+                # orjson writes NaN and Infinity as null, so check for those (if needed).
+                if b"null" not in result or not self._has_non_finite(value):
+                    return result
+            except TypeError:
+                pass  # some values (like huge integers) are not supported by orjson.
+        return super().dumps(value, indent)
+
+    def _has_non_finite(self, value: Any) -> bool:
+        """True if value contains a NaN or infinite float, looking inside objects too."""
+        if isinstance(value, float):
+            return not math.isfinite(value)
+        if isinstance(value, dict):
+            return any(self._has_non_finite(v) for v in value.values())
+        if isinstance(value, (list, tuple)):
+            return any(self._has_non_finite(v) for v in value)
+        if value is None or isinstance(value, (str, int)):
+            return False
+        try:
+            return self._has_non_finite(self._default(value))
+        except Exception:
+            return False
+
+
+class _UjsonBackend(JsonBackend):
+    """Uses the ujson library for reading JSON.
+
+    Writing still uses the json module, since ujson has its own encoding of Decimals etc.
+    """
+
+    name = "ujson"
+
+    def __init__(self):
+        import ujson  # type: ignore
+        self.loads = ujson.loads  # type: ignore
+
+
+class _SimdjsonBackend(JsonBackend):
+    """Uses the pysimdjson library for reading JSON.  It does not support writing."""
+
+    name = "simdjson"
+
+    def __init__(self):
+        import simdjson  # type: ignore
+        self.loads = simdjson.loads  # type: ignore
+
+
+JSON_BACKENDS = {
+    "json": JsonBackend,
+    "orjson": _OrjsonBackend,
+    "ujson": _UjsonBackend,
+    "simdjson": _SimdjsonBackend,
+    }
+
+_json_backends: Dict[str, JsonBackend] = {}  # the backends created so far.
+
+
+def get_json_backend(backend: Union[str, JsonBackend, None] = None) -> JsonBackend:
+    """Gets the JSON library used to load and save JSON traces files.
+
+    Args:
+        backend: the name of one of the JSON_BACKENDS ("json", "orjson", "ujson" or
+            "simdjson"), or a JsonBackend object.  The default (None) chooses the fastest
+            one that is installed, in the order orjson, simdjson, ujson, then json.
+
+    Returns:
+        a JsonBackend object.  An ImportError is raised if the requested library
+        is not installed.
+    """
+    if isinstance(backend, JsonBackend):
+        return backend
+    if backend is None:
+        for name in ["orjson", "simdjson", "ujson"]:
+            try:
+                return get_json_backend(name)
+            except ImportError:
+                pass
+        return get_json_backend("json")
+    if backend not in _json_backends:
+        if backend not in JSON_BACKENDS:
+            raise Exception(f"unknown JSON backend {backend}, "
+                            f"expected one of {list(JSON_BACKENDS)}.")
+        _json_backends[backend] = JSON_BACKENDS[backend]()
+    return _json_backends[backend]
+
+
+class TraceEncoder(json.JSONEncoder):
+    """Custom JSON encoder because objects from zeep could not be serialised.
 
     Based on ideas from this blog entry by 'The Fellow' (Ouma Rodgers):
     https://medium.com/python-pandemonium/json-the-python-way-91aac95d4041.
@@ -856,6 +2809,17 @@ class TraceEncoder(json.JSONEncoder):
             return list(obj)
         if isinstance(obj, (datetime.date, datetime.datetime, datetime.time)):
             return obj.isoformat()  # as a string
+        if isinstance(obj, TraceView):
+            # save the events of the view without materializing it.
+            return {"__class__": "Trace", "__module__": obj.__module__,
+                    "events": list(obj), "meta_data": obj.meta_data}
+        if isinstance(obj, Event):
+            # this saves the dictionaries as they are stored, including any EMPTY_DATA.
+            result = {"__class__": obj.__class__.__name__, "__module__": obj.__module__,
+                      "action": obj.action, "inputs": obj._inputs, "outputs": obj._outputs,
+                      "meta_data": obj._meta_data}
+            self._add_public_attributes(result, _slot_attributes(obj))
+            return result
         if hasattr(obj, "__dict__"):
             result = {
                 "__class__": obj.__class__.__name__,
@@ -868,6 +2832,14 @@ class TraceEncoder(json.JSONEncoder):
             else:
                 self._add_public_attributes(result, obj.__dict__)
             return result
+        slots = _slot_attributes(obj)
+        if slots:
+            result = {
+                "__class__": obj.__class__.__name__,
+                "__module__": obj.__module__
+                }
+            self._add_public_attributes(result, slots)
+            return result
         raise Exception("JSON serialisation not implemented yet for: " +
                         str(obj) + " type " + str(type(obj)) + " dir:" + ",".join(dir(obj)))
 
@@ -877,6 +2849,626 @@ class TraceEncoder(json.JSONEncoder):
                 result[name] = value
 
 
+def _slot_attributes(obj: Any) -> Dict[str, Any]:
+    """Returns the attributes of an object that uses __slots__, in declaration order."""
+    result = {}
+    for klass in reversed(type(obj).__mro__):
+        slots = klass.__dict__.get("__slots__", ())
+        for name in [slots] if isinstance(slots, str) else slots:
+            if hasattr(obj, name):
+                result[name] = getattr(obj, name)
+    return result
+
+
+def _load_traces_file(cls, file: Path, backend: Optional[str]) -> TraceSet:
+    """Loads one file for TraceSet.load_many (this must be a global function for pickling)."""
+    if file.suffix == ".npz":
+        return cls.load_from_columnar(file)
+    return cls.load_from_json(file, backend=backend)
+
+
+COMPRESSION_SUFFIXES = [".gz", ".bz2", ".xz", ".zst"]
+
+
+def _open_trace_file(file: Path, mode: str, level: Optional[int] = None) -> IO[bytes]:
+    """Opens a traces file in binary mode ("rb" or "wb").
+
+    If the file name ends with one of the COMPRESSION_SUFFIXES, the data is compressed
+    or decompressed incrementally as it is written or read.
+
+    Args:
+        file: the file to open.
+        mode: "rb" or "wb".
+        level: optional compression level (when writing a compressed file).
+    """
+    suffix = file.suffix
+    if suffix == ".gz":
+        return gzip.open(file, mode, **({} if level is None else {"compresslevel": level}))
+    if suffix == ".bz2":
+        return bz2.open(file, mode, **({} if level is None else {"compresslevel": level}))
+    if suffix == ".xz":
+        return lzma.open(file, mode, preset=level)
+    if suffix == ".zst":
+        try:
+            import zstandard  # type: ignore
+        except ImportError:
+            raise ImportError("Please install zstandard to use *.zst files: pip install zstandard")
+        raw = file.open(mode)
+        if mode == "wb":
+            compressor = zstandard.ZstdCompressor(level=3 if level is None else level)
+            return compressor.stream_writer(raw)
+        return zstandard.ZstdDecompressor().stream_reader(raw)
+    return file.open(mode)
+
+
+CLUSTER_STRATEGIES = ["meanshift", "minibatch_kmeans", "birch", "hdbscan"]
+"""The names of the clustering algorithms that create_clusters(strategy=...) can create."""
+
+_CLUSTER_BATCH_SIZE = 10000
+"""How many traces create_clusters normalizes and predicts at a time, after sampling."""
+
+_TRACE_DATA_ALIASES = {"ngrams": "action_ngram_counts",
+                       "transitions": "action_transition_counts"}
+"""Short names for some get_trace_data methods."""
+
+_COLUMNAR_TRACE_DATA = ["action_counts", "action_status_counts",
+                        "action_ngram_counts", "action_transition_counts"]
+"""The get_trace_data methods that are calculated from TraceSet.get_columns()."""
+
+_NAT = np.iinfo(np.int64).min  # the int64 value of NaT (not a time) in NumPy.
+_EPOCH = datetime.datetime(1970, 1, 1)
+_EPOCH_UTC = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def _index_dtype(size: int) -> type:
+    """Returns the smallest NumPy integer type for indexes into a list of the given size."""
+    return np.int32 if size < 2**31 else np.int64
+
+
+def _select_events(trace: Trace, indexes: List[int], view: bool) -> Trace:
+    """Returns a new trace containing trace[i] for each i in indexes.
+
+    If view is True, this is a TraceView that shares the events of trace.
+    """
+    if view:
+        array = np.array(indexes, dtype=_index_dtype(len(trace)))
+        if len(indexes) == 0 or (np.diff(array) == 1).all():
+            start = indexes[0] if indexes else 0
+            return trace.view(range(start, start + len(indexes)))
+        return trace.view(array)
+    return Trace([trace[i] for i in indexes])
+
+
+def _trace_data_table(trace_data: List[Dict[str, Any]],
+                      columns: Optional[List[str]]) -> pd.DataFrame:
+    """Makes the table of TraceSet.get_trace_data, from the data of each trace."""
+    if columns is None:
+        # columns is the sorted list of the union of all keys in trace_data.
+        keys = set()
+        for d in trace_data:
+            keys.update(set(d.keys()))
+        columns = sorted(list(keys))
+    data = pd.DataFrame(trace_data, columns=columns)
+    data.fillna(value=0, inplace=True)
+    return data
+
+
+def _apply_steps(trace: Trace, steps: List[Callable[[Trace], List[Trace]]]) -> Iterator[Trace]:
+    """Passes trace through each step of a TraceQuery, yielding the resulting traces."""
+    if not steps:
+        yield trace
+    else:
+        for tr in steps[0](trace):
+            yield from _apply_steps(tr, steps[1:])
+
+
+def _trace_data_matrix(trace_data: List[Dict[str, Any]],
+                       columns: Optional[List[str]]) -> Tuple[Any, List[str]]:
+    """Like _trace_data_table, but returns (scipy.sparse.csr_matrix, column_names)."""
+    if columns is None:
+        columns = sorted(set(key for d in trace_data for key in d))
+    position = {name: i for (i, name) in enumerate(columns)}
+    rows = []
+    cols = []
+    values = []
+    for (row, d) in enumerate(trace_data):
+        for (key, value) in d.items():
+            col = position.get(key, None)
+            if col is not None:
+                rows.append(row)
+                cols.append(col)
+                values.append(value)
+    matrix = scipy.sparse.csr_matrix((values, (rows, cols)),
+                                     shape=(len(trace_data), len(columns)))
+    return (matrix, columns)
+
+
+def _cluster_algorithm(strategy: str, n_clusters: Optional[int], random_state: Optional[int]):
+    """Creates the clustering algorithm for one of the CLUSTER_STRATEGIES."""
+    if strategy not in CLUSTER_STRATEGIES:
+        raise Exception(f"unknown clustering strategy '{strategy}', not in {CLUSTER_STRATEGIES}")
+    size = {} if n_clusters is None else {"n_clusters": n_clusters}
+    if strategy == "meanshift":
+        return sklearn.cluster.MeanShift()
+    if strategy == "minibatch_kmeans":
+        return sklearn.cluster.MiniBatchKMeans(n_init=3, random_state=random_state, **size)
+    if strategy == "birch":
+        return sklearn.cluster.Birch(**size)
+    if not hasattr(sklearn.cluster, "HDBSCAN"):
+        raise Exception("The hdbscan strategy needs scikit-learn 1.3 or later.")
+    # it can safely update the data in place, since it is our normalized copy.
+    copy = {"copy": False} if "copy" in sklearn.cluster.HDBSCAN().get_params() else {}
+    return sklearn.cluster.HDBSCAN(**copy)
+
+
+def _row_batches(num_rows: int, batch_size: int) -> Iterator[slice]:
+    """Splits the rows 0..num_rows-1 into slices of at most batch_size rows."""
+    for start in range(0, num_rows, batch_size):
+        yield slice(start, min(start + batch_size, num_rows))
+
+
+def _take_rows(data: Any, rows: Union[slice, np.ndarray]) -> Any:
+    """Selects some rows of a DataFrame, a sparse matrix or an array."""
+    return data.iloc[rows] if isinstance(data, pd.DataFrame) else data[rows]
+
+
+def _row_argmax(data: Any) -> np.ndarray:
+    """The column number of the largest value in each row of some data."""
+    if isinstance(data, pd.DataFrame):
+        data = data.to_numpy()
+    return np.asarray(data.argmax(axis=1)).reshape(-1)
+
+
+def _normalized_rows(normalizer: Any, data: Any) -> Any:
+    """Normalizes some data, keeping DataFrames as DataFrames and sparse data sparse."""
+    result = normalizer.transform(data)
+    if scipy.sparse.issparse(data):
+        return scipy.sparse.csr_matrix(result)
+    if isinstance(data, pd.DataFrame):
+        return pd.DataFrame(result, columns=data.columns)
+    return result
+
+
+def _stratified_sample(strata: np.ndarray, size: int, rand: np.random.Generator) -> np.ndarray:
+    """Chooses about size random positions, in proportion to the size of each stratum.
+
+    Every stratum gets at least one position, so small strata are always represented.
+
+    Returns:
+        The chosen positions, in increasing order.
+    """
+    (values, groups, counts) = np.unique(strata, return_inverse=True, return_counts=True)
+    groups = groups.reshape(-1)
+    quotas = np.minimum(counts, np.maximum(1, counts * size // max(len(strata), 1)))
+    # shuffle, then sort by stratum, so that each stratum is in a random order.
+    order = rand.permutation(len(strata))
+    order = order[np.argsort(groups[order], kind="stable")]
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    ranks = np.arange(len(order)) - starts[groups[order]]
+    return np.sort(order[ranks < quotas[groups[order]]])
+
+
+class _PointFinder:
+    """Finds the plotted points that are near the mouse, using a KD-tree.
+
+    Distances are measured in pixels, so the tree is built on the points scaled by the
+    current axes transform, and is rebuilt only when that scaling changes (zooming).
+    """
+
+    def __init__(self, points: np.ndarray, radius: float = 5.0, max_points: int = 10):
+        self.points = np.asarray(points, dtype=float)
+        self.radius = radius
+        self.max_points = max_points
+        self._scale: Optional[np.ndarray] = None
+        self._tree: Any = None
+
+    def find(self, transform: np.ndarray, x: float, y: float) -> List[int]:
+        """The positions of the points near data coordinates (x,y), nearest first.
+
+        Args:
+            transform: the 3x3 affine matrix that maps data coordinates to pixels.
+            x: the X data coordinate of the mouse.
+            y: the Y data coordinate of the mouse.
+        """
+        if len(self.points) == 0 or x is None or y is None:
+            return []
+        scale = np.abs(np.array([transform[0][0], transform[1][1]], dtype=float))
+        if self._scale is None or not np.array_equal(scale, self._scale):
+            self._scale = scale
+            self._tree = scipy.spatial.cKDTree(self.points * scale)
+        k = min(self.max_points, len(self.points))
+        (dists, near) = self._tree.query(np.array([x, y]) * scale, k=k,
+                                         distance_upper_bound=self.radius)
+        return [int(n) for (d, n) in zip(np.atleast_1d(dists), np.atleast_1d(near))
+                if np.isfinite(d)]
+
+
+def _traces_hash(traces: List[Trace]) -> str:
+    """A SHA-256 hash of the contents (the events and meta-data) of some traces."""
+    digest = hashlib.sha256()
+    for tr in traces:
+        text = json.dumps([list(tr), tr.meta_data], cls=TraceEncoder, sort_keys=True)
+        digest.update(text.encode("utf-8"))
+        digest.update(b"\n")
+    return digest.hexdigest()
+
+
+def _fit_maybe_sparse(action: Callable[[Any], Any], data: Any) -> Any:
+    """Calls action(data), converting sparse data to a dense array if action rejects it."""
+    try:
+        return action(data)
+    except TypeError:
+        if not scipy.sparse.issparse(data):
+            raise
+        print(f"    converting sparse data to dense for {action.__qualname__}.")
+        return action(data.toarray())
+
+
+def _count_codes(codes: np.ndarray, names: List[str]) -> Dict[str, int]:
+    """Counts how many times each code occurs, as a dictionary from names to counts."""
+    counts = np.bincount(codes, minlength=len(names))
+    result: Dict[str, int] = defaultdict(int)
+    for code in np.flatnonzero(counts).tolist():
+        result[names[code]] = int(counts[code])
+    return result
+
+
+def _codes_matrix(rows: np.ndarray, codes: np.ndarray, names: List[str], num_rows: int,
+                  columns: Optional[List[str]]) -> Tuple[Any, List[str]]:
+    """Counts each (row, code) pair, into a sparse matrix with the given column names.
+
+    Returns:
+        A pair (scipy.sparse.csr_matrix, columns).  The default columns are sorted names.
+    """
+    if columns is None:
+        columns = sorted(names)
+    position = {name: i for (i, name) in enumerate(columns)}
+    # renumber the codes into column positions, with -1 for dropped columns.
+    renumber = np.array([position.get(name, -1) for name in names] + [-1], dtype=np.int64)
+    cols = renumber[codes] if len(codes) > 0 else np.zeros(0, dtype=np.int64)
+    keep = cols >= 0
+    ones = np.ones(np.count_nonzero(keep), dtype=np.int64)
+    matrix = scipy.sparse.csr_matrix((ones, (rows[keep], cols[keep])),
+                                     shape=(num_rows, len(columns)))
+    matrix.sum_duplicates()
+    return (matrix, columns)
+
+
+def _matrix_to_table(matrix: Any, columns: List[str]) -> pd.DataFrame:
+    """Converts a sparse matrix of counts into the same table as _trace_data_table."""
+    dense = matrix.toarray()
+    data = {}
+    for (i, col) in enumerate(columns):
+        values = dense[:, i]
+        # a missing count is NaN then 0.0 in the general get_trace_data algorithm.
+        data[col] = values.astype(np.float64) if (values == 0).any() else values
+    # the index gives one row per trace, even if there are no columns.
+    return pd.DataFrame(data, columns=columns, index=pd.RangeIndex(dense.shape[0]))
+
+
+def _ngrams(codes: np.ndarray, offsets: np.ndarray, names: List[str], n: int, pad: bool,
+            hash_size: Optional[int]) -> Tuple[np.ndarray, np.ndarray, List[str]]:
+    """Finds all the n-grams (sequences of n consecutive codes) within each trace.
+
+    Args:
+        codes: the action codes of all the events.  Code c means the action names[c].
+        offsets: the events of trace i are codes[offsets[i]:offsets[i+1]].
+        names: the action names.
+        n, pad, hash_size: see Trace.action_ngram_counts.
+
+    Returns:
+        A triple (rows, ngrams, ngram_names), giving the trace number and the n-gram code
+        of each n-gram, and the names of the n-gram codes.
+    """
+    if n < 1:
+        raise Exception(f"n-grams require n >= 1, not {n}")
+    num_traces = len(offsets) - 1
+    lengths = np.diff(offsets)
+    names = list(names)
+    if pad:
+        # insert a "^" start code before each trace and a "$" end code after each trace.
+        names += ["^", "$"]
+        trace_nums = np.repeat(np.arange(num_traces), lengths)
+        shift = 2 * np.arange(num_traces + 1)
+        padded = np.empty(len(codes) + 2 * num_traces, dtype=np.int64)
+        padded[np.arange(len(codes)) + 2 * trace_nums + 1] = codes
+        padded[offsets[:-1] + shift[:-1]] = len(names) - 2
+        padded[offsets[1:] + shift[:-1] + 1] = len(names) - 1
+        (codes, offsets, lengths) = (padded, offsets + shift, lengths + 2)
+    trace_nums = np.repeat(np.arange(num_traces), lengths)
+    num_windows = max(len(codes) - n + 1, 0)
+    # keep just the windows that start and end in the same trace.
+    valid = np.flatnonzero(trace_nums[:num_windows] == trace_nums[n - 1:n - 1 + num_windows])
+    windows = np.stack([codes[valid + i] for i in range(n)], axis=1)
+    if len(names) ** n < 2**62:
+        # encode each window as one integer, which is much faster to sort.
+        ids = np.zeros(len(valid), dtype=np.int64)
+        for i in range(n):
+            ids = ids * len(names) + windows[:, i]
+        (keys, ngrams) = np.unique(ids, return_inverse=True)
+        keys = np.stack([keys // len(names)**(n - 1 - i) % len(names) for i in range(n)], axis=1)
+    else:
+        (keys, ngrams) = np.unique(windows, axis=0, return_inverse=True)
+    ngrams = ngrams.reshape(-1)
+    ngram_names = ["->".join(names[c] for c in key) for key in keys.tolist()]
+    if hash_size is not None:
+        width = len(str(hash_size - 1))
+        buckets = np.array([zlib.crc32(name.encode("utf-8")) % hash_size
+                            for name in ngram_names] + [0], dtype=np.int64)
+        (used, ngrams) = np.unique(buckets[ngrams], return_inverse=True)
+        ngrams = ngrams.reshape(-1)
+        ngram_names = [f"hash{b:0{width}d}" for b in used.tolist()]
+    return (trace_nums[valid], ngrams, ngram_names)
+
+
+def _split_trace(old: Trace, start_action: Optional[str], input_name: Optional[str],
+                 delay: Optional[datetime.timedelta], view: bool) -> List[Trace]:
+    """Splits one trace into shorter traces.  See TraceSet.with_traces_split."""
+    # starts are the positions where each new trace starts.
+    starts = [0]
+    if start_action is not None or input_name is not None:
+        # a plain loop is faster than NumPy for the typical short trace.
+        prev_input = None
+        for (pos, event) in enumerate(old):
+            input_value = event._inputs.get(input_name, None)
+            input_changed = input_value != prev_input and input_value is not None
+            if (event.action == start_action or input_changed) and pos > 0:
+                starts.append(pos)
+            if input_value is not None:
+                prev_input = input_value
+            # NOTE: we could check end_action here.
+    if delay is not None:
+        # timestamps are parsed once and cached in each trace (see get_timestamps).
+        delay_starts = np.flatnonzero(old._delay_cuts(delay)).tolist()
+        if delay_starts:
+            starts = sorted(set(starts).union(delay_starts))
+    ends = starts[1:] + [len(old)]
+    if view:
+        return [old.view(range(start, end)) for (start, end) in zip(starts, ends)]
+    return [Trace(old[start:end]) for (start, end) in zip(starts, ends)]
+
+
+def _group_key(name: Optional[str], property: bool,
+               key: Optional[Callable[[Event], Any]]) -> Callable[[Event], Any]:
+    """Returns the key function for grouping events.  See TraceSet.with_traces_grouped_by."""
+    if key is not None:
+        return key
+    if name is None:
+        raise Exception("with_traces_grouped_by requires a name or a key function.")
+    return functools.partial(_event_value, name, property)
+
+
+def _group_trace(old: Trace, key: Callable[[Event], Any], sort_by: Optional[str],
+                 view: bool) -> List[Trace]:
+    """Groups the events of one trace into new traces.  See TraceSet.with_traces_grouped_by."""
+    return _grouped_traces(old, _group_positions([old], key), [old], sort_by, view)
+
+
+def _grouped_traces(source: Trace, groups: Dict[Any, List[int]], traces: List[Trace],
+                    sort_by: Optional[str], view: bool) -> List[Trace]:
+    """Makes a trace for each group of positions in source (the events of traces)."""
+    values = None
+    if sort_by == "timestamp" and len(groups) > 0:
+        values = np.concatenate([tr.get_timestamps() for tr in traces])
+    result = []
+    for positions in groups.values():
+        if values is not None:
+            order = np.argsort(values[positions], kind="stable")  # NaT sorts last
+            positions = [positions[i] for i in order.tolist()]
+        elif sort_by is not None:
+            positions = sorted(positions, key=functools.partial(_meta_sort_key, source, sort_by))
+        result.append(_select_events(source, positions, view))
+    return result
+
+
+def _filter_trace(trace: Trace, predicate: Callable[[Event], bool], removeEmptyTrace: bool,
+                  view: bool) -> List[Trace]:
+    """Filters the events of one trace.  See TraceSet.with_events_filtered.
+
+    Returns:
+        A list of one trace, or no traces if it was emptied and removeEmptyTrace is True.
+    """
+    positions = [pos for (pos, event) in enumerate(trace) if predicate(event)]
+    if removeEmptyTrace and len(positions) == 0 and len(trace) > 0:
+        return []
+    return [_select_events(trace, positions, view)]
+
+
+def _meta_equals(name: str, value: Any, event: Event) -> bool:
+    """The event filter of with_events_filtered."""
+    return event._meta_data.get(name) == value
+
+
+def _event_value(name: str, property: bool, event: Event) -> Any:
+    """The default key of with_traces_grouped_by: an input or meta-data value of event."""
+    if property:
+        return event._meta_data.get(name, None)
+    return event._inputs.get(name, None)
+
+
+def _group_positions(traces: List[Union[Trace, List[Event]]],
+                     key: Callable[[Event], Any]) -> Dict[Any, List[int]]:
+    """Groups the positions of all the events in traces (numbered consecutively) by key.
+
+    Events whose key is None are discarded.  The result is in order of first appearance.
+    (This is a global function so that it can be run in other processes).
+    """
+    groups: Dict[Any, List[int]] = defaultdict(list)
+    pos = 0
+    for tr in traces:
+        for event in tr:
+            value = key(event)
+            if value is not None:
+                groups[value].append(pos)
+            pos += 1
+    return groups
+
+
+def _meta_sort_key(trace: Trace, name: str, pos: int) -> Tuple[bool, Any]:
+    """Sort key for the meta-data value name of trace[pos], with missing values last."""
+    value = trace[pos].meta_data.get(name, None)
+    return (value is None, value)
+
+
+def _error_string(event: Event) -> str:
+    """The error message of event as a string, or "" if it has no error message."""
+    err = event.error_message
+    return "" if err is None else str(err)
+
+
+def _json_column(values: Any) -> np.ndarray:
+    """Encodes values as JSON text, stored as an array of bytes for saving in an npz file."""
+    text = json.dumps(values, cls=TraceEncoder)  # ASCII-only, since ensure_ascii is True.
+    return np.frombuffer(text.encode("ascii"), dtype=np.uint8)
+
+
+def _json_column_values(column: np.ndarray) -> Any:
+    """The inverse of _json_column."""
+    return json.loads(column.tobytes().decode("ascii"))
+
+
+def _json_index_path(file: Path) -> Path:
+    """The sidecar index file for the given JSON traces file."""
+    return file.with_name(file.name + ".index.npz")
+
+
+def _save_json_index(file: Path, starts: np.ndarray, ends: np.ndarray,
+                     header: Dict[str, Any]) -> None:
+    """Saves the positions of all the traces in a JSON traces file into its sidecar index.
+
+    The index records the size and modification time of the JSON file, so that
+    it can be recognised as out of date if the JSON file changes.
+    """
+    stat = file.stat()
+    with _json_index_path(file).open("wb") as output:
+        np.savez(output, starts=starts, ends=ends, header=_json_column(header),
+                 size=np.int64(stat.st_size), mtime_ns=np.int64(stat.st_mtime_ns))
+
+
+_JSON_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+class _JsonStreamReader:
+    """Incrementally parses a large JSON document from a text stream.
+
+    Only the outer objects and arrays are walked explicitly (see keys() and items()).
+    Each inner value is decoded by the standard JSON decoder as soon as all of its
+    text has been read, so memory usage is bounded by the largest single value,
+    rather than by the size of the whole document.
+    """
+
+    def __init__(self, stream, chunk_size: int = 1 << 16):
+        self._stream = stream
+        self._chunk_size = chunk_size
+        self._buffer = ""
+        self._pos = 0      # current position within self._buffer.
+        self._offset = 0   # position of self._buffer[0] within the whole stream.
+        self._eof = False
+        self._decoder = json.JSONDecoder()
+
+    @property
+    def position(self) -> int:
+        """The current position (in characters) within the whole stream."""
+        return self._offset + self._pos
+
+    def _fill(self, size: int) -> bool:
+        """Discards the text already parsed, then reads more text from the stream.
+
+        Returns:
+            False if we are already at the end of the stream.
+        """
+        if self._eof:
+            return False
+        self._offset += self._pos
+        self._buffer = self._buffer[self._pos:]
+        self._pos = 0
+        text = self._stream.read(size)
+        if not text:
+            self._eof = True
+            return False
+        self._buffer += text
+        return True
+
+    def peek(self) -> str:
+        """Skips any whitespace and returns the next character, or "" at end of stream."""
+        while True:
+            self._pos = _JSON_WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill(self._chunk_size):
+                return ""
+
+    def expect(self, chars: str) -> str:
+        """Reads the next non-whitespace character, which must be one of chars."""
+        ch = self.peek()
+        if ch == "" or ch not in chars:
+            raise Exception(f"JSON error at position {self.position}: "
+                            f"expected one of '{chars}' but found '{ch}'.")
+        self._pos += 1
+        return ch
+
+    def value(self) -> Any:
+        """Reads and decodes the next complete JSON value."""
+        self.peek()
+        size = self._chunk_size
+        while True:
+            try:
+                obj, end = self._decoder.raw_decode(self._buffer, self._pos)
+                # a number at the very end of the buffer may not be complete yet.
+                if end < len(self._buffer) or self._eof:
+                    self._pos = end
+                    return obj
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+            # read more text, doubling the buffer each time, so large values parse in linear time.
+            self._fill(size)
+            size = max(size, len(self._buffer))
+
+    def span(self) -> Tuple[int, int]:
+        """Skips over the next complete JSON value, and returns its (start, end) positions."""
+        self.peek()
+        start = self.position
+        self.value()
+        return (start, self.position)
+
+    def items(self, read_item: Callable[[], Any] = None) -> Iterator[Any]:
+        """Decodes the elements of an array one at a time.
+
+        The opening '[' must have been read already.
+
+        Args:
+            read_item: the method used to read each element (default is value()).
+        """
+        if read_item is None:
+            read_item = self.value
+        if self.peek() == "]":
+            self._pos += 1
+            return
+        while True:
+            yield read_item()
+            if self.expect(",]") == "]":
+                return
+
+    def keys(self) -> Iterator[str]:
+        """Reads the keys of an object one at a time.
+
+        The opening '{' must have been read already.  After each key is returned,
+        the caller must read the corresponding value (for example via value() or items()).
+        """
+        if self.peek() == "}":
+            self._pos += 1
+            return
+        while True:
+            key = self.value()
+            if not isinstance(key, str):
+                raise Exception(f"JSON error at position {self.position}: key must be a string.")
+            self.expect(":")
+            yield key
+            if self.expect(",}") == "}":
+                return
+
+
 def xml_decode(obj: ET.Element) -> Union[str, Dict[str, Any]]:
     """Custom XML encoder to decode XML into a Python dictionary suitable for JSON encoding.
 
@@ -929,6 +3521,9 @@ def default_map_to_chars(actions: Set[str], given: Dict[str, str] = None) -> Dic
     """
     names: List[str] = sorted(list(actions))
     result: Dict[str, str] = {} if given is None else given.copy()
+    used = set(result.values())  # so that checking if a char is free is O(1).
+    # the length of the common prefix of each name and the next name.
+    common = [len(os.path.commonprefix([name, nxt])) for (name, nxt) in zip(names, names[1:])]
     # TODO: a better algorithm might be to break up compound words and look for word prefixes?
     curr_prefix = ""
     pass2 = []
@@ -943,42 +3538,43 @@ def default_map_to_chars(actions: Set[str], given: Dict[str, str] = None) -> Dic
             pos = 0
         # check ahead for common prefixes first
         if i + 1 < len(names):
-            nxt = names[i + 1]
-            if nxt.startswith(name) and name[0] not in result.values():
+            # the next name starts with this name if the common prefix is all of this name.
+            if 0 < common[i] == len(name) and name[0] not in used:
                 result[name] = name[0]
+                used.add(name[0])
                 curr_prefix = name
                 continue
-            prefix = max([p for p in range(max(len(name), len(nxt))) if name[0:p] == nxt[0:p]])
-            # print(f"  found prefix {prefix} of {name} and {nxt}")
+            prefix = common[i]
             curr_prefix = name[0:prefix]
         else:
             prefix = 0
             curr_prefix = ""
-        if prefix > 0 and prefix > pos:
+        if prefix > pos:
             pos = prefix
-        done = False
-        for j in range(pos, len(name)):
-            if name[pos] not in result.values():
-                result[name] = name[pos]
-                done = True
-                break
-        if not done:
+        # NOTE: only the first char after the common prefixes is tried in this pass.
+        if pos < len(name) and name[pos] not in used:
+            result[name] = name[pos]
+            used.add(name[pos])
+        else:
             pass2.append(name)
     # Pass 2 (all visible ASCII chars except " and ')
     allchars = "".join([chr(n) for n in range(42, 127)]) + "!#$%&()"
     for name in pass2:
         for ch in name + allchars:
-            if ch not in result.values():
+            if ch not in used:
                 result[name] = ch
+                used.add(ch)
                 break  # move onto next name in pass2
     return result
 
 
 def all_action_names(traces: List[Trace]) -> Set[str]:
-    """Collects all the action names that appear in the given traces."""
+    """Collects all the action names that appear in the given traces (or TraceSet)."""
+    if isinstance(traces, TraceSet):
+        return set(traces.get_columns().actions)
     result = set()
     for tr in traces:
-        for ev in tr.events:
+        for ev in tr:
             action = ev.action
             result.add(action)
     return result
@@ -1019,24 +3615,251 @@ def trace_to_string(trace: List[Event], to_char: Mapping[str, str], compress: Li
     return "".join(chars)
 
 
-def traces_to_pandas(traces: List[Trace]) -> pd.DataFrame:
+def traces_to_pandas(traces: List[Trace], inputs: Union[bool, List[str]] = True,
+                     outputs: Union[bool, List[str]] = False,
+                     meta_keys: List[str] = None) -> pd.DataFrame:
     """Collects all events into a single Pandas DataFrame.
 
-    Columns include the trace number, the event number, the action name, each input parameter,
-    the result status and error message.
+    Columns include the trace number, the event number, the action name,
+    the result status and error message, and each input parameter.
+    The table is built column by column, with 'Action' and 'Error' as 'category' columns
+    and 'Trace', 'Event' and 'Status' as the smallest integer type that fits.
+
+    Args:
+        traces: the traces to convert.
+        inputs: True means one column for each input parameter, False means none,
+            or a list of input names gives just those columns, in that order.
+        outputs: like inputs, but for the output values (other than Status and Error),
+            which are named with an "out_" prefix.  The default is no output columns.
+        meta_keys: an optional list of event meta-data keys, such as ["timestamp"].
+            Each one gives a column named with a "meta_" prefix.
 
     TODO: we could convert complex values to strings before sending to Pandas?
-    TODO: we could have an option to encode strings into integer properties?
     """
-    rows = []
-    for tr_num in range(len(traces)):
-        events = traces[tr_num].events
-        for ev_num in range(len(events)):
-            event = events[ev_num]
-            row = {"Trace": tr_num, "Event": ev_num, "Action": event.action}
-            # we add "Status" and "Error" first, so that those columns come before inputs.
-            row["Status"] = event.status
-            row["Error"] = event.error_message
-            row.update(event.inputs.items())
-            rows.append(row)
-    return pd.DataFrame(rows)
+    return _events_to_pandas(traces, TraceSetColumns(traces), inputs, outputs, meta_keys)
+
+
+def _events_to_pandas(traces: List[Trace], columns: 'TraceSetColumns',
+                      inputs: Union[bool, List[str]], outputs: Union[bool, List[str]],
+                      meta_keys: Optional[List[str]], first_trace: int = 0) -> pd.DataFrame:
+    """Implements traces_to_pandas, given the columnar view of the traces.
+
+    The trace numbers start from first_trace.
+    """
+    num_events = int(columns.offsets[-1])
+    lengths = np.diff(columns.offsets)
+    trace_nums = np.repeat(np.arange(first_trace, first_trace + len(traces)), lengths)
+    event_nums = np.arange(num_events) - np.repeat(columns.offsets[:-1], lengths)
+    errors: Dict[str, int] = {}
+    error_codes = np.array([errors.setdefault(_error_string(ev), len(errors))
+                            for tr in traces for ev in tr], dtype=np.int32)
+    data = {
+        "Trace": _compact_ints(trace_nums),
+        "Event": _compact_ints(event_nums),
+        "Action": pd.Categorical.from_codes(columns.action_codes, columns.actions),
+        "Status": _compact_ints(columns.statuses),
+        "Error": _categorical(error_codes, list(errors)),
+    }
+    for (get_dict, prefix, wanted, skip) in _value_sources(inputs, outputs, meta_keys):
+        # the columns are discovered in one pass, and missing values are NaN.
+        values: Dict[str, List[Any]] = {}
+        if wanted is not True:
+            values = {key: [np.nan] * num_events for key in wanted}
+        i = 0
+        for tr in traces:
+            for ev in tr:
+                for (key, value) in get_dict(ev).items():
+                    col = values.get(key)
+                    if col is None:
+                        if wanted is not True or key in skip:
+                            continue
+                        col = values[key] = [np.nan] * num_events
+                    col[i] = value
+                i += 1
+        for (key, col) in values.items():
+            data[prefix + key] = pd.Series(col, dtype=None if col else object)
+    return pd.DataFrame(data)
+
+
+def _value_sources(inputs: Union[bool, List[str]], outputs: Union[bool, List[str]],
+                   meta_keys: Optional[List[str]]) -> List[Tuple[Callable[[Event], Dict[str, Any]],
+                                                                 str, Any, Tuple[str, ...]]]:
+    """The dictionaries of each event that give the value columns of a to_pandas table.
+
+    Returns:
+        A list of (get_dict, column_prefix, wanted_keys or True for all, keys_to_skip).
+    """
+    sources = []
+    if inputs:
+        sources.append((lambda ev: ev._inputs, "", inputs, ()))
+    if outputs:
+        sources.append((lambda ev: ev._outputs, "out_", outputs, ("Status", "Error")))
+    if meta_keys:
+        sources.append((lambda ev: ev._meta_data, "meta_", meta_keys, ()))
+    return sources
+
+
+def _value_dtype(types: Set[type], count: int, num_events: int) -> Any:
+    """The Pandas type of a to_pandas column with count values of the given types."""
+    if types == {str}:
+        return pd.Series(["", np.nan]).dtype  # object, or a string type in newer Pandas.
+    if types == {int} and count == num_events:
+        return np.int64
+    if types == {bool} and count == num_events:
+        return np.bool_
+    if types <= {int, float}:
+        return np.float64  # with NaN for any missing values.
+    return object
+
+
+def _iter_pandas(get_traces: Callable[[], Iterator[Trace]], chunk_traces: int,
+                 inputs: Union[bool, List[str]] = True, outputs: Union[bool, List[str]] = False,
+                 meta_keys: List[str] = None) -> Iterator[pd.DataFrame]:
+    """Implements iter_pandas, given a function that returns a fresh iterator of the traces.
+
+    The first pass over the traces finds the columns and the types of all the tables.
+    """
+    if chunk_traces < 1:
+        raise Exception(f"chunk_traces must be positive, not {chunk_traces}")
+    scan = _EventScan(get_traces(), inputs, outputs, meta_keys)
+    dtypes = scan.dtypes()
+    # now every chunk can be built with the same list of keys from each source.
+    (inputs, outputs, meta_keys) = scan.keys()
+    traces = get_traces()
+    first_trace = 0
+    while True:
+        chunk = list(itertools.islice(traces, chunk_traces))
+        if not chunk:
+            return
+        table = _events_to_pandas(chunk, TraceSetColumns(chunk), inputs, outputs, meta_keys,
+                                  first_trace=first_trace)
+        yield table.astype(dtypes)
+        first_trace += len(chunk)
+
+
+class _ValueScan:
+    """The types, number and (up to some limit) distinct strings of the values of one key."""
+    __slots__ = ("types", "count", "distinct")
+
+    def __init__(self):
+        self.types: Set[type] = set()
+        self.count = 0
+        self.distinct: Optional[Set[str]] = set()
+
+
+class _EventScan:
+    """One pass over some traces, to find the columns and types of a table of their events.
+
+    This is used to give every chunk of iter_pandas the same schema, and by save_to_arff.
+    """
+
+    def __init__(self, traces: Iterator[Trace], inputs: Union[bool, List[str]],
+                 outputs: Union[bool, List[str]], meta_keys: Optional[List[str]],
+                 max_distinct: int = -1):
+        """Scans the traces.
+
+        Args:
+            traces: the traces to scan.
+            inputs, outputs, meta_keys: the value columns, as for traces_to_pandas.
+            max_distinct: the distinct values of each key are recorded as strings,
+                until there are more than this many (-1 means do not record them).
+        """
+        self.sources = _value_sources(inputs, outputs, meta_keys)
+        # for each source, a _ValueScan for each key, in order of appearance.
+        self.values: List[Dict[str, _ValueScan]] = []
+        for (get_dict, prefix, wanted, skip) in self.sources:
+            self.values.append({} if wanted is True else {key: _ValueScan() for key in wanted})
+        self.actions: Set[str] = set()
+        self.errors: Set[str] = set()
+        (self.num_traces, self.num_events, self.max_length) = (0, 0, 0)
+        (self.low_status, self.high_status) = (0, 0)
+        for tr in traces:
+            self.num_traces += 1
+            self.num_events += len(tr)
+            self.max_length = max(self.max_length, len(tr))
+            for ev in tr:
+                self.actions.add(ev.action)
+                self.errors.add(_error_string(ev))
+                status = ev.status
+                self.low_status = min(self.low_status, status)
+                self.high_status = max(self.high_status, status)
+                for ((get_dict, prefix, wanted, skip), found) in zip(self.sources, self.values):
+                    for (key, value) in get_dict(ev).items():
+                        info = found.get(key)
+                        if info is None:
+                            if wanted is not True or key in skip:
+                                continue
+                            info = found[key] = _ValueScan()
+                        info.types.add(type(value))
+                        info.count += 1
+                        if info.distinct is not None:
+                            info.distinct.add(str(value))
+                            if len(info.distinct) > max_distinct:
+                                info.distinct = None
+
+    def keys(self) -> Tuple[Union[bool, List[str]], Union[bool, List[str]], Optional[List[str]]]:
+        """The (inputs, outputs, meta_keys) arguments that give exactly the scanned columns."""
+        keys: List[Any] = [False, False, None]
+        for ((get_dict, prefix, wanted, skip), found) in zip(self.sources, self.values):
+            keys[["", "out_", "meta_"].index(prefix)] = list(found)
+        return cast(Tuple[Any, Any, Any], tuple(keys))
+
+    def value_columns(self) -> Iterator[Tuple[str, _ValueScan]]:
+        """Yields the name and the scan of each value column, in table order."""
+        for ((get_dict, prefix, wanted, skip), found) in zip(self.sources, self.values):
+            for (key, info) in found.items():
+                yield (prefix + key, info)
+
+    def dtypes(self) -> Dict[str, Any]:
+        """The Pandas type of each column of the table."""
+        dtypes = {
+            "Trace": _compact_ints(np.array([0, self.num_traces - 1])).dtype,
+            "Event": _compact_ints(np.array([0, self.max_length - 1])).dtype,
+            "Action": pd.CategoricalDtype(sorted(self.actions)),
+            "Status": _compact_ints(np.array([self.low_status, self.high_status])).dtype,
+            "Error": pd.CategoricalDtype(sorted(self.errors)),
+        }
+        for (name, info) in self.value_columns():
+            dtypes[name] = _value_dtype(info.types, info.count, self.num_events)
+        return dtypes
+
+
+_ARFF_SPECIAL = re.compile(r"[\s\"'\\%,{}?\x00-\x1f]")
+"""Characters that must be quoted in ARFF names and values."""
+
+_ARFF_ESCAPES = {i: f"\\{i:03o}" for i in range(32)}
+_ARFF_ESCAPES.update({ord("\\"): "\\\\", ord("'"): "\\'", ord("\n"): "\\n", ord("\r"): "\\r",
+                      ord("\t"): "\\t"})
+
+
+def _arff_quote(value: str) -> str:
+    """Quotes a name or string value for an ARFF file, if necessary."""
+    if value and not _ARFF_SPECIAL.search(value):
+        return value
+    return "'" + value.translate(_ARFF_ESCAPES) + "'"
+
+
+def _arff_value(value: Any, numeric: bool) -> str:
+    """Formats one value of a NUMERIC column, or of a STRING or NOMINAL column, for ARFF."""
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return "?"
+    return str(value) if numeric else _arff_quote(str(value))
+
+
+def _compact_ints(values: np.ndarray) -> np.ndarray:
+    """Converts an array of integers to the smallest signed integer type that holds them."""
+    if len(values) == 0:
+        return values.astype(np.int8)
+    (low, high) = (int(values.min()), int(values.max()))
+    for dtype in [np.int8, np.int16, np.int32]:
+        if np.iinfo(dtype).min <= low and high <= np.iinfo(dtype).max:
+            return values.astype(dtype)
+    return values.astype(np.int64)
+
+
+def _categorical(codes: np.ndarray, values: List[str]) -> pd.Categorical:
+    """Makes a Pandas categorical column, with sorted categories, from codes into values."""
+    categories = sorted(values)
+    position = {value: i for (i, value) in enumerate(categories)}
+    renumber = np.array([position[value] for value in values] + [0], dtype=np.int32)
+    return pd.Categorical.from_codes(renumber[codes], categories)
@@ -193,7 +193,8 @@ class RandomTester:
         meta["method_signatures"] = {}  # see add_web_service
         meta["action_chars"] = action_chars
         new_trace = Trace([], random_state=self.random.getstate())
-        self.curr_events = new_trace.events  # mutable list to append to.
+        self.curr_trace = new_trace  # append events via the trace, so its caches are updated.
+        self.curr_events = new_trace.events
         self.trace_set = TraceSet([], meta)
         self.trace_set.append(new_trace)
         for w in self.urls:
@@ -337,7 +338,7 @@ class RandomTester:
             raw_out = getattr(client.service, name)(*args_list)
             out = self.decode_outputs(raw_out)
         event = Event(name, args, out, meta_data=meta_data)
-        self.curr_events.append(event)
+        self.curr_trace.append(event)
         if self.verbose:
             print(f"      -> {self.summary(event.outputs)}")
         return event
@@ -356,7 +357,8 @@ class RandomTester:
         if start:
             if len(self.curr_events) > 0:
                 new_trace = Trace([], random_state=self.random.getstate())
-                self.curr_events = new_trace.events  # mutable list to append to.
+                self.curr_trace = new_trace
+                self.curr_events = new_trace.events
                 self.trace_set.append(new_trace)
         if methods is None:
             methods = self.methods_allowed
@@ -437,7 +439,7 @@ class TracePrefixExtractor(sklearn.base.BaseEstimator, sklearn.base.TransformerM
         if isinstance(X, TraceSet):
             for tr in X.traces:
                 for size in range(len(tr) + 1):  # every prefix, plus the whole trace.
-                    events = tr.events[0:size]
+                    events = tr[0:size]
                     features = self.get_prefix_features(events)
                     action = tr[size].action if size < len(tr) else TRACE_END
                     data.append(features)
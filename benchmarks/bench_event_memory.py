@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+Measure the memory used per Event after loading a traces file.
+
+It uses the given traces file, or else a synthetic set of traces: either the
+mixed traces of bench_json_backends.py, or action-only traces whose events have
+empty inputs, outputs and meta data.  It reports the bytes per event for:
+
+  * legacy: the old Event class, which had a __dict__ and no interned action names;
+  * slots: a normal load, using the current Event class with __slots__;
+  * compact: a normal load followed by TraceSet.compact (shared EMPTY_DATA).
+"""
+
+import argparse
+import gc
+import json
+import random
+import tempfile
+import tracemalloc
+from pathlib import Path
+from typing import Any, Dict, List
+
+import agilkia
+from bench_json_backends import make_traces
+
+
+class LegacyEvent:
+    """A copy of the Event class before it used __slots__, as a baseline."""
+
+    def __init__(self, action: str, inputs: Dict[str, Any], outputs: Dict[str, Any],
+                 meta_data: Dict[str, Any] = None):
+        self.action = action
+        self.inputs = inputs
+        self.outputs = outputs
+        self.meta_data = {} if meta_data is None else meta_data.copy()
+
+
+def load_legacy(file: Path) -> List[List[LegacyEvent]]:
+    """Loads the events of file into LegacyEvent objects, one list per trace.
+
+    Nested objects (with a "__class__" key) are left as plain dictionaries.
+    """
+    with file.open("r") as input:
+        data = json.load(input)
+    if isinstance(data, list):
+        ev_lists = data  # pre-TraceSet files are just a list of lists of events.
+    else:
+        ev_lists = [tr["events"] for tr in data["traces"]]
+    return [[LegacyEvent(ev["action"], ev["inputs"], ev["outputs"], ev.get("meta_data"))
+             for ev in ev_list]
+            for ev_list in ev_lists]
+
+
+def make_empty_traces(num_traces: int, length: int, seed: int = 1) -> agilkia.TraceSet:
+    """Generates a synthetic TraceSet whose events have only an action name."""
+    rand = random.Random(seed)
+    actions = [f"Action{n}" for n in range(20)]
+    traces = agilkia.TraceSet([], {"date": "2020-01-01", "dataset": "benchmark"})
+    for t in range(num_traces):
+        traces.append(agilkia.Trace([agilkia.Event(rand.choice(actions), {}, {})
+                                     for e in range(length)]))
+    return traces
+
+
+def measure(file: Path, mode: str, copies: int) -> float:
+    """Loads file (copies times) and returns the number of bytes allocated per event."""
+    gc.collect()
+    tracemalloc.start()
+    loaded = []
+    for i in range(copies):
+        if mode == "legacy":
+            loaded.append(load_legacy(file))
+            continue
+        traces = agilkia.TraceSet.load_from_json(file)
+        if mode == "compact":
+            traces.compact()
+        loaded.append(traces)
+    gc.collect()
+    (current, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    num_events = sum(len(tr) for traces in loaded for tr in traces)
+    return current / num_events
+
+
+def main():
+    """Prints the bytes per event for the legacy Event class, a normal load and a compact load."""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-n", "--traces", type=int, default=1000, help="number of TRACES")
+    parser.add_argument("-l", "--length", type=int, default=50, help="LENGTH of each trace")
+    parser.add_argument("-c", "--copies", type=int, default=1,
+                        help="load the file this many times (useful for tiny files)")
+    parser.add_argument("-f", "--fixture", choices=["mixed", "empty", "both"], default="both",
+                        help="which synthetic traces to use, if no file is given")
+    parser.add_argument("file", nargs="?", help="optional traces file (*.json)")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        files = []
+        if args.file:
+            files.append((args.file, Path(args.file)))
+        else:
+            makers = {"mixed": make_traces, "empty": make_empty_traces}
+            for (name, make) in makers.items():
+                if args.fixture in (name, "both"):
+                    file = Path(tmp_dir) / f"bench_{name}.json"
+                    make(args.traces, args.length).save_to_json(file)
+                    files.append((name, file))
+        for (name, file) in files:
+            print(f"{name}:")
+            for mode in ["legacy", "slots", "compact"]:
+                per_event = measure(file, mode, args.copies)
+                print(f"  {mode:8s} {per_event:8.1f} bytes/event")
+
+
+if __name__ == "__main__":
+    main()
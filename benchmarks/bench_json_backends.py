@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark the load and save throughput of each installed JSON backend.
+
+It uses the given traces file, or else generates a synthetic set of traces.
+"""
+
+import argparse
+import random
+import tempfile
+import time
+from pathlib import Path
+
+import agilkia
+
+
+def make_traces(num_traces: int, length: int, seed: int = 1) -> agilkia.TraceSet:
+    """Generates a synthetic TraceSet with a mixture of input and output values."""
+    rand = random.Random(seed)
+    actions = [f"Action{n}" for n in range(20)]
+    traces = agilkia.TraceSet([], {"date": "2020-01-01", "dataset": "benchmark"})
+    for t in range(num_traces):
+        events = []
+        for e in range(length):
+            inputs = {"user": f"user{t}", "amount": rand.random() * 100, "count": e}
+            outputs = {"Status": rand.choice([0, 0, 0, 1]), "Error": "", "Balance": t * 1.5}
+            meta = {"timestamp": f"2020-01-01T10:{e % 60:02d}:00"}
+            events.append(agilkia.Event(rand.choice(actions), inputs, outputs, meta))
+        traces.append(agilkia.Trace(events))
+    return traces
+
+
+def main():
+    """Times save_to_json and load_from_json with each installed JSON backend."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--traces", type=int, default=2000, help="number of TRACES")
+    parser.add_argument("-l", "--length", type=int, default=50, help="LENGTH of each trace")
+    parser.add_argument("-r", "--repeats", type=int, default=3, help="REPEATS of each timing")
+    parser.add_argument("file", nargs="?", help="optional traces file (*.json)")
+    args = parser.parse_args()
+    if args.file:
+        traces = agilkia.TraceSet.load_from_json(Path(args.file))
+    else:
+        traces = make_traces(args.traces, args.length)
+    num_events = sum(len(tr) for tr in traces)
+    print(f"{len(traces)} traces, {num_events} events.")
+    print(f"{'backend':10s} {'indent':>6s} {'MB':>8s} {'save MB/s':>10s} {'load MB/s':>10s}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_json = Path(tmp_dir) / "bench.json"
+        for name in agilkia.JSON_BACKENDS:
+            try:
+                agilkia.get_json_backend(name)
+            except ImportError:
+                print(f"{name:10s} (not installed)")
+                continue
+            for indent in [2, None]:
+                save_time = min(timed(lambda: traces.save_to_json(tmp_json, indent=indent,
+                                                                  backend=name))
+                                for i in range(args.repeats))
+                load_time = min(timed(lambda: agilkia.TraceSet.load_from_json(tmp_json,
+                                                                              backend=name))
+                                for i in range(args.repeats))
+                mb = tmp_json.stat().st_size / 1e6
+                print(f"{name:10s} {str(indent):>6s} {mb:8.1f} "
+                      f"{mb / save_time:10.1f} {mb / load_time:10.1f}")
+
+
+def timed(action) -> float:
+    """Returns the time in seconds taken to do action()."""
+    start = time.perf_counter()
+    action()
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    main()
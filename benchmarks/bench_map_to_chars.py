@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Measure the time taken by default_map_to_chars for a large set of action names.
+
+It generates synthetic web-service style operation names (many sharing
+prefixes, like getOrder, getOrderStatus, ...), times default_map_to_chars,
+and checks that it gives exactly the same mapping as the original algorithm.
+"""
+
+import argparse
+import random
+from typing import Dict, List, Set
+
+import agilkia
+from bench_json_backends import timed
+
+
+def make_names(num_names: int, seed: int = 1) -> Set[str]:
+    """Generates num_names distinct action names, with lots of common prefixes."""
+    rand = random.Random(seed)
+    verbs = ["get", "set", "add", "remove", "list", "find", "update", "Create", "Delete", "Pay"]
+    nouns = ["Order", "Item", "Customer", "Account", "Invoice", "Payment", "Product", "User",
+             "Address", "Cart", "Session", "Token", "Report", "Stock", "Price", "Tax"]
+    suffixes = ["", "s", "Status", "Details", "ById", "ByName", "History", "V2", "Async"]
+    names: Set[str] = set()
+    while len(names) < num_names:
+        name = rand.choice(verbs) + rand.choice(nouns) + rand.choice(suffixes)
+        if name in names:
+            name += str(rand.randrange(1000))
+        names.add(name)
+    return names
+
+
+def original_map_to_chars(actions: Set[str], given: Dict[str, str] = None) -> Dict[str, str]:
+    """The original algorithm, which searches result.values() for every candidate char."""
+    names: List[str] = sorted(list(actions))
+    result: Dict[str, str] = {} if given is None else given.copy()
+    curr_prefix = ""
+    pass2 = []
+    for i in range(len(names)):
+        name = names[i]
+        if name in result:
+            continue  # given
+        if name.startswith(curr_prefix):
+            pos = len(curr_prefix)
+        else:
+            pos = 0
+        if i + 1 < len(names):
+            nxt = names[i + 1]
+            if nxt.startswith(name) and name[0] not in result.values():
+                result[name] = name[0]
+                curr_prefix = name
+                continue
+            prefix = max([p for p in range(max(len(name), len(nxt))) if name[0:p] == nxt[0:p]])
+            curr_prefix = name[0:prefix]
+        else:
+            prefix = 0
+            curr_prefix = ""
+        if prefix > 0 and prefix > pos:
+            pos = prefix
+        done = False
+        for j in range(pos, len(name)):
+            if name[pos] not in result.values():
+                result[name] = name[pos]
+                done = True
+                break
+        if not done:
+            pass2.append(name)
+    allchars = "".join([chr(n) for n in range(42, 127)]) + "!#$%&()"
+    for name in pass2:
+        for ch in name + allchars:
+            if ch not in result.values():
+                result[name] = ch
+                break
+    return result
+
+
+def main():
+    """Prints the time taken by the original and current algorithms."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--names", type=int, default=1000, help="number of action NAMES")
+    parser.add_argument("-r", "--repeats", type=int, default=3, help="REPEATS of each timing")
+    args = parser.parse_args()
+    names = make_names(args.names)
+    given = {sorted(names)[0]: "."}
+    for (label, algorithm) in [("original", original_map_to_chars),
+                               ("current", agilkia.default_map_to_chars)]:
+        seconds = min(timed(lambda: algorithm(names, given)) for i in range(args.repeats))
+        print(f"{label:10s} {seconds * 1000:10.2f} msecs")
+    same = original_map_to_chars(names, given) == agilkia.default_map_to_chars(names, given)
+    print(f"same mapping: {same}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+Measure the time and memory of TraceSet.to_pandas.
+
+It uses the given traces file, or else a synthetic set of traces
+(see bench_json_backends.py), and compares to_pandas with the old
+algorithm that built one dictionary per event.
+"""
+
+import argparse
+from pathlib import Path
+
+import pandas as pd
+
+import agilkia
+from bench_json_backends import make_traces, timed
+
+
+def rows_to_pandas(traces: agilkia.TraceSet) -> pd.DataFrame:
+    """The old to_pandas algorithm, which builds a dictionary for each event."""
+    rows = []
+    for tr_num in range(len(traces)):
+        for (ev_num, event) in enumerate(traces[tr_num]):
+            row = {"Trace": tr_num, "Event": ev_num, "Action": event.action}
+            row["Status"] = event.status
+            row["Error"] = event.error_message
+            row.update(event.inputs.items())
+            rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def main():
+    """Prints the time and the table size for each to_pandas algorithm."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--traces", type=int, default=2000, help="number of TRACES")
+    parser.add_argument("-l", "--length", type=int, default=50, help="LENGTH of each trace")
+    parser.add_argument("-r", "--repeats", type=int, default=3, help="REPEATS of each timing")
+    parser.add_argument("file", nargs="?", help="optional traces file (*.json)")
+    args = parser.parse_args()
+    if args.file:
+        traces = agilkia.TraceSet.load_from_json(Path(args.file))
+    else:
+        traces = make_traces(args.traces, args.length)
+    traces.get_columns()  # built once and cached, like the traces themselves.
+    print(f"{len(traces)} traces, {sum(len(tr) for tr in traces)} events.")
+    algorithms = [
+        ("rows", lambda: rows_to_pandas(traces)),
+        ("to_pandas", traces.to_pandas),
+        ("no inputs", lambda: traces.to_pandas(inputs=False)),
+        ]
+    for (name, algorithm) in algorithms:
+        seconds = min(timed(algorithm) for i in range(args.repeats))
+        mb = algorithm().memory_usage(deep=True).sum() / 1e6
+        print(f"{name:10s} {seconds:8.3f} secs {mb:8.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
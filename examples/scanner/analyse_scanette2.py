@@ -135,9 +135,9 @@ normalizer = MinMaxScaler()
 num_clusters = traceset3.create_clusters(data, algorithm=clusterer, normalizer=normalizer)
 print(num_clusters, "clusters found - see clusters_out.txt")
 with Path("clusters_out.txt").open("w") as out:
-    for i in range(num_clusters):
+    for (i, cluster) in traceset3.iter_clusters():
         out.write(f"Cluster {i}:\n")
-        for tr in traceset3.get_cluster(i):
+        for tr in cluster:
             out.write(f"    {tr}\n")
 
 # %% Visualize the coverage of each cluster (the better is to have non-overlapping coverage)
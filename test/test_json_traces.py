@@ -7,12 +7,20 @@ Test JSON saving and loading.
 
 import agilkia
 import jsonpickle     # type: ignore
+import io
 import json
+import pickle
 import decimal
+import math
 import datetime
+import shutil
+import tempfile
 import xml.etree.ElementTree as ET
 from pathlib import Path
 import pandas as pd   # type: ignore
+import numpy as np    # type: ignore
+import scipy.sparse   # type: ignore
+import sklearn.cluster  # type: ignore
 import numpy.testing as nptest
 import unittest
 import pytest         # type: ignore
@@ -147,6 +155,254 @@ class TestJsonTraces(unittest.TestCase):
         # if all went well, we can delete the temp file now.
         tmp2_json.unlink()
 
+    def test_streaming_load(self):
+        """Test that streaming loads give the same traces as normal loads."""
+        data1 = agilkia.TraceSet.load_from_json(THIS_DIR / "fixtures/traces1.json")
+        data2 = agilkia.TraceSet.load_from_json(THIS_DIR / "fixtures/traces1.json",
+                                                streaming=True)
+        self.assertEqual(data1.meta_data["source"], data2.meta_data["source"])
+        self.assertEqual(len(data1), len(data2))
+        tmp_json = Path("tmp_stream.json")
+        data1.save_to_json(tmp_json)
+        header = {}
+        traces = list(agilkia.TraceSet.iter_traces_from_json(tmp_json, header))
+        self.assertEqual(agilkia.TRACE_SET_VERSION, header["version"])
+        self.assertEqual(data1.meta_data, header["meta_data"])
+        data3 = agilkia.TraceSet.load_from_json(tmp_json, streaming=True)
+        self.assertEqual(data1.meta_data, data3.meta_data)
+        for (tr1, tr2, tr3) in zip(data1, traces, data3):
+            self.assertIs(data3, tr3.trace_set())
+            self.assertEqual([ev.action for ev in tr1], [ev.action for ev in tr2])
+            self.assertEqual([ev.inputs for ev in tr1], [ev.inputs for ev in tr3])
+            self.assertEqual([ev.outputs for ev in tr1], [ev.outputs for ev in tr3])
+        tmp_json.unlink()
+
+    def test_writer(self):
+        """Test that incrementally written traces can be loaded, even if unfinished."""
+        ev1 = agilkia.Event("Order", {"Name": "Mark"}, {"Status": 0}, {"n": "a\nb"})
+        ev2 = agilkia.Event("Pay", {"Amount": decimal.Decimal(3.5)}, {"Status": 1})
+        meta = {"date": "2020-01-01", "dataset": "writer"}
+        tmp_json = Path("tmp_writer.json")
+        for indent in [2, None]:
+            with agilkia.TraceSetWriter(tmp_json, meta, indent=indent) as writer:
+                writer.write(agilkia.Trace([ev1, ev2]))
+                writer.write(agilkia.Trace([ev2], meta_data={"id": 2}))
+            self.assertEqual(2, writer.count)
+            for streaming in [False, True]:
+                traces = agilkia.TraceSet.load_from_json(tmp_json, streaming=streaming)
+                self.assertEqual(meta, traces.meta_data)
+                self.assertEqual(2, len(traces))
+                self.assertEqual("a\nb", traces[0][0].meta_data["n"])
+                self.assertEqual(3.5, traces[0][1].inputs["Amount"])
+                self.assertEqual({"id": 2}, traces[1].meta_data)
+        # an unfinished file still gives the traces written so far.
+        writer = agilkia.TraceSetWriter(tmp_json, meta, flush=True)
+        writer.write(agilkia.Trace([ev1]))
+        recovered = []
+        with self.assertRaises(Exception):
+            for tr in agilkia.TraceSet.iter_traces_from_json(tmp_json):
+                recovered.append(tr)
+        self.assertEqual(1, len(recovered))
+        writer.close()
+        tmp_json.unlink()
+
+    def test_json_backends(self):
+        """Test that every installed JSON backend saves and loads the same contents."""
+        inputs = {"d": decimal.Decimal(3.4500048012), "s": {1, 2}, "b": b"x", "n": "Zoë",
+                  "t": datetime.datetime(2019, 9, 17, hour=18, minute=58), "obj": Dummy()}
+        traces = agilkia.TraceSet([], {"date": "2020-01-01", "dataset": "backends"})
+        traces.append(agilkia.Trace([agilkia.Event("Order", inputs, {"Status": 0})]))
+        traces.append(agilkia.Trace([agilkia.Event("Order", {}, {"Big": 2 ** 70})]))
+        tmp_json = Path("tmp_backend.json")
+        traces.save_to_json(tmp_json, backend="json")
+        expect = json.loads(tmp_json.read_text())
+        self.assertEqual(3.450005, expect["traces"][0]["events"][0]["inputs"]["d"])
+        for name in agilkia.JSON_BACKENDS:
+            try:
+                agilkia.get_json_backend(name)
+            except ImportError:
+                continue  # not installed
+            for indent in [2, None]:
+                traces.save_to_json(tmp_json, indent=indent, backend=name)
+                self.assertEqual(expect, json.loads(tmp_json.read_text(encoding="utf-8")))
+                traces2 = agilkia.TraceSet.load_from_json(tmp_json, backend=name)
+                self.assertEqual("Zoë", traces2[0][0].inputs["n"])
+        # NaN and Infinity are written (and read) the same as the json module does.
+        traces3 = agilkia.TraceSet([], {"date": "2020-01-01", "dataset": "backends"})
+        inputs = {"nan": float("nan"), "inf": float("-inf"), "none": None}
+        traces3.append(agilkia.Trace([agilkia.Event("Order", inputs, {"Status": 0})]))
+        traces3.save_to_json(tmp_json, backend="json")
+        expect_text = tmp_json.read_text()
+        for name in agilkia.JSON_BACKENDS:
+            try:
+                agilkia.get_json_backend(name)
+            except ImportError:
+                continue  # not installed
+            traces3.save_to_json(tmp_json, backend=name)
+            self.assertEqual(expect_text, tmp_json.read_text())
+            inputs = agilkia.TraceSet.load_from_json(tmp_json, backend=name)[0][0].inputs
+            self.assertTrue(math.isnan(inputs["nan"]))
+            self.assertEqual([float("-inf"), None], [inputs["inf"], inputs["none"]])
+        with self.assertRaises(Exception):
+            agilkia.get_json_backend("unknown")
+        tmp_json.unlink()
+
+    def test_load_many(self):
+        """Test loading and merging several files, in parallel and sequentially."""
+        files = [Path(f"tmp_many{i}.json") for i in range(3)]
+        for (i, file) in enumerate(files):
+            meta = {"date": "2020-01-01", "dataset": "many", "host": f"host{i}"}
+            traces = agilkia.TraceSet([], meta)
+            for j in range(i + 1):
+                traces.append(agilkia.Trace([agilkia.Event(f"A{i}", {"j": j}, {})]))
+            traces.save_to_json(file)
+        for workers in [1, 2]:
+            merged = agilkia.TraceSet.load_many(files, workers=workers)
+            self.assertEqual(6, len(merged))
+            self.assertEqual(["A0", "A1", "A1", "A2", "A2", "A2"], [tr[0].action for tr in merged])
+            self.assertEqual(str(files[1]), merged[2].meta_data["source_file"])
+            self.assertTrue(all(tr.trace_set() is merged for tr in merged))
+            self.assertEqual("many", merged.meta_data["dataset"])
+            self.assertEqual("2020-01-01", merged.meta_data["date"])
+            self.assertNotIn("host", merged.meta_data)
+            self.assertEqual([str(f) for f in files], merged.meta_data["source_files"])
+        merged = agilkia.TraceSet.load_many(files[0:1], meta_data={"dataset": "given"})
+        self.assertEqual({"dataset": "given", "source_files": [str(files[0])]},
+                         merged.meta_data)
+        for file in files:
+            file.unlink()
+
+    def test_compressed(self):
+        """Test saving and loading compressed JSON files."""
+        traces = agilkia.TraceSet.load_from_json(THIS_DIR / "fixtures/traces1.json")
+        expect = [ev.outputs for ev in traces[0]]
+        for suffix in agilkia.COMPRESSION_SUFFIXES:
+            tmp_json = Path("tmp_compressed.json" + suffix)
+            try:
+                traces.save_to_json(tmp_json, compress_level=1)
+            except ImportError:
+                continue  # that compression library is not installed.
+            self.assertNotEqual(b"{", tmp_json.read_bytes()[0:1])
+            for streaming in [False, True]:
+                traces2 = agilkia.TraceSet.load_from_json(tmp_json, streaming=streaming)
+                self.assertEqual(traces.meta_data, traces2.meta_data)
+                self.assertEqual(expect, [ev.outputs for ev in traces2[0]])
+            with self.assertRaises(Exception):
+                agilkia.TraceSet.load_trace(tmp_json, 0)
+            tmp_json.unlink()
+
+    def test_load_traces_index(self):
+        """Test loading individual traces, using saved and lazily-built indexes."""
+        traces = agilkia.TraceSet([], {"date": "2020-01-01", "dataset": "index"})
+        for i in range(5):
+            ev = agilkia.Event("Act" + str(i), {"Name": "Zoë" * i}, {"Status": i})
+            traces.append(agilkia.Trace([ev] * i, meta_data={"id": i}))
+        tmp_json = Path("tmp_index.json")
+        index = Path("tmp_index.json.index.npz")
+        traces.save_to_json(tmp_json, index=True)
+        self.assertTrue(index.exists())
+        tr = agilkia.TraceSet.load_trace(tmp_json, 3)
+        self.assertEqual({"id": 3}, tr.meta_data)
+        self.assertEqual("ZoëZoëZoë", tr[0].inputs["Name"])
+        self.assertEqual(traces.meta_data, tr.trace_set().meta_data)
+        # the file changes, so the index should be rebuilt (lazily).
+        traces.save_to_json(tmp_json, indent=None)
+        subset = agilkia.TraceSet.load_traces(tmp_json, [4, 0, -1])
+        self.assertEqual([4, 0, 4], [tr.meta_data["id"] for tr in subset])
+        self.assertEqual([4, 0, 4], [len(tr) for tr in subset])
+        self.assertEqual("Act4", subset[0][3].action)
+        with self.assertRaises(IndexError):
+            agilkia.TraceSet.load_traces(tmp_json, [5])
+        with self.assertRaises(IndexError):
+            agilkia.TraceSet.load_traces(tmp_json, [-6])
+        # non-ASCII meta data survives both rebuilding the index and reading it back.
+        traces.meta_data["dataset"] = "Zoë café"
+        for name in agilkia.JSON_BACKENDS:
+            try:
+                agilkia.get_json_backend(name)
+            except ImportError:
+                continue  # not installed
+            traces.save_to_json(tmp_json, backend=name)
+            for i in range(2):
+                tr = agilkia.TraceSet.load_trace(tmp_json, 1)
+                self.assertEqual("Zoë café", tr.trace_set().meta_data["dataset"])
+        tmp_json.unlink()
+        index.unlink()
+        # and it works for old-format files too (copied, so the index is not left in fixtures).
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            old_json = Path(tmp_dir) / "traces1.json"
+            shutil.copy(THIS_DIR / "fixtures/traces1.json", old_json)
+            old = agilkia.TraceSet.load_traces(old_json, [0])
+            self.assertEqual(4, len(old[0]))
+            self.assertTrue(Path(tmp_dir, "traces1.json.index.npz").exists())
+
+    def test_columnar_round_trip(self):
+        """Test that the columnar format stores exactly the same data as the JSON format."""
+        ev1 = agilkia.Event("Order", {"Name": "Mark"}, {"Status": 0, "Error": None}, {"n": 1})
+        ev2 = agilkia.Event("Pay", {"Amount": decimal.Decimal(3.5)}, {"Status": 2, "Error": "No"})
+        traces = agilkia.TraceSet.load_from_json(THIS_DIR / "fixtures/traces1.json")
+        traces.append(agilkia.Trace([]))
+        traces.append(agilkia.Trace([ev2, ev1, ev2], meta_data={"id": 2}))
+        tmp_json = Path("tmp_col.json")
+        tmp_npz = Path("tmp_col.npz")
+        traces.save_to_json(tmp_json)
+        traces.save_to_columnar(tmp_npz)
+        expect = json.loads(tmp_json.read_text())
+        traces2 = agilkia.TraceSet.load_from_columnar(tmp_npz)
+        traces2.save_to_json(tmp_json)
+        self.assertEqual(expect, json.loads(tmp_json.read_text()))
+        # now load just some of the columns
+        traces3 = agilkia.TraceSet.load_from_columnar(tmp_npz, columns=["status", "error"])
+        self.assertEqual([4, 0, 3], [len(tr) for tr in traces3])
+        self.assertEqual({"id": 2}, traces3[2].meta_data)
+        self.assertEqual({}, traces3[2][0].inputs)
+        self.assertEqual({"Status": 2, "Error": "No"}, traces3[2][0].outputs)
+        self.assertEqual({"Status": 0}, traces3[2][1].outputs)
+        self.assertEqual(["Pay", "Order", "Pay"], [ev.action for ev in traces3[2]])
+        with self.assertRaises(Exception):
+            agilkia.TraceSet.load_from_columnar(tmp_npz, columns=["Action"])
+        tmp_json.unlink()
+        tmp_npz.unlink()
+
+    def test_stream_reader(self):
+        """Test the incremental JSON reader with a tiny buffer, so values span many reads."""
+        text = '{"a": [1, 23456, {"b": "x y"}, [], 7.5], "c": {}, "d": -123} '
+        reader = agilkia.json_traces._JsonStreamReader(io.StringIO(text), chunk_size=3)
+        reader.expect("{")
+        result = {}
+        for key in reader.keys():
+            if key == "a":
+                self.assertEqual("[", reader.expect("["))
+                result[key] = list(reader.items())
+            else:
+                result[key] = reader.value()
+        self.assertEqual(json.loads(text), result)
+        self.assertEqual("", reader.peek())
+
+    def test_compact_load(self):
+        traces = agilkia.TraceSet.load_from_json(THIS_DIR / "fixtures/traces1.json")
+        tmp_json = Path("tmp_compact.json")
+        tmp2_json = Path("tmp_compact2.json")
+        for ev in traces[0]:
+            ev.meta_data = {}
+        traces.save_to_json(tmp_json)
+        try:
+            for streaming in [False, True]:
+                compact = agilkia.TraceSet.load_from_json(tmp_json, streaming=streaming,
+                                                          compact=True)
+                self.assertIs(agilkia.EMPTY_DATA, compact[0][0]._meta_data)
+                self.assertEqual(traces.to_pandas().shape, compact.to_pandas().shape)
+                self.assertEqual(str(traces[0]), str(compact[0]))
+                compact[0][0].meta_data["timestamp"] = "2020-01-01"
+                self.assertIs(agilkia.EMPTY_DATA, compact[0][1]._meta_data)
+                compact.save_to_json(tmp2_json)
+                loaded = agilkia.TraceSet.load_from_json(tmp2_json)
+                self.assertEqual(len(traces), len(loaded))
+                self.assertEqual({"timestamp": "2020-01-01"}, loaded[0][0].meta_data)
+        finally:
+            tmp_json.unlink()
+            tmp2_json.unlink()
+
     def test_pickled_round_trip(self):
         """Loads some pickled zeep objects and checks that they save/load okay."""
         pickled = THIS_DIR / "fixtures/traces_pickled.json"
@@ -196,6 +452,45 @@ class TestEvent(unittest.TestCase):
     def test_str(self):
         self.assertEqual("Event(Order, {'Name': 'Other'}, {})", str(self.ev2))
 
+    def test_slots(self):
+        ev = agilkia.Event("Ord" + "er".lower(), {}, {"Status": 0})
+        self.assertFalse(hasattr(ev, "__dict__"))
+        self.assertIs(self.ev1.action, ev.action)  # interned
+
+    def test_compact(self):
+        ev = agilkia.Event("Order", {"Name": "Mark"}, {}, {})
+        ev.compact()
+        self.assertEqual({"Name": "Mark"}, ev.inputs)
+        self.assertIs(agilkia.EMPTY_DATA, ev._outputs)
+        self.assertIs(agilkia.EMPTY_DATA, ev._meta_data)
+        self.assertEqual({}, ev.outputs)
+        self.assertEqual(0, ev.status)
+        self.assertEqual("", ev.error_message)
+        self.assertEqual("Event(Order, {'Name': 'Mark'}, {})", str(ev))
+        # compacted events can still be updated in place.
+        ev.meta_data["timestamp"] = "2020-01-01"
+        ev.meta_data.update(n=1)
+        self.assertEqual({"timestamp": "2020-01-01", "n": 1}, ev.meta_data)
+        self.assertIs(agilkia.EMPTY_DATA, ev._outputs)
+        ev.outputs.setdefault("Status", 1)
+        self.assertEqual(1, ev.status)
+        self.assertEqual({}, agilkia.EMPTY_DATA)
+        with pytest.raises(TypeError):
+            agilkia.EMPTY_DATA["timestamp"] = "2020-01-01"
+        ev.meta_data = {"timestamp": "2020-01-02"}
+        self.assertEqual("2020-01-02", ev.meta_data["timestamp"])
+        # pickling keeps compacted events compact.
+        self.assertIs(agilkia.EMPTY_DATA, pickle.loads(pickle.dumps(agilkia.EMPTY_DATA)))
+        ev2 = agilkia.Event("Order", {}, {})
+        ev2.compact()
+        ev3 = pickle.loads(pickle.dumps(ev2))
+        self.assertIs(agilkia.EMPTY_DATA, ev3._inputs)
+        ev2.inputs["Name"] = "Mark"
+        ev3 = pickle.loads(pickle.dumps(ev2))
+        self.assertEqual((dict, {"Name": "Mark"}), (type(ev3.inputs), ev3.inputs))
+        self.assertEqual('{"outputs": {}}',
+                         json.dumps({"outputs": agilkia.EMPTY_DATA}))
+
 
 class TestTrace(unittest.TestCase):
     """Unit tests for agilkia.Trace and agilkia.TraceSet."""
@@ -274,6 +569,32 @@ class TestTrace(unittest.TestCase):
         self.assertEqual(8, df.shape[1])  # columns
         cols = ["Trace", "Event", "Action", "Status", "Error", "Name", "Amount", "Size"]
         self.assertEqual(cols, list(df.columns))
+        self.assertEqual("category", df.Action.dtype)
+        self.assertEqual("category", df.Error.dtype)
+        self.assertEqual(np.int8, df.Trace.dtype)
+        self.assertEqual(["Order", "Pay", "Skip", "Pay"], df.Action.tolist())
+        self.assertEqual(["", "", "Too big", ""], df.Error.tolist())
+        self.assertEqual([0, 0, 1, 0], df.Status.tolist())
+        self.assertEqual([0, 1, 0, 1], df.Event.tolist())
+        self.assertEqual([23.45, 23.45], df.Amount[[1, 3]].tolist())
+        self.assertTrue(np.isnan(df.Amount[2]))
+        ev5 = agilkia.Event("Pay", {"Amount": 1.0}, {"Status": 0, "Total": 9}, {"timestamp": "t"})
+        traces.append(agilkia.Trace([ev5]))
+        df = traces.to_pandas(inputs=["Amount", "Other"], outputs=True, meta_keys=["timestamp"])
+        cols = ["Trace", "Event", "Action", "Status", "Error", "Amount", "Other",
+                "out_Total", "meta_timestamp"]
+        self.assertEqual(cols, list(df.columns))
+        self.assertEqual(9, df.out_Total[4])
+        self.assertEqual("t", df.meta_timestamp[4])
+        self.assertEqual(5, df.Other.isna().sum())
+        chunks = list(traces.iter_pandas(2, inputs=["Name"]))
+        self.assertEqual([4, 1], [chunk.shape[0] for chunk in chunks])
+        self.assertEqual([2], chunks[1].Trace.tolist())
+        self.assertEqual(list(chunks[0].dtypes), list(chunks[1].dtypes))
+        self.assertEqual(["Order", "Pay", "Skip"], list(chunks[1].Action.cat.categories))
+        df = agilkia.traces_to_pandas(traces.traces[2:], inputs=False)
+        self.assertEqual(["Trace", "Event", "Action", "Status", "Error"], list(df.columns))
+        self.assertEqual(["Pay"], list(df.Action))
 
     def test_default_meta_data(self):
         now = str(datetime.datetime.now())
@@ -286,6 +607,33 @@ class TestTrace(unittest.TestCase):
         i64 = pd.api.types.pandas_dtype("int64")
         self.assertEqual("INTEGER", traces.arff_type(i64))
 
+    def test_save_to_arff(self):
+        ev5 = agilkia.Event("Pay", {"Name": "O'Neil, Jo", "Size": 1.5}, {"Status": 0})
+        traces = agilkia.TraceSet([agilkia.Trace([self.ev1, self.ev2]), agilkia.Trace([ev5])])
+        self.assertEqual(["Order", "Pay", "Skip"],
+                         traces.arff_type(pd.CategoricalDtype(["Skip", "Order", "Pay"])))
+        self.assertEqual("STRING", traces.arff_type(np.dtype(object), {"a", "b"}, max_nominal=1))
+        tmp_arff = Path("tmp_traces.arff")
+        try:
+            traces.save_to_arff(tmp_arff, max_nominal=2)
+            lines = tmp_arff.read_text().splitlines()
+        finally:
+            tmp_arff.unlink()
+        self.assertEqual(["% Events from tmp_traces", "@RELATION tmp_traces", "",
+                          "@ATTRIBUTE Trace INTEGER",
+                          "@ATTRIBUTE Event INTEGER",
+                          "@ATTRIBUTE Action STRING",
+                          "@ATTRIBUTE Status INTEGER",
+                          "@ATTRIBUTE Error {'', 'Too big'}",
+                          "@ATTRIBUTE Name {Mark, 'O\\'Neil, Jo'}",
+                          "@ATTRIBUTE Size REAL",
+                          "",
+                          "@DATA",
+                          "0,0,Order,0,'',Mark,?",
+                          "0,1,Skip,1,'Too big',?,3",
+                          "1,0,Pay,0,'','O\\'Neil, Jo',1.5"],
+                         lines)
+
     def test_split_none(self):
         # each ev1 will start a new trace
         trace = agilkia.Trace([self.ev2, self.ev1, self.ev3, self.ev1, self.ev1, self.ev2])
@@ -364,6 +712,35 @@ class TestTrace(unittest.TestCase):
         self.assertEqual(2, len(traces3s1[0]))
         self.assertEqual(2, len(traces3s1[1]))
 
+    def test_split_delay_timestamps(self):
+        def event(timestamp):
+            meta = {} if timestamp is None else {"timestamp": timestamp}
+            return agilkia.Event("Act", {}, {}, meta)
+        trace = agilkia.Trace([event("2020-02-16T12:00:00"), event("2020-02-16T12:10:00.5"),
+                               event(None), event("2020-02-16T13:00:00"),
+                               event("2020-02-16T13:40:00+00:00"),
+                               event("2020-02-16T15:00:00+01:00")])
+        expect = ["2020-02-16T12:00:00", "2020-02-16T12:10:00.5", "NaT",
+                  "2020-02-16T13:00:00", "2020-02-16T13:40:00", "2020-02-16T14:00:00"]
+        nptest.assert_array_equal(np.array(expect, dtype="datetime64[ns]"),
+                                  trace.get_timestamps())
+        with self.assertRaises(TypeError):
+            # like datetime, we cannot compare naive and timezone-aware timestamps.
+            agilkia.TraceSet([trace]).with_traces_split(delay=datetime.timedelta(minutes=5))
+        # the missing timestamp means that the 12:10 to 13:00 gap is ignored.
+        traces = agilkia.TraceSet([agilkia.Trace(trace.events[0:4]),
+                                   agilkia.Trace(trace.events[4:])])
+        split = traces.with_traces_split(delay=datetime.timedelta(minutes=5))
+        self.assertEqual([1, 3, 1, 1], [len(tr) for tr in split])
+        split = traces.with_traces_split(delay=datetime.timedelta(minutes=15))
+        self.assertEqual([4, 1, 1], [len(tr) for tr in split])
+        split = traces.with_traces_split(delay=datetime.timedelta(minutes=15), start_action="Act")
+        self.assertEqual([1, 1, 1, 1, 1, 1], [len(tr) for tr in split])
+        # appending an event discards the cached timestamps.
+        traces[1].append(event("2020-02-16T14:30:00+00:00"))
+        split = traces.with_traces_split(delay=datetime.timedelta(minutes=20))
+        self.assertEqual([4, 2, 1], [len(tr) for tr in split])
+
     def test_events_filtered(self):
         ev9 = agilkia.Event("someAction", {}, {}, {"key": 3})
         ev10 = agilkia.Event("someAction", {}, {}, {"key": '3'})
@@ -414,6 +791,144 @@ class TestTrace(unittest.TestCase):
         self.assertEqual(4, len(traces2[0]))
         self.assertEqual(1, len(traces2[1]))
 
+    def test_views(self):
+        ev3b = agilkia.Event("Pay", {"Name": "Merry", "Amount": 23.45}, {"Status": 0},
+                             {"shop": "B"})
+        ev1b = agilkia.Event("Order", {"Name": "Mark"}, {"Status": 0}, {"shop": "B"})
+        trace = agilkia.Trace([self.ev1, self.ev3, ev3b, self.ev3, self.ev2, ev1b, ev3b])
+        traces = agilkia.TraceSet([trace, agilkia.Trace([])])
+        grouped = traces.with_traces_grouped_by("Name", view=True)
+        split = grouped.with_traces_split(start_action="Order", view=True)
+        filtered = split.with_events_filtered("shop", "B", view=True)
+        for (derived, copied) in [
+                (grouped, traces.with_traces_grouped_by("Name")),
+                (split, grouped.with_traces_split(start_action="Order")),
+                (filtered, split.with_events_filtered("shop", "B"))]:
+            self.assertTrue(all(isinstance(tr, agilkia.TraceView) for tr in derived))
+            self.assertEqual([list(tr) for tr in copied], [list(tr) for tr in derived])
+            self.assertEqual([tr[:] for tr in copied], [tr[:] for tr in derived])
+        # the views all share the original list of events.
+        self.assertEqual([[ev1b], [ev3b, ev3b]], [list(tr) for tr in filtered])
+        self.assertIs(trace.events, filtered[1]._source)
+        self.assertEqual(ev3b, filtered[1][-1])
+        self.assertEqual({"Pay": 2}, filtered[1].action_counts())
+        # filtered traces start with empty meta data, whether they are views or copies.
+        split[1].meta_data["Name"] = "Merry"
+        for copied in [split.with_events_filtered("shop", "B", view=True),
+                       split.with_events_filtered("shop", "B")]:
+            self.assertEqual({}, copied[1].meta_data)
+            copied[1].meta_data["filtered"] = True
+            self.assertEqual({"Name": "Merry"}, split[1].meta_data)
+        # saving does not materialize, but appending does.
+        tmp_json = Path("tmp_views.json")
+        filtered.save_to_json(tmp_json)
+        loaded = agilkia.TraceSet.load_from_json(tmp_json)
+        tmp_json.unlink()
+        self.assertEqual([1, 2], [len(tr) for tr in loaded])
+        self.assertFalse(filtered[1].is_materialized())
+        filtered[1].append(self.ev1)
+        self.assertTrue(filtered[1].is_materialized())
+        self.assertEqual([ev3b, ev3b, self.ev1], filtered[1].events)
+        self.assertEqual(7, len(trace))
+
+    def test_group_across_traces(self):
+        def event(name, time):
+            return agilkia.Event("Act", {"Name": name}, {}, {"timestamp": time, "n": time[-1]})
+        ev1 = event("A", "2020-01-01T10:05")
+        ev2 = event("B", "2020-01-01T10:01")
+        ev3 = event("A", "2020-01-01T10:02")
+        ev4 = event("C", "2020-01-01T10:03")
+        ev5 = event("B", "2020-01-01T10:00")
+        ev6 = agilkia.Event("Act", {}, {})
+        traces = agilkia.TraceSet([agilkia.Trace([ev1, ev2]), agilkia.Trace([]),
+                                   agilkia.Trace([ev3, ev6, ev4, ev5])])
+        within = traces.with_traces_grouped_by("Name")
+        self.assertEqual([[ev1], [ev2], [ev3], [ev4], [ev5]], [tr.events for tr in within])
+        expect = [[ev1, ev3], [ev2, ev5], [ev4]]
+        for view in [False, True]:
+            for workers in [None, 2]:
+                grouped = traces.with_traces_grouped_by("Name", across_traces=True, view=view,
+                                                        workers=workers)
+                self.assertEqual(expect, [list(tr) for tr in grouped])
+        grouped = traces.with_traces_grouped_by(key=lambda ev: ev.inputs.get("Name") != "C",
+                                                across_traces=True, sort_by="timestamp")
+        self.assertEqual([[ev5, ev2, ev3, ev1, ev6], [ev4]], [tr.events for tr in grouped])
+        grouped = traces.with_traces_grouped_by("Name", across_traces=True, sort_by="n",
+                                                view=True)
+        self.assertEqual([[ev3, ev1], [ev5, ev2], [ev4]], [list(tr) for tr in grouped])
+        empty = agilkia.TraceSet([]).with_traces_grouped_by("Name", across_traces=True,
+                                                            sort_by="timestamp")
+        self.assertEqual(0, len(empty))
+
+    def test_query(self):
+        def event(action, name, shop):
+            return agilkia.Event(action, {"Name": name}, {"Status": 0}, {"shop": shop})
+        trace1 = agilkia.Trace([event("Login", "A", 1), event("Pay", "B", 1),
+                                event("Pay", "A", 2), event("Login", "A", 1),
+                                event("Buy", "A", 1), event("Pay", "B", 1)])
+        trace2 = agilkia.Trace([event("Buy", "C", 2)])
+        traces = agilkia.TraceSet([trace1, trace2, agilkia.Trace([])],
+                                  {"date": "2020-01-01", "dataset": "query"})
+        eager = (traces.with_events_filtered("shop", 1)
+                 .with_traces_grouped_by("Name")
+                 .with_traces_split(start_action="Login"))
+        tmp_json = Path("tmp_query.json")
+        tmp2_json = Path("tmp_query2.json")
+        traces.save_to_json(tmp_json)
+        try:
+            for source in [traces.query(), agilkia.TraceSet.query_json(tmp_json)]:
+                query = (source.filter_events("shop", 1)
+                         .group_by("Name")
+                         .split(start_action="Login"))
+                lazy = query.collect()
+                self.assertEqual("query", lazy.get_meta("dataset"))
+                self.assertEqual([str(tr) for tr in eager], [str(tr) for tr in lazy])
+                self.assertEqual([[ev.action for ev in tr] for tr in eager],
+                                 [[ev.action for ev in tr] for tr in lazy])
+                pd.testing.assert_frame_equal(eager.get_trace_data(),
+                                              query.features().to_pandas())
+                for (method, kwargs) in [("ngrams", {"n": 3}), ("transitions", {"hash_size": 4})]:
+                    pd.testing.assert_frame_equal(eager.get_trace_data(method, **kwargs),
+                                                  query.features(method, **kwargs).to_pandas())
+                pd.testing.assert_frame_equal(eager.to_pandas(), query.to_pandas())
+                chunks = pd.concat(query.iter_pandas(2), ignore_index=True)
+                pd.testing.assert_frame_equal(eager.to_pandas(), chunks)
+                self.assertEqual(len(eager), query.save(tmp2_json))
+                saved = agilkia.TraceSet.load_from_json(tmp2_json)
+                self.assertEqual([len(tr) for tr in eager], [len(tr) for tr in saved])
+                self.assertEqual("query", saved.get_meta("dataset"))
+            # files with the meta-data after the traces are saved in the same layout.
+            with agilkia.TraceSetWriter(tmp_json, meta_data_last=True) as writer:
+                for tr in traces:
+                    writer.write(tr)
+                writer.meta_data = traces.meta_data
+            query = agilkia.TraceSet.query_json(tmp_json).filter_events("shop", 1)
+            self.assertEqual(2, query.save(tmp2_json, index=True))
+            self.assertEqual(["__class__", "__module__", "version", "traces", "meta_data"],
+                             list(json.loads(tmp2_json.read_text())))
+            saved = agilkia.TraceSet.load_from_json(tmp2_json)
+            self.assertEqual("query", saved.get_meta("dataset"))
+            loaded = agilkia.TraceSet.load_traces(tmp2_json, [0])
+            self.assertEqual(("query", 5), (loaded.get_meta("dataset"), len(loaded[0])))
+            Path("tmp_query2.json.index.npz").unlink()
+            # the query builder methods do not change the original query.
+            query = traces.query()
+            query.filter_events("shop", 2)
+            self.assertEqual(3, len(query.collect()))
+            # and collecting the traces does not take them away from their set.
+            columns = traces.get_columns()
+            copied = traces.query().collect()
+            self.assertEqual([tr.events for tr in traces], [list(tr) for tr in copied])
+            self.assertTrue(all(tr._parent is traces for tr in traces))
+            self.assertIs(columns, traces.get_columns())
+            copied[0].append(event("Buy", "A", 1))
+            copied[0].meta_data["copied"] = True
+            self.assertEqual((6, {}), (len(trace1), trace1.meta_data))
+            self.assertIs(columns, traces.get_columns())
+        finally:
+            tmp_json.unlink()
+            tmp2_json.unlink()
+
 
 class TestTraceSet(unittest.TestCase):
     """Unit tests specifically for agilkia.TraceSet.
@@ -458,6 +973,309 @@ class TestTraceSet(unittest.TestCase):
         self.assertFalse(traces2.is_clustered())
         tmp3_json.unlink()
 
+    def test_sparse_trace_data(self):
+        ev3 = agilkia.Event("Pay", {}, {"Status": 2})
+        tr1 = agilkia.Trace([self.ev2, self.ev2, self.ev1])
+        tr2 = agilkia.Trace([self.ev1, self.ev1, ev3])
+        tr3 = agilkia.Trace([])
+        traces1 = agilkia.TraceSet([tr1, tr2, tr3])
+        for method in ["action_counts", "action_status_counts"]:
+            dense = traces1.get_trace_data(method)
+            (matrix, names) = traces1.get_trace_data(method, sparse=True)
+            self.assertTrue(scipy.sparse.isspmatrix_csr(matrix))
+            self.assertEqual(list(dense.columns), names)
+            nptest.assert_array_equal(dense.values, matrix.toarray())
+            # the general (non-columnar) algorithm gives the same matrix.
+            trace_data = [getattr(agilkia.Trace(tr.events), method)() for tr in traces1]
+            (matrix2, names2) = agilkia.json_traces._trace_data_matrix(trace_data, None)
+            self.assertEqual(names, names2)
+            nptest.assert_array_equal(matrix.toarray(), matrix2.toarray())
+        (matrix, names) = traces1.get_trace_data(columns=["Skip", "Other", "Order"], sparse=True)
+        self.assertEqual(["Skip", "Other", "Order"], names)
+        nptest.assert_array_equal([[2, 0, 1], [0, 0, 2], [0, 0, 0]], matrix.toarray())
+
+    def test_ngram_counts(self):
+        # ev1 is "Order", ev2 is "Skip"
+        tr1 = agilkia.Trace([self.ev2, self.ev2, self.ev1])
+        tr2 = agilkia.Trace([self.ev1, self.ev1, self.ev2, self.ev1])
+        tr3 = agilkia.Trace([])
+        self.assertEqual({"Skip->Skip": 1, "Skip->Order": 1}, tr1.action_ngram_counts())
+        self.assertEqual({"^->Skip": 1, "Skip->Skip": 1, "Skip->Order": 1, "Order->$": 1},
+                         tr1.action_transition_counts())
+        self.assertEqual({"Order->Order->Skip": 1, "Order->Skip->Order": 1},
+                         tr2.action_ngram_counts(3))
+        self.assertEqual({"^->$": 1}, tr3.action_transition_counts())
+        self.assertEqual({}, tr3.action_ngram_counts())
+        traces1 = agilkia.TraceSet([tr1, tr2, tr3])
+        # the columnar results are the same as for traces that are not in a TraceSet.
+        for kwargs in [{}, {"n": 1}, {"n": 3, "pad": True}, {"hash_size": 3}]:
+            for tr in traces1:
+                self.assertEqual(agilkia.Trace(tr.events).action_ngram_counts(**kwargs),
+                                 tr.action_ngram_counts(**kwargs))
+        data = traces1.get_trace_data("ngrams")
+        self.assertEqual(["Order->Order", "Order->Skip", "Skip->Order", "Skip->Skip"],
+                         list(data.columns))
+        nptest.assert_array_equal([[0, 0, 1, 1], [1, 1, 1, 0], [0, 0, 0, 0]], data.values)
+        (matrix, names) = traces1.get_trace_data("transitions", sparse=True)
+        self.assertEqual(8, len(names))
+        self.assertEqual([4, 5, 1], matrix.sum(axis=1).A1.tolist())
+        # hashing caps the number of columns.
+        (matrix, names) = traces1.get_trace_data("ngrams", n=3, pad=True, hash_size=2,
+                                                 sparse=True)
+        self.assertTrue(set(names) <= {"hash0", "hash1"})
+        self.assertEqual([3, 4, 0], matrix.sum(axis=1).A1.tolist())
+        # there is still one row per trace when there are no n-grams at all.
+        self.assertEqual((3, 0), traces1.get_trace_data("ngrams", n=9).shape)
+
+    def test_trace_data_cache(self):
+        tr1 = agilkia.Trace([self.ev1, self.ev2])
+        counts = tr1.action_counts()
+        counts["Order"] = 99  # updating the result does not change the cache.
+        self.assertEqual({"Order": 1, "Skip": 1}, tr1.action_counts())
+        tr1.append(self.ev1)
+        self.assertEqual({"Order": 2, "Skip": 1}, tr1.action_counts())
+        # appending directly to the list of events is noticed too.
+        tr1.events.append(self.ev2)
+        self.assertEqual({"Order": 2, "Skip": 2}, tr1.action_counts())
+        tr1.events.pop()
+        traces1 = agilkia.TraceSet([tr1])
+        data = traces1.get_trace_data()
+        self.assertIn(("action_counts", None, False, ()), traces1._trace_data)
+        data["Order"] = 0
+        self.assertEqual([2, 1], traces1.get_trace_data().values[0].tolist())
+        tr1.append(self.ev2)
+        self.assertEqual([2, 2], traces1.get_trace_data().values[0].tolist())
+        self.assertEqual({"Order": 2, "Skip": 2}, tr1.action_counts())
+        tr1.events.append(self.ev2)
+        self.assertEqual({"Order": 2, "Skip": 3}, tr1.action_counts())
+        self.assertEqual([2, 3], traces1.get_trace_data().values[0].tolist())
+        tr1.events.pop()
+        traces1.append(agilkia.Trace([self.ev2]))
+        self.assertEqual([[2, 2], [0, 1]], traces1.get_trace_data().values.tolist())
+        traces1.set_event_chars({"Order": "o"})
+        self.assertEqual({}, traces1._trace_data)
+        # changing the events directly requires invalidate_columns.
+        tr1.events[0] = self.ev2
+        self.assertEqual([[2, 2], [0, 1]], traces1.get_trace_data().values.tolist())
+        traces1.invalidate_columns()
+        self.assertEqual([[1, 3], [0, 1]], traces1.get_trace_data().values.tolist())
+        self.assertEqual({"Order": 1, "Skip": 3}, tr1.action_counts())
+
+    def test_sparse_clustering(self):
+        tr1 = agilkia.Trace([self.ev2, self.ev2, self.ev1])  # in cluster 1
+        tr2 = agilkia.Trace([self.ev1, self.ev1, self.ev2])  # in cluster 0
+        tr3 = agilkia.Trace([self.ev1, self.ev2, self.ev1])  # in cluster 0
+        traces1 = agilkia.TraceSet([tr1, tr2, tr3])
+        data = traces1.get_trace_data(sparse=True)
+        # MeanShift needs dense data, so this converts it.
+        self.assertEqual(2, traces1.create_clusters(data))
+        nptest.assert_array_equal([tr1], traces1.get_cluster(1))
+        # KMeans accepts sparse data directly.
+        kmeans = sklearn.cluster.KMeans(n_clusters=2, n_init=10, random_state=0)
+        self.assertEqual(2, traces1.create_clusters(data, algorithm=kmeans))
+        self.assertTrue(scipy.sparse.issparse(traces1._cluster_data))
+        self.assertEqual([tr2, tr3], traces1.get_cluster(traces1.get_clusters()[1]))
+
+    def test_cluster_strategies(self):
+        # 60 traces of mostly Order, and 40 traces of mostly Skip.
+        traces = [agilkia.Trace([self.ev1] * 5 + [self.ev2] * (i % 2)) for i in range(60)]
+        traces += [agilkia.Trace([self.ev2] * 4 + [self.ev1] * (i % 3)) for i in range(40)]
+        traces1 = agilkia.TraceSet(traces)
+        data = traces1.get_trace_data()
+        expect = [0] * 60 + [1] * 40
+        for (kwargs, kept) in [({}, 100),
+                               ({"sample_size": 20}, 100),
+                               ({"batch_size": 30}, 30),
+                               ({"sample_size": 20, "batch_size": 30}, 20)]:
+            for strategy in ["minibatch_kmeans", "birch"]:
+                num = traces1.create_clusters(data, strategy=strategy, n_clusters=2,
+                                              random_state=1, **kwargs)
+                self.assertEqual(2, num)
+                clusters = list(traces1.get_clusters())
+                if clusters[0] == 1:
+                    clusters = [1 - c for c in clusters]
+                self.assertEqual(expect, clusters)
+                self.assertEqual(kept, traces1._cluster_data.shape[0])
+        # HDBSCAN cannot predict, so the traces are given the cluster of the nearest sample.
+        # It finds the 5 distinct kinds of trace (2 mostly Order, and 3 mostly Skip).
+        num = traces1.create_clusters(traces1.get_trace_data(sparse=True), strategy="hdbscan",
+                                      sample_size=50, batch_size=40, random_state=1)
+        self.assertEqual(5, num)
+        clusters = traces1.get_clusters()
+        self.assertEqual(2, len(set(clusters[:60])))
+        self.assertEqual(3, len(set(clusters[60:])))
+        self.assertEqual(list(clusters[:6]) * 10, list(clusters[:60]))
+        with self.assertRaises(Exception):
+            traces1.create_clusters(data, strategy="unknown")
+        with self.assertRaises(Exception):
+            traces1.create_clusters(data, algorithm=sklearn.cluster.Birch(), strategy="birch")
+
+    def test_stratified_sample(self):
+        rand = np.random.default_rng(1)
+        strata = np.array([0] * 90 + [1] * 9 + [2])
+        sample = agilkia.json_traces._stratified_sample(strata, 10, rand)
+        self.assertEqual([9, 1, 1], np.bincount(strata[sample]).tolist())
+        self.assertEqual(sorted(sample), list(sample))
+
+    def test_cluster_index(self):
+        traces = [agilkia.Trace([self.ev1] * (i % 3)) for i in range(7)]
+        traces1 = agilkia.TraceSet(traces)
+        dbscan = sklearn.cluster.DBSCAN(eps=0.01, min_samples=2)
+        # traces 1,4 and 2,5 are two clusters, while traces 0,3,6 are far apart, so are noise.
+        data = pd.DataFrame({"n": [i % 3 if i % 3 else 9 * i for i in range(7)]})
+        self.assertEqual(2, traces1.create_clusters(data, dbscan))
+        self.assertEqual([1, 4], list(traces1.get_cluster_indices(0)))
+        self.assertEqual([2, 5], list(traces1.get_cluster_indices(1)))
+        self.assertEqual([0, 3, 6], list(traces1.get_cluster_indices(-1)))
+        self.assertEqual([], list(traces1.get_cluster_indices(2)))
+        self.assertEqual([2, 2], list(traces1.cluster_sizes()))
+        self.assertEqual([traces[2], traces[5]], traces1.get_cluster(1))
+        self.assertEqual([(0, [traces[1], traces[4]]), (1, [traces[2], traces[5]])],
+                         list(traces1.iter_clusters()))
+        traces1.append(agilkia.Trace([]))
+        with self.assertRaises(Exception):
+            traces1.get_cluster(0)
+
+    def test_embed_clusters(self):
+        traces = [agilkia.Trace([self.ev1] * 5 + [self.ev2] * (i % 2)) for i in range(60)]
+        traces += [agilkia.Trace([self.ev2] * 4 + [self.ev1] * (i % 3)) for i in range(40)]
+        traces1 = agilkia.TraceSet(traces)
+        with self.assertRaises(Exception):
+            traces1._embed_clusters(None, True, None, None, 1)
+        kmeans = sklearn.cluster.KMeans(n_clusters=2, n_init=10, random_state=0)
+        traces1.create_clusters(traces1.get_trace_data(method="action_status_counts"), kmeans)
+        (rows, points) = traces1._embed_clusters(None, True, 50, 2, 1)
+        self.assertEqual((50, 2), points.shape)
+        self.assertEqual([20, 30], sorted(np.bincount(traces1.get_clusters()[rows])))
+        # the same arguments reuse the cached points.
+        self.assertIs(points, traces1._embed_clusters(None, True, 50, 2, 1)[1])
+        self.assertIsNot(points, traces1._embed_clusters(None, True, 60, 2, 1)[1])
+        with self.assertRaises(Exception):
+            traces1._embed_clusters(sklearn.decomposition.PCA(2), False, None, 2, 1)
+
+    def test_point_finder(self):
+        finder = agilkia.json_traces._PointFinder(np.array([[0.0, 0.0], [1.0, 0.0], [0.0, 0.1]]))
+        pixels = np.array([[100.0, 0, 0], [0, 10.0, 0], [0, 0, 1.0]])  # X is 10 times Y.
+        self.assertEqual([0, 2], finder.find(pixels, 0.0, 0.001))
+        self.assertEqual([1], finder.find(pixels, 0.98, 0.0))
+        self.assertEqual([], finder.find(pixels, 0.5, 0.0))
+        self.assertEqual([], finder.find(pixels, None, None))
+        zoomed = pixels * 100
+        self.assertEqual([0], finder.find(zoomed, 0.0, 0.001))
+
+    def test_save_clusters(self):
+        traces = [agilkia.Trace([self.ev1] * 5 + [self.ev2] * (i % 2)) for i in range(6)]
+        traces += [agilkia.Trace([self.ev2] * 4 + [self.ev1] * (i % 3)) for i in range(4)]
+        traces1 = agilkia.TraceSet(traces)
+        kmeans = sklearn.cluster.KMeans(n_clusters=2, n_init=10, random_state=0)
+        for sparse in [False, True]:
+            data = traces1.get_trace_data(sparse=sparse)
+            self.assertEqual(2, traces1.create_clusters(data, algorithm=kmeans))
+            tmp_clusters = Path("tmp.clusters.npz")
+            traces1.save_clusters(tmp_clusters)
+            # the same traces, loaded separately.
+            traces2 = agilkia.TraceSet([agilkia.Trace(list(tr)) for tr in traces])
+            self.assertFalse(traces2.is_clustered())
+            self.assertEqual(2, traces2.load_clusters(tmp_clusters))
+            self.assertEqual(list(traces1.get_clusters()), list(traces2.get_clusters()))
+            self.assertEqual([tr.events for tr in traces1.get_cluster(1)],
+                             [tr.events for tr in traces2.get_cluster(1)])
+            self.assertEqual(scipy.sparse.issparse(traces2._cluster_data), sparse)
+            (normalizer, algorithm, columns) = traces2.get_cluster_model()
+            self.assertEqual(["Order", "Skip"], columns)
+            nptest.assert_array_equal(kmeans.cluster_centers_, algorithm.cluster_centers_)
+            # the loaded model can predict clusters.
+            traces2.create_clusters(data, algorithm, normalizer, fit=False)
+            self.assertEqual(list(traces1.get_clusters()), list(traces2.get_clusters()))
+            # traces with different contents are rejected.
+            traces3 = agilkia.TraceSet(traces[1:] + traces[:1])
+            with self.assertRaises(Exception):
+                traces3.load_clusters(tmp_clusters)
+            tmp_clusters.unlink()
+
+    def test_columns(self):
+        ev3 = agilkia.Event("Order", {"Name": "Mark"}, {})
+        tr1 = agilkia.Trace([self.ev2, self.ev2, self.ev1, ev3])
+        tr2 = agilkia.Trace([])
+        tr3 = agilkia.Trace([self.ev1, self.ev2, self.ev1])
+        traces = agilkia.TraceSet([tr1, tr2, tr3])
+        cols = traces.get_columns()
+        self.assertEqual(["Order", "Skip"], cols.actions)
+        nptest.assert_array_equal([1, 1, 0, 0, 0, 1, 0], cols.action_codes)
+        nptest.assert_array_equal([0, 4, 4, 7], cols.offsets)
+        nptest.assert_array_equal([1, 1, 0, 0, 0, 1, 0], cols.statuses)
+        self.assertIs(cols, traces.get_columns())
+        self.assertEqual(["Order", "Skip"], traces.get_all_actions())
+        self.assertEqual({"Order", "Skip"}, agilkia.all_action_names(traces))
+        self.assertEqual({"Order": 2, "Skip": 2}, tr1.action_counts())
+        self.assertEqual({"Order_0": 2, "Skip_1": 2}, tr1.action_status_counts())
+        self.assertEqual({}, tr2.action_counts())
+        # compare the table with the general (non-columnar) algorithm.
+        for method in ["action_counts", "action_status_counts"]:
+            expect = pd.DataFrame([getattr(agilkia.Trace(tr.events), method)() for tr in traces])
+            expect = expect[sorted(expect.columns)].fillna(value=0)
+            pd.testing.assert_frame_equal(expect, traces.get_trace_data(method))
+        data = traces.get_trace_data(columns=["Skip", "Other"])
+        self.assertEqual([2.0, 0.0, 1.0], list(data["Skip"]))
+        self.assertEqual([0.0, 0.0, 0.0], list(data["Other"]))
+        # to_string
+        to_char = {"Order": "O", "Skip": "S"}
+        for compress in [None, ["Skip"], ["Order", "Skip"]]:
+            for color in [False, True]:
+                expect = agilkia.trace_to_string(tr1.events, to_char, compress, color)
+                self.assertEqual(expect, tr1.to_string(to_char, compress, color))
+        with self.assertRaises(KeyError):
+            tr1.to_string({"Order": "O"})
+        # appending invalidates the columns.
+        tr2.append(agilkia.Event("Pay", {}, {"Status": "2"}))
+        self.assertEqual(["Order", "Pay", "Skip"], traces.get_all_actions())
+        self.assertEqual({"Pay_2": 1}, tr2.action_status_counts())
+        traces.append(agilkia.Trace([ev3]))
+        self.assertEqual(4, traces.get_columns().num_traces)
+        nptest.assert_array_equal([0, 4, 5, 8, 9], traces.get_columns().offsets)
+        # appending directly to the list of events is noticed too.
+        tr3.events.append(self.ev2)
+        nptest.assert_array_equal([0, 4, 5, 9, 10], traces.get_columns().offsets)
+        self.assertEqual(10, len(traces.to_pandas()))
+
+    def test_to_strings(self):
+        tr1 = agilkia.Trace([self.ev2, self.ev2, self.ev1])
+        tr2 = agilkia.Trace([self.ev2, self.ev1, self.ev1])
+        traces = agilkia.TraceSet([tr1, agilkia.Trace([]), tr2])
+        traces.set_event_chars({"Order": "O", "Skip": "S"})
+        self.assertEqual(["SSO", "", "SOO"], traces.to_strings())
+        self.assertEqual(["SO", "", "SO"], traces.to_strings(compress=["Order", "Skip"]))
+        red = "\033[91mS\033[0m"
+        self.assertEqual([red + "O", "", red + "O"], traces.to_strings(["Skip", "Order"], True))
+        for compress in [None, ["Skip"]]:
+            for color in [False, True]:
+                expect = [agilkia.trace_to_string(tr, traces.get_event_chars(), compress, color)
+                          for tr in traces]
+                self.assertEqual(expect, traces.to_strings(compress, color))
+                self.assertEqual(expect, [tr.to_string(None, compress, color) for tr in traces])
+        # the cached strings are discarded when the chars or events change.
+        traces.set_event_chars({"Order": "o", "Skip": "s"})
+        self.assertEqual("sso", str(tr1))
+        tr1.append(self.ev2)
+        self.assertEqual("ssos", str(tr1))
+        traces.append(agilkia.Trace([self.ev1]))
+        self.assertEqual(["ssos", "", "soo", "o"], traces.to_strings())
+        # appending directly to the list of events is noticed too.
+        tr2.events.append(self.ev1)
+        self.assertEqual("sooo", str(tr2))
+        tr1.events.append(self.ev1)
+        self.assertEqual(["ssoso", "", "sooo", "o"], traces.to_strings())
+
+    def test_hmm_symbols(self):
+        ev3 = agilkia.Event("Order", {"Name": "Mark"}, {})
+        traces = agilkia.TraceSet([agilkia.Trace([self.ev2, ev3, self.ev1]),
+                                   agilkia.Trace([]),
+                                   agilkia.Trace([self.ev1])])
+        hmm = agilkia.HMM_ClusterAlgo()
+        expect = [[hmm.eventToSymbol(ev) for ev in tr] for tr in traces]
+        self.assertEqual([["Skip1", "Order", "Order0"], [], ["Order0"]], expect)
+        self.assertEqual(expect, hmm.tracesSetToSymbolSeq(traces))
+
 
 class TestDefaultMapToChars(unittest.TestCase):
 
@@ -482,6 +1300,17 @@ class TestDefaultMapToChars(unittest.TestCase):
         expect = {'Order': 'O', 'Pay': 'P', 'PayLate': 'L', 'Save': '.', 'Skip': 'S'}
         self.assertEqual(expect, agilkia.default_map_to_chars(actions, given=given))
 
+    def test_default_map_to_chars_many(self):
+        actions = [f"get{noun}{suffix}" for noun in ["Order", "Item", "User"]
+                   for suffix in ["", "s", "ById", "Status"]]
+        result = agilkia.default_map_to_chars(actions, given={"getItem": "."})
+        self.assertEqual(sorted(actions), sorted(result))
+        self.assertEqual(len(actions), len(set(result.values())))
+        self.assertEqual({"getItem": ".", "getItemById": "B", "getItemStatus": "S",
+                          "getItems": "s", "getOrder": "g", "getOrderById": "e",
+                          "getOrderStatus": "t", "getOrders": "O", "getUser": "U",
+                          "getUserById": "r", "getUserStatus": "a", "getUsers": "*"}, result)
+
 
 class TestSafeString(unittest.TestCase):
 
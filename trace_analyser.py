@@ -10,8 +10,10 @@ Optionally, it can also report how many rows were added to each database table.
 
 import pandas as pd
 import argparse
+import itertools
 from pathlib import Path
 import textwrap
+from typing import Any, Dict, Iterable, Iterator, List
 
 import agilkia
 
@@ -39,20 +41,66 @@ def read_database_changes(before_csv: str, after_csv: str) -> pd.DataFrame:
     return changes
 
 
-def make_action_status_table(df: pd.DataFrame) -> pd.DataFrame:
-    """From TraceSet DataFrame, creates a table of Actions showing how many got Ok vs Error."""
-    ok = df[df.Status == 0].groupby("Action").size()
-    err = df[df.Status != 0].groupby("Action").size()
+def count_action_statuses(df: pd.DataFrame) -> pd.DataFrame:
+    """From TraceSet DataFrame, counts how many of each Action got Ok vs Error."""
+    ok = df[df.Status == 0].groupby("Action", observed=True).size()
+    err = df[df.Status != 0].groupby("Action", observed=True).size()
     data = pd.DataFrame({"Ok": ok, "Err": err})
-    data.fillna(0, inplace=True, downcast="infer")
+    return data.fillna(0).astype(int)
+
+
+def add_totals(data: pd.DataFrame) -> pd.DataFrame:
+    """Adds a Total column and a Total row to a table of Ok and Err counts."""
+    data = data.copy()
     data["Total"] = data.Ok + data.Err
     totals = data.sum().rename("Total")
     # add Totals row at bottom
-    data = data.append(totals)
-    # total = df.shape[0]  # number of rows = total event count
-    # percents = (totals * 100.0 / total).rename("Percent")
-    # data = data.append(percents)
-    return data
+    return pd.concat([data, totals.to_frame().T])
+
+
+def make_action_status_table(df: pd.DataFrame) -> pd.DataFrame:
+    """From TraceSet DataFrame, creates a table of Actions showing how many got Ok vs Error."""
+    return add_totals(count_action_statuses(df))
+
+
+def collect_statistics(chunks: Iterable[pd.DataFrame]) -> Dict[str, Any]:
+    """Calculates the statistics of a set of traces, one table of events at a time.
+
+    Args:
+        chunks: tables of events, such as from TraceSet.iter_pandas or traces_to_pandas.
+
+    Returns:
+        A dictionary with the number of "events", the number of non-empty "traces",
+        the "actions" (a list of all action names), the Ok/Err "action_status" table
+        (without totals), the number of events with each "errors" message,
+        and the number of events with status "ok".
+    """
+    stats: Dict[str, Any] = {
+        "events": 0, "traces": 0, "ok": 0, "actions": [],
+        "action_status": pd.DataFrame({"Ok": [], "Err": []}, dtype=int),
+        "errors": pd.Series([], dtype=int),
+    }
+    for df in chunks:
+        stats["events"] += df.shape[0]
+        stats["traces"] += df.Trace.nunique()
+        stats["ok"] += int((df.Status == 0).sum())
+        stats["actions"] = sorted(set(stats["actions"]).union(df.Action.cat.categories))
+        counts = count_action_statuses(df)
+        stats["action_status"] = stats["action_status"].add(counts, fill_value=0).astype(int)
+        errors = df[df.Error != ""].groupby("Error", observed=True).size()  # "" is no error.
+        stats["errors"] = stats["errors"].add(errors, fill_value=0).astype(int)
+    return stats
+
+
+def iter_chunks(traces: Iterable[agilkia.Trace],
+                chunk_traces: int) -> Iterator[List[agilkia.Trace]]:
+    """Groups the traces into lists of (at most) chunk_traces traces."""
+    traces_iter = iter(traces)
+    while True:
+        chunk = list(itertools.islice(traces_iter, chunk_traces))
+        if not chunk:
+            return
+        yield chunk
 
 
 def main():
@@ -61,10 +109,12 @@ def main():
     parser.add_argument("-a", "--after", help="database row counts AFTER testing (*.csv)")
     parser.add_argument("-b", "--before", help="database row counts BEFORE testing (*.csv)")
     parser.add_argument("-c", "--chars", help="name of action-to-CHAR mapping file (*.csv)")
+    parser.add_argument("-k", "--chunk", type=int, default=1000,
+                        help="number of traces in each CHUNK of statistics (default 1000)")
     parser.add_argument("-r", "--repeats", help="remove REPEATS of this action")
     parser.add_argument("-s", "--status", help="show STATUS in color (red=error)",
                         action="store_true")
-    parser.add_argument("traces", help="traces file (*.json)")
+    parser.add_argument("traces", help="traces file (*.json, or compressed *.json.gz etc.)")
     args = parser.parse_args()
     # print(f"Args are:", args)
     if args.before and args.after:
@@ -72,30 +122,39 @@ def main():
         nonzero = changes[changes.added > 0].sort_values(by="added", ascending=False)
         print("==== database changes ====")
         print(nonzero)
-    traceset = agilkia.TraceSet.load_from_json(Path(args.traces))
-    actions = agilkia.all_action_names(traceset.traces)
+    # the traces are streamed from the file (twice), so that large files fit in memory.
+    # The first pass calculates the statistics, including all the action names.
+    traces_file = Path(args.traces)
+    header: Dict[str, Any] = {}
+    traces = agilkia.TraceSet.iter_traces_from_json(traces_file, header)
+    chunks = iter_chunks(traces, args.chunk)
+    stats = collect_statistics(agilkia.traces_to_pandas(chunk, inputs=False) for chunk in chunks)
+    char_map = header.get("meta_data", {}).get("action_chars")
     if args.chars:
         mapfile = pd.read_csv(args.chars, header=None)
         # we assume this has just two columns: 0=action_name and 1=char.
         char_map = dict(zip(mapfile.iloc[:, 0], mapfile.iloc[:, 1]))
         # print("given map=", char_map)
-        traceset.set_event_chars(char_map)
-    # print("final map=", char_map)
+    to_char = agilkia.default_map_to_chars(set(stats["actions"]), given=char_map)
+    # print("final map=", to_char)
+    # The second pass prints each chunk of traces, now that the action chars are known.
     repeats = [] if args.repeats is None else [args.repeats]
-    for tr in traceset.traces:
-        print(tr.to_string(compress=repeats, color_status=args.status))
+    num_traces = 0
+    for chunk in iter_chunks(agilkia.TraceSet.iter_traces_from_json(traces_file), args.chunk):
+        columns = agilkia.TraceSetColumns(chunk)
+        for line in columns.to_strings(to_char, compress=repeats, color_status=args.status):
+            print(line)
+        num_traces += len(chunk)
     print("==== statistics ====")
-    df = traceset.to_pandas()
-    # print(df.head())
-    print(f"Number of traces     : {len(traceset.traces)}")
-    print(f"Average trace length : {df.groupby('Trace').count().Action.mean()}")
-    print(f"Number of events     : {df.shape[0]}")
-    print(f"Number of event kinds: {len(actions)}")
-    print(textwrap.indent(str(make_action_status_table(df)), "    "))
-    statuses = df.Status.value_counts()
-    percent_ok = 100.0 * statuses[0] / df.shape[0]
+    num_events = stats["events"]
+    percent_ok = 100.0 * stats["ok"] / num_events if num_events else 100.0
+    print(f"Number of traces     : {num_traces}")
+    print(f"Average trace length : {num_events / stats['traces'] if stats['traces'] else 0}")
+    print(f"Number of events     : {num_events}")
+    print(f"Number of event kinds: {len(stats['actions'])}")
+    print(textwrap.indent(str(add_totals(stats["action_status"])), "    "))
     print(f"Detailed error counts: ({100.0 - percent_ok:.2f}%)")
-    print(textwrap.indent(str(df.groupby("Error").count().Action), "    "))
+    print(textwrap.indent(str(stats["errors"].rename_axis("Error").rename("Action")), "    "))
     print(f"Percent of status ok : {percent_ok:.2f}%")
 
 
@@ -30,12 +30,17 @@ def main():
     parser.add_argument("-v", "--verbose",
                         help="print VERBOSE messages during testing", action="store_true")
     parser.add_argument("-s", "--seed", type=int, help="SEED for random generator")
-    parser.add_argument("-o", "--output", type=str, default="out.json", help="name of OUTPUT file")
+    parser.add_argument("-o", "--output", type=str, default="out.json",
+                        help="name of OUTPUT file (*.json, or compressed *.json.gz etc.)")
+    parser.add_argument("--compact", help="save COMPACT JSON without indentation",
+                        action="store_true")
     parser.add_argument("url", nargs='+', help="URL of web service server")
     args = parser.parse_args()
     # print(f"Args are:", args)
 
-    json_output = Path(args.output).with_suffix(".json")
+    json_output = Path(args.output)
+    if ".json" not in json_output.suffixes:
+        json_output = json_output.with_suffix(".json")  # but allow compressed *.json.gz etc.
     if json_output.exists():
         raise Exception(f"do not want to overwrite {json_output}.")
     # process each optional argument
@@ -63,14 +68,19 @@ def main():
         # this will prompt for a password
         tester.set_username(input_rules["username"])
     # TODO: methods_to_test=None,
-    for i in range(args.tests):
-        if args.model:
-            trace = tester.generate_trace_ml(model, length=args.length, start=True)
-        else:
-            trace = tester.generate_trace(length=args.length, start=True)
-        if args.verbose:
-            print(f"  {str(trace)}")
-    tester.trace_set.save_to_json(json_output)
+    # each trace is saved as soon as it is generated, so a crash does not lose earlier traces.
+    indent = None if args.compact else 2
+    with agilkia.TraceSetWriter(json_output, tester.trace_set.meta_data,
+                                indent=indent, flush=True) as writer:
+        for i in range(args.tests):
+            if args.model:
+                trace = tester.generate_trace_ml(model, length=args.length, start=True)
+            else:
+                trace = tester.generate_trace(length=args.length, start=True)
+            if args.verbose:
+                print(f"  {str(trace)}")
+            if len(trace) > 0:
+                writer.write(trace)  # an empty trace will be reused by the next generate_trace.
 
 
 if __name__ == "__main__":